@@ -1,50 +1,209 @@
-import sqlite3
-import datetime
 import argparse
+import datetime
+import html
+import json
+import os
+import re
+import sqlite3
 import sys
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from state.WordCard import WordCard
+from state.WordCardImporter import card_key
+from utils.time_utils import unique_ids_by_time
+
+FIELD_SEPARATOR = '\x1f'
+# Ease of a review answered with Again
+EASE_AGAIN = 1
+# Rows fetched from the cursor at a time
+FETCH_SIZE = 500
+# Sidecar of the collection keeping the last revlog id already handed out, see Watermark
+WATERMARK_SUFFIX = ".again_today"
+ANKI_TAG = "anki"
+
+_TAGS = re.compile(r"<[^>]*>")
+
+
+@dataclass
+class FailedReview:
+    revlog_id: int
+    deck_name: str
+    note_id: int
+    fields: List[str]
+
+    @property
+    def word(self) -> str:
+        return self.fields[0] if self.fields else ""
+
+
+def deck_display_name(name: str) -> str:
+    """
+    Current collections separate the parts of nested deck names with the field separator instead of "::".
+    """
+    return name.replace(FIELD_SEPARATOR, "::")
+
+
+def today_start_millis() -> int:
+    today = datetime.date.today()
+    return int(datetime.datetime(today.year, today.month, today.day).timestamp()) * 1000
+
+
+def open_collection(db_path: str) -> sqlite3.Connection:
+    """
+    Opens the collection read-only, so that it can be read while Anki has it open: the connection takes
+    part in WAL like any other reader instead of copying or locking the file, and can't write to it.
+    """
+    connection = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+    connection.execute("PRAGMA query_only = ON")
+    return connection
+
+
+def iter_failed_reviews(connection: sqlite3.Connection, since_revlog_id: int) -> Iterator[FailedReview]:
+    """
+    Streams the reviews answered with Again whose revlog id, the review time in milliseconds, is greater than
+    since_revlog_id, in revlog order. The id is the revlog's primary key, so only the new rows are read,
+    and the rows are fetched from the cursor a batch at a time rather than all at once.
+    """
+    cursor = connection.execute('''
+        SELECT r.id, d.name, n.id, n.flds
+        FROM revlog r
+        JOIN cards c ON r.cid = c.id
+        JOIN notes n ON c.nid = n.id
+        JOIN decks d ON c.did = d.id
+        WHERE r.id > ? AND r.ease = ?
+        ORDER BY r.id
+    ''', (since_revlog_id, EASE_AGAIN))
+    try:
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            for revlog_id, deck_name, note_id, fields_str in rows:
+                yield FailedReview(revlog_id, deck_display_name(deck_name), note_id,
+                                   fields_str.split(FIELD_SEPARATOR))
+    finally:
+        cursor.close()
+
+
+class Watermark:
+    """
+    The last revlog id handed out for a collection, kept in a small JSON file next to it,
+    so that repeated runs only fetch the failures that happened since.
+    """
+
+    def __init__(self, db_path: str, path: Optional[str] = None):
+        self.path = path or db_path + WATERMARK_SUFFIX
+
+    def load(self) -> int:
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                return json.load(file).get("lastRevlogId", 0)
+        except (OSError, ValueError):
+            return 0
+
+    def store(self, revlog_id: int):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({"lastRevlogId": revlog_id}, file)
+        os.replace(temp_path, self.path)
+
+
+def failed_since_watermark(db_path: str,
+                           watermark: Optional[Watermark] = None) -> Tuple[List[FailedReview], Optional[int]]:
+    """
+    Today's failures not handed out since the watermark, and the revlog id to move the watermark to,
+    None if there are no failures. The watermark isn't moved here: the caller stores the id once the failures
+    are dealt with for good, e.g. saved, so that they are handed out again if that doesn't happen.
+    """
+    watermark = watermark or Watermark(db_path)
+    since = max(watermark.load(), today_start_millis())
+    connection = open_collection(db_path)
+    try:
+        reviews = list(iter_failed_reviews(connection, since))
+    finally:
+        connection.close()
+    return reviews, reviews[-1].revlog_id if reviews else None
+
+
+def group_by_deck(reviews) -> Dict[str, List[str]]:
+    """
+    The words of the reviews by deck name, in the order of the deck names, each word once per deck.
+    """
+    deck_map: Dict[str, List[str]] = {}
+    for review in reviews:
+        words = deck_map.setdefault(review.deck_name, [])
+        if review.word not in words:
+            words.append(review.word)
+    return dict(sorted(deck_map.items()))
+
+
+def field_text(field: str) -> str:
+    """
+    The text of a note field without its HTML.
+    """
+    return html.unescape(_TAGS.sub(" ", field)).strip()
+
+
+def focus_failed_words(learning, reviews) -> int:
+    """
+    Brings the words of the failed reviews into the learning's focused cards: an existing card with the same
+    word and translation (the first two fields) is focused, otherwise a new card is made and focused.
+    Returns the number of cards focused; the caller triggers the save.
+    """
+    existing = {card_key(card.word, card.translation): card.identifier for card in learning.word_cards_combined()}
+    new_reviews = []
+    focused = 0
+    for review in reviews:
+        word = field_text(review.word)
+        translation = field_text(review.fields[1]) if len(review.fields) > 1 else ""
+        if not word:
+            continue
+        key = card_key(word, translation)
+        identifier = existing.get(key)
+        if identifier is None:
+            new_reviews.append((key, word, translation, review.deck_name))
+            existing[key] = ""
+        elif identifier and not learning.is_focused(identifier):
+            learning.toggle_word_card_focus(identifier)
+            focused += 1
+
+    for identifier, (key, word, translation, deck_name) in zip(unique_ids_by_time(len(new_reviews)), new_reviews):
+        learning.add_word_card(WordCard(identifier, word, "", translation, "", deck=deck_name, tags=[ANKI_TAG]))
+        learning.toggle_word_card_focus(identifier)
+        focused += 1
+    return focused
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process Anki cards reviewed today with ease 1.')
+    parser.add_argument('db_path', help='Path to the Anki collection.anki2 database file')
+    parser.add_argument('--new-only', action='store_true',
+                        help='Only list the failures since the last run with this option')
+    args = parser.parse_args()
+
+    last_revlog_id = None
+    try:
+        if args.new_only:
+            reviews, last_revlog_id = failed_since_watermark(args.db_path)
+        else:
+            connection = open_collection(args.db_path)
+            try:
+                reviews = list(iter_failed_reviews(connection, today_start_millis()))
+            finally:
+                connection.close()
+    except sqlite3.Error as e:
+        print(f"Error reading the database: {e}")
+        sys.exit(1)
+
+    for deck_name, words in group_by_deck(reviews).items():
+        print(f"{deck_name}:")
+        word_line = ", ".join(f'"{word}"' for word in words)
+        print(f"  {word_line}")
+    if last_revlog_id is not None:
+        Watermark(args.db_path).store(last_revlog_id)
+
 
-parser = argparse.ArgumentParser(description='Process Anki cards reviewed today with ease 1.')
-parser.add_argument('db_path', help='Path to the Anki collection.anki2 database file')
-args = parser.parse_args()
-
-try:
-    conn = sqlite3.connect(args.db_path)
-    cursor = conn.cursor()
-except sqlite3.Error as e:
-    print(f"Error connecting to the database: {e}")
-    sys.exit(1)
-
-# Get today's date in seconds since the epoch
-today = datetime.date.today()
-today_start = int(datetime.datetime(today.year, today.month, today.day).timestamp())
-
-# Select cards reviewed today with ease 1 (Again), joining with decks and ordering by deck name
-cursor.execute('''
-    SELECT d.name, n.flds
-    FROM revlog r
-    JOIN cards c ON r.cid = c.id
-    JOIN notes n ON c.nid = n.id
-    JOIN decks d ON c.did = d.id
-    WHERE r.ease = 1 AND r.id > ?
-    ORDER BY d.name COLLATE BINARY
-''', (today_start * 1000,))
-
-results = cursor.fetchall()
-
-deck_map = {}
-
-for deck_name, fields_str in results:
-    fields = fields_str.split('\x1f')
-    first_field = fields[0] if fields else ""
-
-    if deck_name not in deck_map:
-        deck_map[deck_name] = []
-    deck_map[deck_name].append(first_field)
-
-# Now print from the map
-for deck_name, words in deck_map.items():
-    print(f"{deck_name}:")
-    word_line = ", ".join(f'"{word}"' for word in words)
-    print(f"  {word_line}")
-
-conn.close()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+import hashlib
+import html
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import zipfile
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from anki.again_today import FIELD_SEPARATOR, field_text
+from state.Archive import Archive
+from state.Dialog import Dialog
+from state.Learning import parse_node
+from state.Node import Node
+from state.Snapshot import LearningSnapshot
+from state.WordCard import WordCard
+
+# Notes inserted with one executemany
+BATCH_SIZE = 500
+
+SENTENCE_MODEL_ID = 1_700_000_000_001
+WORD_MODEL_ID = 1_700_000_000_002
+DIALOGS_DECK_ID = 1_700_000_000_101
+WORD_CARDS_DECK_ID = 1_700_000_000_102
+
+SENTENCE_FIELDS = ["Sentence", "Translation", "Audio", "Context"]
+WORD_FIELDS = ["Word", "Word Comment", "Translation", "Translation Comment"]
+
+# The cached MP3 of the utterance spoken by the voice, or None if it was never synthesized
+AudioLookup = Callable[[str, str], Optional[bytes]]
+
+# Collection schema 11, which every Anki version imports
+_SCHEMA = '''
+    CREATE TABLE col (id INTEGER PRIMARY KEY, crt INTEGER NOT NULL, mod INTEGER NOT NULL, scm INTEGER NOT NULL,
+        ver INTEGER NOT NULL, dty INTEGER NOT NULL, usn INTEGER NOT NULL, ls INTEGER NOT NULL, conf TEXT NOT NULL,
+        models TEXT NOT NULL, decks TEXT NOT NULL, dconf TEXT NOT NULL, tags TEXT NOT NULL);
+    CREATE TABLE notes (id INTEGER PRIMARY KEY, guid TEXT NOT NULL, mid INTEGER NOT NULL, mod INTEGER NOT NULL,
+        usn INTEGER NOT NULL, tags TEXT NOT NULL, flds TEXT NOT NULL, sfld INTEGER NOT NULL, csum INTEGER NOT NULL,
+        flags INTEGER NOT NULL, data TEXT NOT NULL);
+    CREATE TABLE cards (id INTEGER PRIMARY KEY, nid INTEGER NOT NULL, did INTEGER NOT NULL, ord INTEGER NOT NULL,
+        mod INTEGER NOT NULL, usn INTEGER NOT NULL, type INTEGER NOT NULL, queue INTEGER NOT NULL,
+        due INTEGER NOT NULL, ivl INTEGER NOT NULL, factor INTEGER NOT NULL, reps INTEGER NOT NULL,
+        lapses INTEGER NOT NULL, left INTEGER NOT NULL, odue INTEGER NOT NULL, odid INTEGER NOT NULL,
+        flags INTEGER NOT NULL, data TEXT NOT NULL);
+    CREATE TABLE revlog (id INTEGER PRIMARY KEY, cid INTEGER NOT NULL, usn INTEGER NOT NULL, ease INTEGER NOT NULL,
+        ivl INTEGER NOT NULL, lastIvl INTEGER NOT NULL, factor INTEGER NOT NULL, time INTEGER NOT NULL,
+        type INTEGER NOT NULL);
+    CREATE TABLE graves (usn INTEGER NOT NULL, oid INTEGER NOT NULL, type INTEGER NOT NULL);
+    CREATE INDEX ix_notes_usn ON notes (usn);
+    CREATE INDEX ix_cards_usn ON cards (usn);
+    CREATE INDEX ix_revlog_usn ON revlog (usn);
+    CREATE INDEX ix_cards_nid ON cards (nid);
+    CREATE INDEX ix_cards_sched ON cards (did, queue, due);
+    CREATE INDEX ix_revlog_cid ON revlog (cid);
+    CREATE INDEX ix_notes_csum ON notes (csum);
+'''
+
+_CSS = ".card { font-family: arial; font-size: 24px; text-align: center; }\n.context { font-size: 16px; color: grey; }"
+
+
+@dataclass
+class ExportResult:
+    sentences: int = 0
+    word_cards: int = 0
+    # MP3 files taken from the audio cache; sentences without cached audio go without
+    audio_files: int = 0
+
+
+def _model(model_id: int, name: str, fields: List[str], qfmt: str, afmt: str, deck_id: int, now: int) -> dict:
+    return {
+        "id": model_id, "name": name, "type": 0, "mod": now, "usn": -1, "sortf": 0, "did": deck_id,
+        "tmpls": [{"name": "Card 1", "ord": 0, "qfmt": qfmt, "afmt": afmt, "did": None, "bqfmt": "", "bafmt": ""}],
+        "flds": [{"name": name, "ord": i, "sticky": False, "rtl": False, "font": "Arial", "size": 20, "media": []}
+                 for i, name in enumerate(fields)],
+        "css": _CSS, "latexPre": "", "latexPost": "", "tags": [], "vers": [], "req": [[0, "any", [0]]],
+    }
+
+
+def _deck(deck_id: int, name: str, now: int) -> dict:
+    return {"id": deck_id, "name": name, "mod": now, "usn": -1, "lrnToday": [0, 0], "revToday": [0, 0],
+            "newToday": [0, 0], "timeToday": [0, 0], "collapsed": False, "desc": "", "dyn": 0, "conf": 1,
+            "extendNew": 10, "extendRev": 50}
+
+
+_DECK_OPTIONS = {
+    "1": {"id": 1, "name": "Default", "mod": 0, "usn": 0, "maxTaken": 60, "autoplay": True, "timer": 0,
+          "replayq": True, "dyn": False,
+          "new": {"delays": [1, 10], "ints": [1, 4, 7], "initialFactor": 2500, "order": 1, "perDay": 20,
+                  "bury": True, "separate": True},
+          "rev": {"perDay": 200, "ease4": 1.3, "fuzz": 0.05, "ivlFct": 1, "maxIvl": 36500, "bury": True,
+                  "minSpace": 1},
+          "lapse": {"delays": [10], "mult": 0, "minInt": 1, "leechFails": 8, "leechAction": 0}}
+}
+
+
+def _guid(kind: str, key: str) -> str:
+    """
+    Stable note guid, so that importing a later export updates the notes instead of duplicating them.
+    """
+    return hashlib.sha1(f"{kind}:{key}".encode('utf-8')).hexdigest()[:16]
+
+
+def _checksum(first_field: str) -> int:
+    return int(hashlib.sha1(field_text(first_field).encode('utf-8')).hexdigest()[:8], 16)
+
+
+def _html(text: str) -> str:
+    """
+    The text as a note field, which Anki shows as HTML.
+    """
+    return html.escape(text, quote=False)
+
+
+def audio_file_name(voice: str, utterance: str) -> str:
+    return "als-" + hashlib.sha1(f"{voice}#{utterance}".encode('utf-8')).hexdigest()[:20] + ".mp3"
+
+
+def iter_dialogs(node_snapshots: Iterable, archive: Optional[Archive] = None) -> Iterator[Dialog]:
+    """
+    The dialogs of the subtrees of the node snapshots. Each one is parsed on its own, reading unloaded
+    and archived ones from their files, so that exporting doesn't keep every dialog in memory.
+    """
+    for node_snapshot in node_snapshots:
+        node = parse_node(node_snapshot.to_json_object(), archive)
+        while not node.is_loaded():
+            node = node.load()
+        yield from _dialogs(node)
+
+
+def _dialogs(node: Node) -> Iterator[Dialog]:
+    if isinstance(node, Dialog):
+        yield node
+    for child in node.nodes:
+        yield from _dialogs(child)
+
+
+class ApkgWriter:
+    """
+    Writes an Anki package: a zip with a schema 11 collection.anki2, the media files named "0", "1", ...
+    and a "media" JSON mapping those names to the file names the notes refer to.
+
+    The collection is built in a temporary file with the notes and cards inserted in batches
+    within one transaction. MP3 files go into the zip as soon as they're added, and the collection
+    is copied in from disk at the end, so memory stays bounded however much is exported.
+    """
+
+    def __init__(self, path: str, batch_size: int = BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.now = int(time.time())
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._db_path = os.path.join(self._temp_dir.name, "collection.anki2")
+        self.connection = sqlite3.connect(self._db_path)
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.executescript(_SCHEMA)
+        self.zip_file = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self.media: dict = {}
+        self._media_names = set()
+        self._notes: List[tuple] = []
+        self._cards: List[tuple] = []
+        # Anki ids are millisecond timestamps; consecutive ones keep the notes in export order
+        self._next_id = self.now * 1000
+        self.result = ExportResult()
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def add_note(self, model_id: int, deck_id: int, guid: str, fields: List[str], tags: Iterable[str] = ()):
+        """
+        The fields are HTML, as Anki stores them; text goes through html.escape first, see add_dialog.
+        """
+        note_id = self._new_id()
+        flds = FIELD_SEPARATOR.join(field.replace(FIELD_SEPARATOR, " ") for field in fields)
+        tags_str = " " + " ".join(tag.replace(" ", "_") for tag in tags) + " " if tags else ""
+        self._notes.append((note_id, guid, model_id, self.now, -1, tags_str, flds, field_text(fields[0]),
+                            _checksum(fields[0]), 0, ""))
+        # A new card, due in the order of the notes
+        self._cards.append((self._new_id(), note_id, deck_id, 0, self.now, -1, 0, 0, len(self._cards) + 1,
+                            0, 0, 0, 0, 0, 0, 0, 0, ""))
+        if len(self._notes) >= self.batch_size:
+            self._flush()
+
+    def add_audio(self, file_name: str, data: bytes):
+        if file_name in self._media_names:
+            return
+        number = str(len(self.media))
+        # MP3 is compressed already
+        self.zip_file.writestr(number, data, compress_type=zipfile.ZIP_STORED)
+        self.media[number] = file_name
+        self._media_names.add(file_name)
+        self.result.audio_files += 1
+
+    def add_dialog(self, dialog: Dialog, audio_lookup: Optional[AudioLookup] = None):
+        for position, sentence in enumerate(dialog.content):
+            audio = ""
+            interlocutor = dialog.get_interlocutor(sentence.who)
+            if audio_lookup and interlocutor:
+                data = audio_lookup(interlocutor.voice, sentence.sentence)
+                if data:
+                    file_name = audio_file_name(interlocutor.voice, sentence.sentence)
+                    self.add_audio(file_name, data)
+                    audio = f"[sound:{file_name}]"
+            self.add_note(SENTENCE_MODEL_ID, DIALOGS_DECK_ID, _guid("sentence", f"{dialog.node_id}:{position}"),
+                          [_html(sentence.sentence), _html(sentence.translation), audio, _html(dialog.context or "")])
+            self.result.sentences += 1
+
+    def add_word_card(self, word_card: WordCard):
+        self.add_note(WORD_MODEL_ID, WORD_CARDS_DECK_ID, _guid("word", word_card.identifier),
+                      [_html(text) for text in word_card.texts()], word_card.tags)
+        self.result.word_cards += 1
+
+    def _flush(self):
+        self.connection.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._notes)
+        self.connection.executemany("INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    self._cards)
+        self._notes = []
+        self._cards = []
+
+    def _write_col(self, dialogs_deck_name: str, word_cards_deck_name: str):
+        models = {
+            str(SENTENCE_MODEL_ID): _model(
+                SENTENCE_MODEL_ID, "AI Language Studio Sentence", SENTENCE_FIELDS,
+                "{{Sentence}}<br>{{Audio}}",
+                "{{FrontSide}}<hr id=answer>{{Translation}}<div class=context>{{Context}}</div>", DIALOGS_DECK_ID,
+                self.now),
+            str(WORD_MODEL_ID): _model(
+                WORD_MODEL_ID, "AI Language Studio Word", WORD_FIELDS,
+                "{{Word}}<div class=context>{{Word Comment}}</div>",
+                "{{FrontSide}}<hr id=answer>{{Translation}}<div class=context>{{Translation Comment}}</div>",
+                WORD_CARDS_DECK_ID, self.now),
+        }
+        decks = {
+            "1": _deck(1, "Default", self.now),
+            str(DIALOGS_DECK_ID): _deck(DIALOGS_DECK_ID, dialogs_deck_name, self.now),
+            str(WORD_CARDS_DECK_ID): _deck(WORD_CARDS_DECK_ID, word_cards_deck_name, self.now),
+        }
+        conf = {"nextPos": 1, "estTimes": True, "activeDecks": [1], "sortType": "noteFld", "timeLim": 0,
+                "sortBackwards": False, "addToCur": True, "curDeck": 1, "newBury": True, "newSpread": 0,
+                "dueCounts": True, "curModel": str(SENTENCE_MODEL_ID), "collapseTime": 1200}
+        self.connection.execute(
+            "INSERT INTO col VALUES (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, '{}')",
+            (self.now, self.now * 1000, self.now * 1000, json.dumps(conf), json.dumps(models), json.dumps(decks),
+             json.dumps(_DECK_OPTIONS)))
+
+    def close(self, dialogs_deck_name: str, word_cards_deck_name: str):
+        try:
+            self._flush()
+            self._write_col(dialogs_deck_name, word_cards_deck_name)
+            self.connection.commit()
+            self.connection.close()
+            self.zip_file.write(self._db_path, "collection.anki2")
+            self.zip_file.writestr("media", json.dumps(self.media))
+            self.zip_file.close()
+        finally:
+            self._temp_dir.cleanup()
+
+    def abort(self):
+        self.connection.close()
+        self.zip_file.close()
+        self._temp_dir.cleanup()
+        os.remove(self.path)
+
+
+def export_apkg(snapshot: LearningSnapshot, path: str, audio_lookup: Optional[AudioLookup] = None,
+                archive: Optional[Archive] = None, include_dialogs=True, include_word_cards=True) -> ExportResult:
+    """
+    Exports the sentences of the dialogs and the word cards of the learning's snapshot into an Anki package
+    at path. Working from a snapshot, taken with Learning.snapshot, lets the export run off the GUI thread;
+    archived dialogs are read from the learning's archive. Audio is only taken from audio_lookup,
+    never synthesized for the export.
+    """
+    writer = ApkgWriter(path)
+    try:
+        if include_dialogs:
+            for dialog in iter_dialogs(snapshot.root.children, archive):
+                writer.add_dialog(dialog, audio_lookup)
+        if include_word_cards:
+            for word_cards in (snapshot.word_cards_focused, snapshot.word_cards_main):
+                for row in word_cards.rows:
+                    writer.add_word_card(WordCard.from_list(row))
+    except BaseException:
+        writer.abort()
+        raise
+    name = f"AI Language Studio::{snapshot.language}"
+    writer.close(name + "::Dialogs", name + "::Word Cards")
+    return writer.result
+
+
+def do_main():
+    from state.Dialog import CreateDialogSettings
+    from state.Learning import Learning
+    from state.RootNode import RootNode
+
+    learning = Learning("tr", "en", RootNode(), [], [WordCard(f"id{i}", f"kelime{i}", "", f"word{i}", "")
+                                                    for i in range(10_000)], CreateDialogSettings())
+    for i in range(2000):
+        learning.root_node.add_child(Dialog.from_data({
+            "interlocutors": [["main", "Ali", "male", "tr-TR-AhmetNeural"], ["other", "Elif", "female", "tr-TR-EmelNeural"]],
+            "currentPosition": 0,
+            "content": [["Ali" if j % 2 else "Elif", f"Cümle {i} {j}", f"Sentence {i} {j}"] for j in range(10)],
+            "context": f"Context {i}",
+        }))
+    audio = bytes(30_000)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export.apkg")
+        start = time.perf_counter()
+        result = export_apkg(learning.snapshot(), path, lambda voice, utterance: audio if utterance.endswith(" 0") else None)
+        print(f"Export: {time.perf_counter() - start:.2f} s, {result}, {os.path.getsize(path) / 1e6:.1f} MB")
+        with zipfile.ZipFile(path) as zip_file:
+            zip_file.extract("collection.anki2", directory)
+            media = json.loads(zip_file.read("media"))
+        connection = sqlite3.connect(os.path.join(directory, "collection.anki2"))
+        print(connection.execute("SELECT COUNT(*) FROM notes").fetchone(),
+              connection.execute("SELECT COUNT(*) FROM cards").fetchone(), len(media))
+        connection.close()
+
+
+if __name__ == '__main__':
+    do_main()
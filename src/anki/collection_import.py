@@ -0,0 +1,272 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from anki.again_today import ANKI_TAG, FIELD_SEPARATOR, deck_display_name, field_text, open_collection
+from state.WordCard import WordCard
+from state.WordCardImporter import card_key
+from utils.time_utils import unique_ids_by_time
+
+# Notes fetched from the cursor at a time
+BATCH_SIZE = 1000
+# Sidecar of the collection with the import state, see ImportState
+IMPORT_STATE_SUFFIX = ".import.json"
+
+# Word card fields and their keys in the note type mappings
+MAPPED_FIELDS = ("word", "wordComment", "translation", "translationComment")
+
+
+@dataclass
+class AnkiImportResult:
+    added: int = 0
+    updated: int = 0
+    # Notes matching a card that was there before the first import, which are linked to it
+    linked: int = 0
+    # Notes without a word or a translation
+    skipped: int = 0
+
+
+@dataclass
+class ImportState:
+    """
+    What the earlier imports of a collection left behind, kept in a JSON file next to it:
+    the greatest note modification time and update sequence number seen, the card made from each note,
+    and for each note type the names of the fields that go into the card, which can be edited to change
+    the mapping. Deleting the file makes the next import read the whole collection again.
+    """
+    path: str
+    last_mod: int = 0
+    last_usn: int = -2
+    card_ids: Dict[str, str] = field(default_factory=dict)
+    note_types: Dict[str, Dict[str, Optional[str]]] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: str) -> "ImportState":
+        try:
+            with open(path, encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return cls(path)
+        return cls(path, data.get("lastMod", 0), data.get("lastUsn", -2), data.get("cardIds", {}),
+                   data.get("noteTypes", {}))
+
+    def store(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({"lastMod": self.last_mod, "lastUsn": self.last_usn, "noteTypes": self.note_types, "cardIds": self.card_ids},
+                      file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def mapping(self, note_type_name: str, field_names: List[str]) -> Dict[str, Optional[str]]:
+        """
+        The mapping of the note type, by default the first field to the word and the second to the translation.
+        """
+        mapping = self.note_types.get(note_type_name)
+        if mapping is None:
+            mapping = {"word": field_names[0] if field_names else None,
+                       "wordComment": None,
+                       "translation": field_names[1] if len(field_names) > 1 else None,
+                       "translationComment": None}
+            self.note_types[note_type_name] = mapping
+        return mapping
+
+
+def read_note_types(connection: sqlite3.Connection) -> Dict[int, Tuple[str, List[str]]]:
+    """
+    The name and the field names of each note type by id, from the notetypes and fields tables of current
+    collections or from the models JSON of the col table of older ones.
+    """
+    tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if "notetypes" in tables:
+        result = {note_type_id: (name, []) for note_type_id, name in connection.execute("SELECT id, name FROM notetypes")}
+        for note_type_id, name in connection.execute("SELECT ntid, name FROM fields ORDER BY ntid, ord"):
+            if note_type_id in result:
+                result[note_type_id][1].append(name)
+        return result
+    models = json.loads(connection.execute("SELECT models FROM col").fetchone()[0])
+    return {int(model_id): (model["name"], [f["name"] for f in sorted(model["flds"], key=lambda f: f["ord"])])
+            for model_id, model in models.items()}
+
+
+def read_deck_names(connection: sqlite3.Connection) -> Dict[int, str]:
+    tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if "decks" in tables:
+        return {deck_id: deck_display_name(name) for deck_id, name in connection.execute("SELECT id, name FROM decks")}
+    decks = json.loads(connection.execute("SELECT decks FROM col").fetchone()[0])
+    return {int(deck_id): deck["name"] for deck_id, deck in decks.items()}
+
+
+@dataclass
+class AnkiImport:
+    """
+    What read_collection found, for apply_import: the cards to edit, under the identifiers of the cards
+    made from the notes earlier, and the cards to add.
+    """
+    state: ImportState
+    result: AnkiImportResult
+    edited_cards: List[WordCard] = field(default_factory=list)
+    new_cards: List[WordCard] = field(default_factory=list)
+
+
+def read_collection(existing_cards: Iterable[WordCard], db_path: str, state_path: Optional[str] = None,
+                    batch_size: int = BATCH_SIZE) -> AnkiImport:
+    """
+    Reads the notes of the collection changed since the last import, as new cards or as edits of the cards
+    made from them by an earlier import.
+
+    Anki sets a note's usn to -1 when it's edited and to the collection's next update sequence number when
+    it's synced, and keeps an index on it, so the notes with usn -1 or above the greatest one seen are found
+    without a scan. For the unsynced ones, their modification time in seconds, mod, filters out those already
+    imported; a newly synced note is read whatever its mod, since a sync can bring in an edit made on another
+    device before the last import. The notes are streamed from the cursor a batch at a time, so re-importing
+    a large collection reads just the changes. Deleted notes leave their cards alone.
+
+    Doesn't touch the learning, so it can run off the GUI thread given a copy of the list of the cards.
+    Raises OSError or sqlite3.Error if the collection can't be read.
+    """
+    state = ImportState.load(state_path or db_path + IMPORT_STATE_SUFFIX)
+    anki_import = AnkiImport(state, AnkiImportResult())
+    result = anki_import.result
+    # Both built only when needed, which a re-import with few changes mostly doesn't
+    cards_by_id: Optional[Dict[str, WordCard]] = None
+    existing: Optional[Dict[int, str]] = None
+    new_cards: List[Tuple[str, Tuple[str, str, str, str], str, Tuple[str, ...]]] = []
+    last_mod = state.last_mod
+    last_usn = state.last_usn
+
+    connection = open_collection(db_path)
+    try:
+        note_types = read_note_types(connection)
+        deck_names = read_deck_names(connection)
+        # Unsynced edits made in the second of the last import have its mod, so that second is read again
+        cursor = connection.execute('''
+            SELECT n.id, n.mid, n.mod, n.usn, n.flds, n.tags,
+                   (SELECT c.did FROM cards c WHERE c.nid = n.id ORDER BY c.ord LIMIT 1)
+            FROM notes n
+            WHERE n.usn > ? OR (n.usn = -1 AND n.mod >= ?)
+        ''', (state.last_usn, state.last_mod))
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for note_id, note_type_id, mod, usn, fields_str, tags_str, deck_id in rows:
+                    last_mod = max(last_mod, mod)
+                    last_usn = max(last_usn, usn)
+                    note_type_name, field_names = note_types.get(note_type_id, ("", []))
+                    mapping = state.mapping(note_type_name, field_names)
+                    values = dict(zip(field_names, fields_str.split(FIELD_SEPARATOR)))
+                    texts = tuple(field_text(values.get(mapping.get(name) or "", "")) for name in MAPPED_FIELDS)
+                    if not texts[0] or not texts[2]:
+                        result.skipped += 1
+                        continue
+                    deck = deck_names.get(deck_id, "")
+                    tags = tuple(tags_str.split()) + (ANKI_TAG,)
+
+                    card_id = state.card_ids.get(str(note_id))
+                    if card_id and cards_by_id is None:
+                        cards_by_id = {card.identifier: card for card in existing_cards}
+                    word_card = cards_by_id.get(card_id) if card_id else None
+                    if word_card:
+                        if (word_card.texts(), word_card.deck, word_card.tags) != (texts, deck, tags):
+                            anki_import.edited_cards.append(WordCard(card_id, *texts, deck=deck, tags=tags))
+                            result.updated += 1
+                        continue
+
+                    if existing is None:
+                        existing = {card_key(card.word, card.translation): card.identifier for card in existing_cards}
+                    key = card_key(texts[0], texts[2])
+                    if key in existing:
+                        state.card_ids[str(note_id)] = existing[key]
+                        result.linked += 1
+                        continue
+                    existing[key] = ""
+                    new_cards.append((str(note_id), texts, deck, tags))
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+
+    for identifier, (note_id, texts, deck, tags) in zip(unique_ids_by_time(len(new_cards)), new_cards):
+        anki_import.new_cards.append(WordCard(identifier, *texts, deck=deck, tags=tags))
+        state.card_ids[note_id] = identifier
+    result.added = len(new_cards)
+    state.last_mod = last_mod
+    state.last_usn = last_usn
+    return anki_import
+
+
+def apply_import(learning, anki_import: AnkiImport) -> AnkiImportResult:
+    """
+    Applies what read_collection found to the learning, with the new cards added in one
+    Learning.add_word_cards, and then stores the import state. Edits of cards deleted in the meantime
+    are dropped. The caller triggers the save. Raises OSError if the import state can't be stored.
+    """
+    result = anki_import.result
+    for word_card in anki_import.edited_cards:
+        if learning.get_word(word_card.identifier):
+            learning.edit_word_card(word_card)
+        else:
+            result.updated -= 1
+    learning.add_word_cards(anki_import.new_cards)
+    anki_import.state.store()
+    return result
+
+
+def import_collection(learning, db_path: str, state_path: Optional[str] = None,
+                      batch_size: int = BATCH_SIZE) -> AnkiImportResult:
+    """
+    Imports the notes of the collection as word cards, or updates the cards made from them by an earlier import,
+    see read_collection. The caller triggers the save.
+    """
+    return apply_import(learning, read_collection(learning.word_cards_combined(), db_path, state_path, batch_size))
+
+
+def do_main():
+    from state.Dialog import CreateDialogSettings
+    from state.Learning import Learning
+    from state.RootNode import RootNode
+
+    n = 50_000
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "collection.anki2")
+        connection = sqlite3.connect(db_path)
+        connection.executescript('''
+            CREATE TABLE notetypes (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE fields (ntid INTEGER, ord INTEGER, name TEXT, PRIMARY KEY (ntid, ord));
+            CREATE TABLE decks (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE notes (id INTEGER PRIMARY KEY, mid INTEGER, mod INTEGER, usn INTEGER, tags TEXT, flds TEXT);
+            CREATE TABLE cards (id INTEGER PRIMARY KEY, nid INTEGER, did INTEGER, ord INTEGER);
+            CREATE INDEX ix_cards_nid ON cards (nid);
+            CREATE INDEX ix_notes_usn ON notes (usn);
+        ''')
+        connection.execute("INSERT INTO notetypes VALUES (1, 'Basic')")
+        connection.executemany("INSERT INTO fields VALUES (1, ?, ?)", [(0, "Front"), (1, "Back")])
+        connection.execute("INSERT INTO decks VALUES (1, 'Turkish\x1fA1')")
+        base_mod = int(time.time()) - 1000
+        connection.executemany("INSERT INTO notes VALUES (?, 1, ?, 0, ' travel ', ?)",
+                               [(i, base_mod, f"word{i}\x1f<b>translation{i}</b>") for i in range(n)])
+        connection.executemany("INSERT INTO cards VALUES (?, ?, 1, 0)", [(i, i) for i in range(n)])
+        connection.commit()
+
+        learning = Learning("tr", "en", RootNode(), [], [], CreateDialogSettings())
+        start = time.perf_counter()
+        result = import_collection(learning, db_path)
+        print(f"First import of {n} notes: {time.perf_counter() - start:.2f} s, {result}")
+
+        connection.executemany("UPDATE notes SET mod = ?, usn = -1, flds = ? WHERE id = ?",
+                               [(base_mod + 500, f"word{i}\x1fnew translation{i}", i) for i in range(0, n, 500)])
+        connection.commit()
+        connection.close()
+        start = time.perf_counter()
+        result = import_collection(learning, db_path)
+        print(f"Re-import after editing {n // 500} notes: {time.perf_counter() - start:.3f} s, {result}")
+        print(learning.get_word(learning.word_cards_main[0].identifier))
+
+
+if __name__ == '__main__':
+    do_main()
@@ -1,4 +1,5 @@
 import json
+import os
 import random
 
 from ontology.Gender import Gender
@@ -13,7 +14,8 @@ class Locale:
             male_voices: list[str],
             female_voices: list[str],
             special_note: str,
-            heavy_generation: bool
+            heavy_generation: bool,
+            code: str = ""
     ):
         self.locale_name = locale_name
         self.male_names = male_names
@@ -22,6 +24,8 @@ class Locale:
         self.female_voices = female_voices
         self.special_note = special_note
         self.heavy_generation = heavy_generation
+        # The name of the locale's file in data, e.g. "tr"
+        self.code = code
 
     def pick_random_name(self, gender, exclusions=None):
         if exclusions is None:
@@ -31,7 +35,7 @@ class Locale:
         return random.choice(available_names)
 
     @staticmethod
-    def parse_from_json_string(json_string):
+    def parse_from_json_string(json_string, code=""):
         data = json.loads(json_string)
         locale_name = data['name']
         male_names = data['names']['male']
@@ -47,13 +51,14 @@ class Locale:
             male_voices,
             female_voices,
             special_note,
-            heavy_generation
+            heavy_generation,
+            code
         )
 
     @staticmethod
     def parse_from_file_name(file_name):
         with open(file_name, 'r', encoding='utf=8') as file:
-            return Locale.parse_from_json_string(file.read())
+            return Locale.parse_from_json_string(file.read(), os.path.splitext(os.path.basename(file_name))[0])
 
     def assign_voices_for_gender(self, names, gender: Gender):
         result = {}
@@ -0,0 +1,121 @@
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from ontology.stream_parsers import DialogStreamParser, Utterance, parse_utterance
+
+# Utterances translated by one request; the first batch goes out as soon as it's complete
+BATCH_UTTERANCES = 4
+# Translation requests in flight at once
+MAX_WORKERS = 3
+
+# Translates the batch given the context and the utterances before it, returning one translation per utterance
+TranslateBatch = Callable[[str, List[Utterance], List[Utterance]], List[str]]
+
+
+class PipelinedTranslation:
+    """
+    Translates the utterances of a dialog while it's still being generated: on_text is given the generated
+    text chunk by chunk, and every BATCH_UTTERANCES complete utterances go to translate_batch on a worker
+    thread, so when the generation ends only the last batch is left to wait for. The total time then
+    approaches the longer of generating and translating instead of their sum.
+
+    A line that isn't an utterance of one of the names, or a batch that fails or comes back with the wrong
+    number of translations, makes finish return None, and the caller falls back to translating it all at once.
+    """
+
+    def __init__(self, translate_batch: TranslateBatch, names: Sequence[str], batch_utterances: int = BATCH_UTTERANCES,
+                 max_workers: int = MAX_WORKERS):
+        self.translate_batch = translate_batch
+        self.names = list(names)
+        self.batch_utterances = batch_utterances
+        self.parser = DialogStreamParser()
+        self.utterances: List[Utterance] = []
+        self.failed = False
+        self._sent = 0
+        self._batches: List[Tuple[List[Utterance], Future]] = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def on_text(self, text: str):
+        self._add(self.parser.feed(text))
+        if len(self.utterances) - self._sent >= self.batch_utterances:
+            self._submit()
+
+    def _add(self, lines: List[str]):
+        if self.failed:
+            return
+        for line in lines:
+            utterance = parse_utterance(line, self.names)
+            if utterance is None:
+                print(f"Not an utterance, translating the dialog at once: {line}")
+                self.failed = True
+                return
+            self.utterances.append(utterance)
+
+    def _submit(self):
+        if self.failed or self._sent == len(self.utterances):
+            return
+        previous = self.utterances[:self._sent]
+        batch = self.utterances[self._sent:]
+        self._sent = len(self.utterances)
+        self._batches.append((batch, self._executor.submit(self.translate_batch, self.parser.context, previous, batch)))
+
+    def finish(self, progress_callback: Callable[[int], None] = lambda count: None) -> Optional[list]:
+        """
+        The aligned [who, utterance, translation] list, in the order of the dialog, or None.
+        progress_callback gets the number of utterances translated so far.
+        """
+        try:
+            self._add(self.parser.finish())
+            self._submit()
+            if self.failed or not self.utterances:
+                return None
+            content = []
+            for batch, future in self._batches:
+                try:
+                    translations = future.result()
+                except Exception:
+                    logging.exception("Error translating a batch of utterances")
+                    return None
+                if not isinstance(translations, list) or len(translations) != len(batch):
+                    print(f"Expected {len(batch)} translations, got: {translations}")
+                    return None
+                content.extend([who, utterance, str(translation)]
+                               for (who, utterance), translation in zip(batch, translations))
+                progress_callback(len(content))
+            return content
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def do_main():
+    names = ["Ali", "Elif"]
+    lines = [f"{names[i % 2]}: Cümle {i}." for i in range(12)]
+    completion = "# Context\nAt a café.\n# Dialog\n" + "\n".join(lines)
+    line_seconds = 0.1
+
+    def translate_batch(context, previous, batch):
+        # Fixed latency plus output time
+        time.sleep(0.3 + 0.05 * len(batch))
+        return [f"Sentence {utterance.split()[1]}" for _, utterance in batch]
+
+    def generate(text_callback):
+        for line in completion.split("\n"):
+            time.sleep(line_seconds)
+            text_callback(line + "\n")
+
+    start = time.perf_counter()
+    generate(lambda text: None)
+    translate_batch("", [], [tuple(line.split(": ")) for line in lines])
+    print(f"Sequential: {time.perf_counter() - start:.2f} s")
+
+    start = time.perf_counter()
+    pipeline = PipelinedTranslation(translate_batch, names)
+    generate(pipeline.on_text)
+    content = pipeline.finish()
+    print(f"Pipelined: {time.perf_counter() - start:.2f} s, {len(content)} utterances, {content[-1]}")
+
+
+if __name__ == '__main__':
+    do_main()
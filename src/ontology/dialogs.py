@@ -19,10 +19,12 @@ class InterlocutorDefinition:
 
 
 class DialogPreliminary:
-    def __init__(self, prompt_start: str, prompt_end: str, interlocutors: list[list]):
+    def __init__(self, prompt_start: str, prompt_end: str, interlocutors: list[list], structured_prompt_end: str = ""):
         self.prompt = prompt_start
         self.prompt_end = prompt_end
         self.interlocutors = interlocutors
+        # Ends the prompt instead of prompt_end when the output format is set by a JSON schema
+        self.structured_prompt_end = structured_prompt_end
 
 
 class Dialogs:
@@ -89,6 +91,9 @@ class Dialogs:
                       f'{other_name}:\n'
                       f'...\n\n'
                       f'Only write direct speech without any remarks!')
+        structured_prompt_end = (f'Write the context in {second_locale.locale_name} and the dialogue in {locale.locale_name}, '
+                                 f'translating each utterance to {second_locale.locale_name}. '
+                                 f'Only write direct speech without any remarks!')
 
         if locale.special_note:
             prompt_start = prompt_start + ". " + locale.special_note
@@ -106,7 +111,8 @@ class Dialogs:
             [
                 [main_type, main_name, main_gender.to_char(), assigned_voice_map[main_name]],
                 [other_type, other_name, other_gender.to_char(), assigned_voice_map[other_name]],
-            ])
+            ],
+            structured_prompt_end)
 
     def random_interlocutor(self) -> InterlocutorDefinition:
         selected_key = random.choice(self.weighted_keys)
@@ -0,0 +1,316 @@
+import re
+import time
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Tuple
+
+from state.WordCard import WordCard
+
+# Bases shorter than this are kept whole, so that e.g. Turkish "ev" isn't cut down to "e"
+MIN_BASE_LENGTH = 2
+
+# A text word starting with a base of at least this length counts as a form of it whatever follows,
+# which catches suffixes missing from the lists below
+MIN_OPEN_MATCH_LENGTH = 5
+
+# Dictionary form endings stripped from the card word once, e.g. Turkish gitmek - git, Russian книга - книг
+LEMMA_ENDINGS: Dict[str, List[str]] = {
+    "tr": ["mak", "mek"],
+    "hu": ["ni"],
+    "it": ["are", "ere", "ire", "o", "a", "e", "i"],
+    "ru": ["ать", "ять", "еть", "ить", "ть", "ий", "ый", "ой", "а", "я", "о", "е", "ь", "й"],
+    "sr": ["ati", "iti", "eti", "a", "o", "e"],
+    "en": ["e"],
+}
+LEMMA_ENDINGS["bs"] = LEMMA_ENDINGS["sr"]
+
+# Turkish card words ending like an infinitive that are mostly nouns, kept whole rather than cut down to
+# a verb stem, e.g. yemek "food" isn't taken for ye-mek "to eat", which would match yemedim
+NOUN_LIKE_INFINITIVES: Dict[str, FrozenSet[str]] = {
+    "tr": frozenset(["yemek", "ekmek", "parmak", "ırmak", "kaymak", "çakmak"]),
+}
+
+# Turkish suffixes by slot, in the order they follow each other, e.g. ev-ler-imiz-de, gel-emi-yor-du-m.
+# A suffix is written with archiphonemes resolved by vowel harmony and the letter before it:
+# A is a or e and I is ı, i, u or ü after the last vowel, D is d or t and C is c or ç after a voiced or
+# a voiceless consonant, and a letter in parentheses is only there after a vowel, or a vowel only after
+# a consonant. A suffix ending in k before a vowel is spelled with ğ, e.g. gideceğim.
+TURKISH_SUFFIX_SLOTS: List[Tuple[str, ...]] = [
+    # Ability and negation of verbs
+    ("(y)Abil",),
+    ("mA", "mAz", "(y)AmA", "(y)AmAz"),
+    # Tense and mood, verbal nouns and participles; the vowel of a negation before (I)yor becomes I, e.g. gel-miyor
+    ("(I)yor", "mIyor", "(y)AmIyor", "(y)AcAk", "mIş", "DI", "(A)r", "(I)r", "mAlI", "(y)sA", "mAk", "mA", "(y)Ip", "(y)An", "DIk",
+     "(y)ArAk", "(y)IncA"),
+    # Plural
+    ("lAr",),
+    # Possessive
+    ("(I)m", "(I)n", "(s)I", "(I)mIz", "(I)nIz", "lArI"),
+    # Case; the ones with n follow the third person possessive, e.g. ev-i-nde
+    ("(y)I", "(y)A", "DA", "DAn", "(n)In", "(y)lA", "nI", "nA", "nDA", "nDAn", "CA"),
+    # Relative, e.g. ev-de-ki
+    ("ki",),
+    # Tense of the copula
+    ("(y)DI", "(y)mIş", "(y)sA"),
+    # Person; the single letters follow a vowel, e.g. aldı-m, gelse-k
+    ("(y)Im", "sIn", "(y)Iz", "sInIz", "lAr", "m", "n", "k", "nIz", "(y)AlIm", "DIr"),
+]
+
+# Inflectional suffixes of the other locales; a text word matches a base when the rest of it is a chain of these.
+# Agglutinative languages stack them, e.g. Hungarian ház-ak-ban.
+SUFFIXES: Dict[str, List[str]] = {
+    "hu": [
+        "ban", "ben", "ba", "be", "ból", "ből", "ra", "re", "ról", "ről", "on", "en", "ön", "n", "nak", "nek",
+        "val", "vel", "hoz", "hez", "höz", "nál", "nél", "tól", "től", "ig", "ért", "ként", "ul", "ül",
+        "ok", "ek", "ök", "ak", "k", "at", "et", "öt", "ot", "t", "ja", "je", "a", "e", "i", "ai", "ei", "jai", "jei",
+        "om", "em", "öm", "am", "m", "od", "ed", "öd", "ad", "d", "unk", "ünk", "tok", "tek", "tök", "juk", "jük",
+        "uk", "ük", "ják", "ni", "tam", "tem", "tál", "tél", "ta", "te", "tt", "ott", "ett", "ött", "tunk", "tünk",
+        "nék", "na", "ne", "l", "sz", "asz", "esz", "hat", "het", "ás", "és", "ó", "ő",
+    ],
+    "it": ["o", "i", "a", "e", "are", "ere", "ire", "iamo", "ate", "ete", "ite", "ano", "ono", "ando", "endo",
+           "ato", "ata", "ati", "uto", "uta", "uti", "ute", "ito", "ita", "iti", "erò", "irò", "errò",
+           "ava", "eva", "iva", "avo", "evo", "ivo", "à", "issimo", "issima", "mente"],
+    "ru": ["а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й", "ой", "ей", "ом", "ем", "ам", "ям", "ами", "ями",
+           "ах", "ях", "ов", "ев", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю", "ого", "его",
+           "ому", "ему", "ым", "им", "ых", "их", "ть", "ешь", "ет", "ете", "ут", "ют", "ишь", "ит",
+           "ите", "ат", "ят", "л", "ла", "ло", "ли", "ся", "сь"],
+    "sr": ["a", "e", "i", "o", "u", "om", "em", "ama", "ima", "og", "eg", "oj", "ih", "im", "ati", "iti",
+           "eti", "am", "aš", "amo", "ate", "aju", "iš", "imo", "ite", "eš", "emo", "ete", "la", "lo", "li", "le"],
+    "en": ["s", "es", "ed", "d", "ing", "er", "est", "ly"],
+}
+SUFFIXES["bs"] = SUFFIXES["sr"]
+
+# Letters at the end of a base that are spelled differently when a suffix follows,
+# e.g. Turkish kitap - kitabı, renk - rengi, git - gidiyor, Hungarian alma - almát
+ALTERNATIONS: Dict[str, Dict[str, Tuple[str, ...]]] = {
+    "tr": {"p": ("b",), "ç": ("c",), "t": ("d",), "k": ("ğ", "g")},
+    "hu": {"a": ("á",), "e": ("é",)},
+}
+
+# Locales written without spaces between words, where the words are looked up as substrings
+UNSEGMENTED = {"cn"}
+
+_WORDS = re.compile(r"\w+")
+_PARENTHESES = re.compile(r"\([^)]*\)|\[[^]]*]")
+
+
+def lower(code: str, text: str) -> str:
+    if code == "tr":
+        text = text.replace("I", "ı").replace("İ", "i")
+    return text.lower()
+
+
+@lru_cache(maxsize=100_000)
+def bases(code: str, word: str) -> FrozenSet[str]:
+    """
+    The spellings the lower-case word takes in front of a suffix: the word without its dictionary form ending,
+    as long as MIN_BASE_LENGTH letters remain, and the spellings with the last letter alternated.
+    """
+    word = lower(code, word)
+    endings = () if word in NOUN_LIKE_INFINITIVES.get(code, ()) else LEMMA_ENDINGS.get(code, ())
+    for ending in sorted(endings, key=len, reverse=True):
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_BASE_LENGTH:
+            word = word[:-len(ending)]
+            break
+    result = {word}
+    for alternative in ALTERNATIONS.get(code, {}).get(word[-1:], ()):
+        result.add(word[:-1] + alternative)
+    return frozenset(result)
+
+
+@lru_cache(maxsize=None)
+def _suffixes(code: str) -> FrozenSet[str]:
+    return frozenset(SUFFIXES.get(code, ()))
+
+
+@lru_cache(maxsize=100_000)
+def is_suffix_chain(code: str, rest: str, base: str = "") -> bool:
+    """
+    Whether the rest of a word after the base is empty or splits into the locale's suffixes,
+    in Turkish in the order of TURKISH_SUFFIX_SLOTS and in harmony with the base.
+    """
+    if not rest:
+        return True
+    if code == "tr":
+        return _is_turkish_chain(rest, 0, _last_vowel(base), base[-1:] or "e")
+    suffixes = _suffixes(code)
+    return any(rest[:length] in suffixes and is_suffix_chain(code, rest[length:])
+               for length in range(1, len(rest) + 1))
+
+
+_TURKISH_VOWELS = "aeıioöuü"
+_TURKISH_BACK_VOWELS = "aıou"
+_TURKISH_VOICELESS = "çfhkpsşt"
+# The vowel I stands for after each vowel
+_TURKISH_HIGH_VOWELS = {"a": "ı", "ı": "ı", "o": "u", "u": "u", "e": "i", "i": "i", "ö": "ü", "ü": "ü"}
+# The slot after the one of (I)yor
+_AFTER_PROGRESSIVE_SLOT = 3
+
+
+def _last_vowel(word: str) -> str:
+    vowels = [letter for letter in word if letter in _TURKISH_VOWELS]
+    return vowels[-1] if vowels else "e"
+
+
+def _turkish_spelling(suffix: str, last_vowel: str, last_letter: str) -> str:
+    """
+    The suffix of TURKISH_SUFFIX_SLOTS spelled after a word ending in last_letter whose last vowel is last_vowel.
+    """
+    after_vowel = last_letter in _TURKISH_VOWELS
+    result = []
+    i = 0
+    while i < len(suffix):
+        letter = suffix[i]
+        if letter == "(":
+            # The letter in parentheses, then the closing one skipped with it
+            letter = suffix[i + 1]
+            i += 2
+            if (letter in "AI") == after_vowel:
+                i += 1
+                continue
+        if letter == "A":
+            letter = "a" if last_vowel in _TURKISH_BACK_VOWELS else "e"
+        elif letter == "I":
+            letter = _TURKISH_HIGH_VOWELS[last_vowel]
+        elif letter == "D":
+            letter = "t" if last_letter in _TURKISH_VOICELESS else "d"
+        elif letter == "C":
+            letter = "ç" if last_letter in _TURKISH_VOICELESS else "c"
+        result.append(letter)
+        if letter in _TURKISH_VOWELS:
+            last_vowel = letter
+        last_letter = letter
+        after_vowel = letter in _TURKISH_VOWELS
+        i += 1
+    return "".join(result)
+
+
+@lru_cache(maxsize=100_000)
+def _is_turkish_chain(rest: str, slot: int, last_vowel: str, last_letter: str) -> bool:
+    if not rest:
+        return True
+    for index in range(slot, len(TURKISH_SUFFIX_SLOTS)):
+        for suffix in TURKISH_SUFFIX_SLOTS[index]:
+            if len(suffix) == 1 and last_letter not in _TURKISH_VOWELS:
+                continue
+            spelling = _turkish_spelling(suffix, last_vowel, last_letter)
+            spellings = [spelling]
+            if spelling.endswith("k") and len(spelling) > 1:
+                spellings.append(spelling[:-1] + "ğ")
+            for spelled in spellings:
+                if not rest.startswith(spelled):
+                    continue
+                remaining = rest[len(spelled):]
+                if spelled.endswith("ğ") and remaining[:1] not in tuple(_TURKISH_VOWELS):
+                    continue
+                vowels = [letter for letter in spelled if letter in _TURKISH_VOWELS]
+                if _is_turkish_chain(remaining, index + 1, vowels[-1] if vowels else last_vowel, spelled[-1]):
+                    return True
+    return False
+
+
+def _is_turkish_progressive(stem: str, rest: str) -> bool:
+    """
+    Whether the rest of a word after a verb stem that lost its last vowel is (I)yor followed by suffixes,
+    e.g. anl-ıyor-um for anlamak.
+    """
+    progressive = _TURKISH_HIGH_VOWELS[_last_vowel(stem)] + "yor"
+    return rest.startswith(progressive) and _is_turkish_chain(rest[len(progressive):], _AFTER_PROGRESSIVE_SLOT,
+                                                              "o", "r")
+
+
+def matches(code: str, card_word: str, text_word: str) -> bool:
+    """
+    Whether the lower-case text_word is a form of the card_word.
+    """
+    for base in bases(code, card_word):
+        if text_word.startswith(base):
+            if len(base) >= MIN_OPEN_MATCH_LENGTH or is_suffix_chain(code, text_word[len(base):], base):
+                return True
+        elif (code == "tr" and len(base) > MIN_BASE_LENGTH and base[-1] in _TURKISH_VOWELS and
+              text_word.startswith(base[:-1]) and _is_turkish_progressive(base[:-1], text_word[len(base) - 1:])):
+            return True
+    return lower(code, card_word) == text_word
+
+
+def card_words(code: str, word_card: WordCard) -> List[str]:
+    """
+    The words of the card's word, without the parts in parentheses, e.g. "kitap (book)" or "yemek [noun]".
+    """
+    text = _PARENTHESES.sub(" ", word_card.word)
+    if code == "en" and text.lower().startswith("to "):
+        text = text[3:]
+    return _WORDS.findall(text)
+
+
+class CoverageMatcher:
+    """
+    Tells which of the word cards appear in a text in some inflected form.
+
+    A card is covered when each of the words of its word matches one of the words of the text:
+    the text word starts with the card word, minus its dictionary form ending and maybe with its last letter
+    alternated, and the rest of the text word is a chain of the locale's suffixes. The text is split once,
+    and the bases and suffix chains are cached, since dialogs keep repeating the same words.
+    """
+
+    def __init__(self, code: str, text: str):
+        self.code = code
+        self.text = text
+        self.words = frozenset(lower(code, word) for word in _WORDS.findall(text))
+
+    def covers(self, word_card: WordCard) -> bool:
+        if self.code in UNSEGMENTED:
+            word = _PARENTHESES.sub("", word_card.word).strip()
+            return bool(word) and word in self.text
+        words = card_words(self.code, word_card)
+        return bool(words) and all(self._covers_word(word) for word in words)
+
+    def _covers_word(self, word: str) -> bool:
+        if lower(self.code, word) in self.words:
+            return True
+        return any(matches(self.code, word, text_word) for text_word in self.words)
+
+    def split(self, word_cards: Iterable[WordCard]) -> Tuple[List[WordCard], List[WordCard]]:
+        """
+        The covered and the missing cards.
+        """
+        covered, missing = [], []
+        for word_card in word_cards:
+            (covered if self.covers(word_card) else missing).append(word_card)
+        return covered, missing
+
+
+def do_main():
+    text = ("Merhaba, bu kitabı dün aldım. Evlerimizde çok kitap var. Evet, yarın İstanbul'a gidiyorum. "
+            "Rengi çok güzel. Ağacın altında oturuyoruz.")
+    cards = [WordCard(str(i), word, "", "", "") for i, word in enumerate(
+        ["kitap", "ev", "gitmek", "renk", "ağaç", "oturmak", "almak", "köpek", "istanbul", "et", "yarın"])]
+    covered, missing = CoverageMatcher("tr", text).split(cards)
+    print("covered:", [card.word for card in covered], "missing:", [card.word for card in missing])
+
+    # Forms that must count as the card word and look-alikes that mustn't
+    checks = [("ev", "evlerimizde", True), ("ev", "evinde", True), ("gitmek", "gideceğim", True),
+              ("gelmek", "gelemiyordum", True), ("anlamak", "anlıyorum", True), ("almak", "aldım", True),
+              ("ev", "evet", False), ("anlamak", "anlat", False), ("kır", "kırmızı", False),
+              ("yemek", "yemedim", False), ("yemek", "yemekler", True)]
+    wrong = [(card_word, text_word) for card_word, text_word, expected in checks
+             if matches("tr", card_word, text_word) != expected]
+    print("wrong matches:", wrong)
+    assert not wrong
+
+    hu_text = "A házakban sok almát láttam. Holnap a barátommal megyek a piacra."
+    hu_cards = [WordCard(str(i), word, "", "", "") for i, word in enumerate(
+        ["ház", "alma", "barát", "piac", "kutya", "lát"])]
+    covered, missing = CoverageMatcher("hu", hu_text).split(hu_cards)
+    print("covered:", [card.word for card in covered], "missing:", [card.word for card in missing])
+
+    long_text = " ".join([text] * 50)
+    runs = 1000
+    start = time.perf_counter()
+    for _ in range(runs):
+        CoverageMatcher("tr", long_text).split(cards[:3])
+    print(f"Checking 3 cards against {len(long_text)} characters: "
+          f"{(time.perf_counter() - start) * 1e6 / runs:.1f} µs")
+
+
+if __name__ == '__main__':
+    do_main()
@@ -0,0 +1,152 @@
+import json
+import re
+import time
+from typing import List, Optional, Sequence, Tuple
+
+_HEADER = re.compile(r'#\s*(Context|Dialog)\s*$')
+# "Ali: Merhaba", also with the name in bold
+_UTTERANCE = re.compile(r'\**([^:*]+?)\**\s*:\s*\**\s*(.+)$')
+
+# (who, utterance)
+Utterance = Tuple[str, str]
+
+
+class DialogStreamParser:
+    """
+    Splits the streamed "# Context ... # Dialog ..." completion into its context and its utterance lines
+    as they arrive. Only lines ended by a newline are handed out, so an utterance is never cut in the middle.
+    The chunks of an unfinished line are kept apart and joined once, so the work stays linear in the text.
+    """
+
+    def __init__(self):
+        self.context_lines: List[str] = []
+        self.section: Optional[str] = None
+        self._pieces: List[str] = []
+
+    @property
+    def context(self) -> str:
+        return "\n".join(self.context_lines).strip()
+
+    def feed(self, text: str) -> List[str]:
+        """
+        The dialog lines completed by the text.
+        """
+        if "\n" not in text:
+            self._pieces.append(text)
+            return []
+        self._pieces.append(text)
+        lines = "".join(self._pieces).split("\n")
+        self._pieces = [lines.pop()]
+        return self._take(lines)
+
+    def finish(self) -> List[str]:
+        lines = ["".join(self._pieces)]
+        self._pieces = []
+        return self._take(lines)
+
+    def _take(self, lines: List[str]) -> List[str]:
+        result = []
+        for line in lines:
+            header = _HEADER.match(line.strip())
+            if header:
+                self.section = header.group(1)
+            elif self.section == "Context":
+                self.context_lines.append(line)
+            elif self.section == "Dialog":
+                line = line.strip()
+                if line and not line.startswith("```"):
+                    result.append(line)
+        return result
+
+
+def parse_utterance(line: str, names: Sequence[str]) -> Optional[Utterance]:
+    match = _UTTERANCE.match(line)
+    if not match or match.group(1).strip() not in names:
+        return None
+    return match.group(1).strip(), match.group(2).strip().strip("*").strip()
+
+
+class JsonElementStreamParser:
+    """
+    Hands out the elements of a streamed JSON array as soon as each one closes, parsed, before the rest of the
+    document has arrived. element_depth is the number of arrays and objects around an element: 1 for the
+    [[who, utterance, translation], ...] list of the translation stage, 2 for the utterance objects in
+    {"context": ..., "utterances": [...]} of the structured generation. Only array and object elements
+    are handed out. Text around the JSON, such as a code fence, is skipped.
+
+    Every character is looked at once and only the text of the current element is kept, so the work is
+    linear in the length of the completion.
+    """
+
+    def __init__(self, element_depth: int = 1):
+        self.element_depth = element_depth
+        self.depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._element: List[str] = []
+        self._element_start: Optional[int] = None
+
+    def feed(self, text: str) -> list:
+        """
+        The elements closed by the text.
+        """
+        result = []
+        start = self._element_start
+        for i, c in enumerate(text):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = self.depth > 0
+            elif c in "[{":
+                if self.depth == self.element_depth:
+                    start = i
+                    self._element = []
+                self.depth += 1
+            elif c in "]}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == self.element_depth and start is not None:
+                    self._element.append(text[start:i + 1])
+                    start = None
+                    try:
+                        result.append(json.loads("".join(self._element)))
+                    except ValueError:
+                        # Not JSON after all; the caller parses the whole completion and reports it
+                        pass
+                    self._element = []
+        if start is not None:
+            self._element.append(text[start:])
+            start = 0
+        self._element_start = start
+        return result
+
+
+def do_main():
+    content = [[("Ali" if i % 2 else "Elif"), f"Cümle {i}, \"alıntı\" [{i}].", f"Sentence {i}."] for i in range(2000)]
+    text = "```json\n" + json.dumps(content, ensure_ascii=False) + "\n```"
+    chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+
+    start = time.perf_counter()
+    parser = JsonElementStreamParser()
+    elements = [element for chunk in chunks for element in parser.feed(chunk)]
+    print(f"JSON array of {len(text)} characters in {len(chunks)} chunks: {len(elements)} elements in "
+          f"{(time.perf_counter() - start) * 1000:.0f} ms, equal: {elements == content}")
+
+    structured = json.dumps({"context": "At a café.", "utterances": [
+        {"who": who, "utterance": sentence, "translation": translation} for who, sentence, translation in content[:3]]})
+    parser = JsonElementStreamParser(2)
+    print([element for i in range(0, len(structured), 5) for element in parser.feed(structured[i:i + 5])])
+
+    markdown = "# Context\nAt a café.\n# Dialog\n" + "\n".join(f"{who}: {sentence}" for who, sentence, _ in content)
+    start = time.perf_counter()
+    parser = DialogStreamParser()
+    lines = [line for i in range(0, len(markdown), 7) for line in parser.feed(markdown[i:i + 7])] + parser.finish()
+    print(f"Markdown: {len(lines)} lines in {(time.perf_counter() - start) * 1000:.0f} ms, context {parser.context}")
+
+
+if __name__ == '__main__':
+    do_main()
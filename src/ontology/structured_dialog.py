@@ -0,0 +1,103 @@
+import json
+import random
+import time
+from typing import Callable, List, Sequence, Tuple
+
+
+def dialog_schema(names: Sequence[str]) -> dict:
+    """
+    JSON schema of a dialog generated in one request: the context and the utterances, each with its speaker,
+    one of the names, and its translation. Written in the subset that OpenAI's strict mode accepts.
+    """
+    return {
+        "type": "object",
+        "properties": {
+            "context": {"type": "string"},
+            "utterances": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "who": {"type": "string", "enum": list(names)},
+                        "utterance": {"type": "string"},
+                        "translation": {"type": "string"},
+                    },
+                    "required": ["who", "utterance", "translation"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["context", "utterances"],
+        "additionalProperties": False,
+    }
+
+
+def parse_structured_dialog(text: str, names: Sequence[str]) -> Tuple[str, list]:
+    """
+    The context and the [who, utterance, translation] list of a completion following dialog_schema.
+    Raises ValueError if it doesn't.
+    """
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("The structured dialog is not an object.")
+    context = data.get("context")
+    utterances = data.get("utterances")
+    if not isinstance(context, str) or not context.strip():
+        raise ValueError("The structured dialog has no context.")
+    if not isinstance(utterances, list) or not utterances:
+        raise ValueError("The structured dialog has no utterances.")
+    content = []
+    for utterance in utterances:
+        if not isinstance(utterance, dict):
+            raise ValueError(f"Not an utterance: {utterance}")
+        who, sentence, translation = (utterance.get(key) for key in ("who", "utterance", "translation"))
+        if who not in names:
+            raise ValueError(f"Unknown speaker {who}.")
+        if not isinstance(sentence, str) or not isinstance(translation, str) or not sentence.strip():
+            raise ValueError(f"Not an utterance: {utterance}")
+        content.append([who, sentence.strip(), translation.strip()])
+    return context.strip(), content
+
+
+def local_structured_completion(names: Sequence[str], stream_callback: Callable[[int], None],
+                                utterance_count: int = 8, chunk_size: int = 12) -> str:
+    """
+    Stand-in for a provider returning a dialog that follows dialog_schema, streamed in chunks of chunk_size
+    characters, to run the structured generation and its parser without network access.
+    """
+    data = {
+        "context": "Two friends meet at a café.",
+        "utterances": [{"who": names[i % len(names)], "utterance": f"Cümle {i}.", "translation": f"Sentence {i}."}
+                       for i in range(utterance_count)],
+    }
+    text = json.dumps(data, ensure_ascii=False)
+    chunks: List[str] = []
+    for chunk_count, start in enumerate(range(0, len(text), chunk_size), 1):
+        chunks.append(text[start:start + chunk_size])
+        stream_callback(chunk_count)
+    return "".join(chunks)
+
+
+def do_main():
+    names = ["Ali", "Elif"]
+    text = local_structured_completion(names, lambda count: None)
+    context, content = parse_structured_dialog(text, names)
+    print(context)
+    print(content[:2])
+
+    random.seed(1)
+    texts = [local_structured_completion(names, lambda count: None, random.randint(6, 16)) for _ in range(1000)]
+    start = time.perf_counter()
+    for text in texts:
+        parse_structured_dialog(text, names)
+    print(f"Parsing: {(time.perf_counter() - start) * 1000 / len(texts):.3f} ms per dialog")
+
+    for bad in ('[]', '{"context": "x", "utterances": [{"who": "Bob", "utterance": "a", "translation": "b"}]}'):
+        try:
+            parse_structured_dialog(bad, names)
+        except ValueError as e:
+            print(f"Rejected: {e}")
+
+
+if __name__ == '__main__':
+    do_main()
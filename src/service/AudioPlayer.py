@@ -56,6 +56,12 @@ class AudioPlayer(QObject):
             self.cache[cache_key] = self.get_audio_bytes(voice, utterance)
         return self.cache[cache_key]
 
+    def cached_audio(self, voice, utterance):
+        """
+        The audio synthesized earlier for the utterance, or None, without requesting it.
+        """
+        return self.cache.get(f"{voice}#{utterance}")
+
     def get_audio_bytes(self, voice, utterance):
         print(f"Retrieving from {voice}: {utterance}")
         speech_synthesizer = self.get_speech_synthesizer(voice)
@@ -1,36 +1,168 @@
-from PyQt5.QtCore import QObject, pyqtSignal, QThread, QTimer, QMetaObject
+import logging
+import threading
+import time
+from collections import deque
+
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, QThread, QTimer
+
+# A save happens once there have been no triggers for this long...
+DEBOUNCE_MS = 2000
+# ...but never later than this after the first trigger since the previous save
+MAX_STALENESS_MS = 10000
+# Delay before retrying a failed save, doubled after every failure up to the maximum
+RETRY_INITIAL_MS = 1000
+RETRY_MAX_MS = 60000
+
+
+class SaveStats:
+    """
+    Counters shared by SaveService and SaveWorker. Plain ints, so they are read without locking.
+    """
+
+    def __init__(self):
+        self.saves_issued = 0
+        self.saves_coalesced = 0
+        self.bytes_written = 0
+        self.failures = 0
+
+    def __repr__(self):
+        return (f"SaveStats(saves_issued={self.saves_issued}, saves_coalesced={self.saves_coalesced}, "
+                f"bytes_written={self.bytes_written}, failures={self.failures})")
 
 
 class SaveService(QObject):
+    """
+    Decides when to save. Lives in the GUI thread, where the triggers come from and the save jobs are prepared.
+
+    Every trigger restarts the debounce window, but never past the deadline set by the first trigger
+    since the previous save, so a steady stream of edits is still saved at least every MAX_STALENESS_MS.
+    """
     should_save = pyqtSignal()
 
-    def __init__(self):
+    def __init__(self, stats: SaveStats, debounce_ms=DEBOUNCE_MS, max_staleness_ms=MAX_STALENESS_MS):
         super().__init__()
-        self.timer = QTimer()
+        self.stats = stats
+        self.debounce_ms = debounce_ms
+        self.max_staleness_ms = max_staleness_ms
+        self.timer = QTimer(self)
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self._emit_should_save)
-        self.is_waiting = False
+        self.deadline = None
 
     def trigger(self):
-        if self.is_waiting:
-            print("Ignoring save trigger")
-            return
-        print("Triggering save in 10 seconds")
-        self.timer.start(10000)
-        self.is_waiting = True
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now + self.max_staleness_ms / 1000
+        else:
+            self.stats.saves_coalesced += 1
+        self.timer.start(min(self.debounce_ms, max(0, int((self.deadline - now) * 1000))))
+
+    def is_waiting(self):
+        return self.deadline is not None
+
+    def cancel(self):
+        self.timer.stop()
+        self.deadline = None
 
     def _emit_should_save(self):
+        self.deadline = None
         self.should_save.emit()
-        self.is_waiting = False
+
+
+class SaveWorker(QObject):
+    """
+    Runs the save jobs prepared by Learning.prepare_save in the order they were submitted. Lives in the worker thread.
+
+    A job that fails with an OSError stays at the head of the queue and is retried with exponential backoff.
+    The jobs after it wait, because journal appends must stay in order.
+    """
+
+    def __init__(self, stats: SaveStats):
+        super().__init__()
+        self.stats = stats
+        self.jobs = deque()
+        self.retry_delay_ms = RETRY_INITIAL_MS
+        self.retry_timer = None
+        # Notified when the queue becomes empty
+        self.idle = threading.Condition()
+
+    @pyqtSlot()
+    def start(self):
+        # Created here, so that the timer belongs to the worker thread
+        self.retry_timer = QTimer(self)
+        self.retry_timer.setSingleShot(True)
+        self.retry_timer.timeout.connect(self.run_jobs)
+
+    def enqueue(self, save_job):
+        """
+        Queues the job. Called from the GUI thread, so the job is in the queue, and seen by wait_until_idle,
+        before the worker thread gets to run it.
+        """
+        with self.idle:
+            self.jobs.append(save_job)
+
+    @pyqtSlot()
+    def job_added(self):
+        if not self.retry_timer.isActive():
+            self.run_jobs()
+
+    @pyqtSlot()
+    def flush(self):
+        """
+        Runs the queued jobs now, even if a retry is being backed off.
+        """
+        self.retry_timer.stop()
+        self.run_jobs()
+
+    @pyqtSlot()
+    def run_jobs(self):
+        while self.jobs:
+            save_job = self.jobs[0]
+            try:
+                written = save_job()
+            except OSError:
+                self.stats.failures += 1
+                logging.exception(f"Saving failed, retrying in {self.retry_delay_ms} ms")
+                self.retry_timer.start(self.retry_delay_ms)
+                self.retry_delay_ms = min(self.retry_delay_ms * 2, RETRY_MAX_MS)
+                return
+            except Exception:
+                # Not an I/O problem, so retrying won't help
+                self.stats.failures += 1
+                logging.exception("Saving failed, dropping the save")
+                written = 0
+            else:
+                self.stats.saves_issued += 1
+                self.stats.bytes_written += written
+            self.retry_delay_ms = RETRY_INITIAL_MS
+            print(f"Saved {written} bytes, {self.stats}")
+            with self.idle:
+                self.jobs.popleft()
+                if not self.jobs:
+                    self.idle.notify_all()
+
+    def wait_until_idle(self, timeout) -> bool:
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.jobs, timeout)
 
 
 class SaveServiceThread(QThread):
+    # Queued to the SaveWorker, which lives in this thread
+    job_added_signal = pyqtSignal()
+    flush_signal = pyqtSignal()
+
     def __init__(self):
         super().__init__()
-        self.save_service = SaveService()
+        self.stats = SaveStats()
+        self.save_service = SaveService(self.stats)
+        self.save_worker = SaveWorker(self.stats)
+        # Must be called from the thread the worker was created in, so it can't be done in run()
+        self.save_worker.moveToThread(self)
+        self.started.connect(self.save_worker.start)
+        self.job_added_signal.connect(self.save_worker.job_added)
+        self.flush_signal.connect(self.save_worker.flush)
 
     def run(self):
-        self.save_service.moveToThread(self)
         self.exec_()
 
     def trigger_save(self):
@@ -39,5 +171,25 @@ class SaveServiceThread(QThread):
     def connect(self, handler):
         self.save_service.should_save.connect(handler)
 
+    def submit(self, save_job):
+        self.save_worker.enqueue(save_job)
+        self.job_added_signal.emit()
+
     def pending_save(self):
-        return self.save_service.is_waiting
+        return self.save_service.is_waiting()
+
+    def flush(self, save_job, timeout) -> bool:
+        """
+        Submits the final save job, if any, waits up to timeout seconds for all queued jobs to finish
+        and stops the thread. Returns False if some changes could not be written in time.
+        """
+        self.save_service.cancel()
+        if save_job:
+            self.submit(save_job)
+        self.flush_signal.emit()
+        flushed = self.save_worker.wait_until_idle(timeout)
+        if not flushed:
+            logging.error(f"Gave up saving after {timeout} s, {self.stats}")
+        self.quit()
+        self.wait(int(timeout * 1000))
+        return flushed
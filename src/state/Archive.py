@@ -0,0 +1,46 @@
+import os
+import threading
+import zlib
+from typing import List
+
+ARCHIVE_SUFFIX = ".archive"
+
+
+class Archive:
+    """
+    Side file with the JSON of dialogs that have not been visited for a long time, see Learning.archive_idle_dialogs.
+    Every dialog is a separately zlib-compressed chunk addressed by its [offset, length] in the file,
+    and the snapshot file only keeps an ArchivedNodeStub with that address.
+
+    The file is append-only, so addresses stay valid. A chunk whose dialog was visited again and
+    went back into the snapshot file is simply no longer referenced.
+    """
+
+    def __init__(self, snapshot_path: str):
+        self.path = snapshot_path + ARCHIVE_SUFFIX
+        self.lock = threading.Lock()
+
+    def append(self, chunks: List[bytes]) -> List[List[int]]:
+        """
+        Compresses and appends the chunks, and returns their addresses once they are on disk.
+        """
+        compressed = [zlib.compress(chunk, 9) for chunk in chunks]
+        addresses = []
+        with self.lock:
+            with open(self.path, 'ab') as archive_file:
+                offset = archive_file.seek(0, os.SEEK_END)
+                for data in compressed:
+                    addresses.append([offset, len(data)])
+                    offset += len(data)
+                archive_file.write(b"".join(compressed))
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
+        return addresses
+
+    def read(self, address: List[int]) -> bytes:
+        offset, length = address
+        with self.lock:
+            with open(self.path, 'rb') as archive_file:
+                archive_file.seek(offset)
+                data = archive_file.read(length)
+        return zlib.decompress(data)
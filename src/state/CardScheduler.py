@@ -0,0 +1,151 @@
+import heapq
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from state.WordCard import WordCard
+
+DAY_SECONDS = 24 * 60 * 60
+# Stability, in days, after the first exposure; every further one multiplies it by the ease
+FIRST_STABILITY_DAYS = 1.0
+EASE = 2.5
+# Focusing a card again is a lapse: it becomes due before every other card and its stability shrinks by this factor
+LAPSE_FACTOR = 0.5
+MIN_STABILITY_DAYS = 0.5
+
+# most_due scans a pool instead of the heap when the heap has this many times more cards
+POOL_SCAN_RATIO = 8
+
+
+def review(card: WordCard, now: int):
+    """
+    SM-2 style update after the card was featured in an accepted dialog.
+    """
+    card.stability = card.stability * EASE if card.stability else FIRST_STABILITY_DAYS
+    card.exposures += 1
+    card.due = now + int(card.stability * DAY_SECONDS)
+    card.last_seen = now
+
+
+def lapse(card: WordCard):
+    """
+    Makes the card due at 0, like the cards never shown, so that it isn't queued behind them:
+    among cards due at the same time, focused ones come first.
+    """
+    card.stability = max(MIN_STABILITY_DAYS, card.stability * LAPSE_FACTOR)
+    card.due = 0
+
+
+class CardScheduler:
+    """
+    Heap of the word cards ordered by how due they are: by due time, focused cards first among cards due
+    at the same time, then in the order the cards were added, so that cards that were never shown keep
+    their list order. Focusing a card makes it due at 0 through lapse, so it comes before the cards never
+    shown and every overdue card, while focused cards due later still wait for their turn.
+
+    Cards are updated by pushing a new entry; the old one stays in the heap and is skipped when it
+    comes up, and the heap is rebuilt once stale entries outnumber the live ones.
+    Taking the k most due cards is O(k log n) and an update O(log n), both amortized.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[int, int, int, str]] = []
+        # The live entry of each card
+        self._entries: Dict[str, Tuple[int, int, int, str]] = {}
+        self._cards: Dict[str, WordCard] = {}
+        self._order = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, card: WordCard, focused: bool):
+        self._cards[card.identifier] = card
+        self._order += 1
+        self._push(card, focused, self._order)
+
+    def remove(self, identifier: str):
+        self._entries.pop(identifier, None)
+        self._cards.pop(identifier, None)
+
+    def update(self, card: WordCard, focused: bool):
+        """
+        Must be called after the card's focus or schedule changed.
+        """
+        entry = self._entries.get(card.identifier)
+        if entry is None:
+            self.add(card, focused)
+        else:
+            self._push(card, focused, entry[2])
+
+    def _push(self, card: WordCard, focused: bool, order: int):
+        entry = (card.due, 0 if focused else 1, order, card.identifier)
+        self._entries[card.identifier] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def most_due(self, k: int, pool=None) -> List[WordCard]:
+        """
+        The k most due cards, most due first. With a pool, such as a CardSet, which iterates its cards and
+        contains their identifiers, only the cards in it are taken. They stay scheduled until they are reviewed.
+        """
+        if pool is not None and len(pool) * POOL_SCAN_RATIO < len(self._entries):
+            # A small pool: pick from its entries rather than popping most of the heap to get to them
+            entries = (self._entries.get(card.identifier) for card in pool)
+            return [self._cards[entry[3]] for entry in heapq.nsmallest(k, (e for e in entries if e))]
+
+        taken = []
+        skipped = []
+        while self._heap and len(taken) < k:
+            entry = heapq.heappop(self._heap)
+            if self._entries.get(entry[3]) is not entry:
+                continue
+            if pool is None or entry[3] in pool:
+                taken.append(entry)
+            else:
+                skipped.append(entry)
+        for entry in taken + skipped:
+            heapq.heappush(self._heap, entry)
+        return [self._cards[entry[3]] for entry in taken]
+
+    def get(self, identifier: str) -> Optional[WordCard]:
+        return self._cards.get(identifier)
+
+
+def do_main():
+    n = 100_000
+    scheduler = CardScheduler()
+    cards = [WordCard(f"id{i}", f"word{i}", "", f"translation{i}", "") for i in range(n)]
+    start = time.perf_counter()
+    for i, card in enumerate(cards):
+        scheduler.add(card, i < 100)
+    print(f"Scheduling {n} cards: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    now = int(time.time())
+    check = CardScheduler()
+    unseen = [WordCard(f"new{i}", "", "", "", "") for i in range(3)]
+    overdue = WordCard("overdue", "", "", "", "", due=now - DAY_SECONDS, stability=4.0, exposures=2)
+    focused = WordCard("focused", "", "", "", "", due=now + 30 * DAY_SECONDS, stability=8.0, exposures=3)
+    for card in unseen + [overdue, focused]:
+        check.add(card, False)
+    lapse(focused)
+    check.update(focused, True)
+    order = [card.identifier for card in check.most_due(5)]
+    print("Order after focusing a card:", order)
+    assert order == ["focused", "new0", "new1", "new2", "overdue"]
+
+    rounds = 10_000
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for card in scheduler.most_due(3):
+            review(card, now)
+            scheduler.update(card, False)
+        card = random.choice(cards)
+        lapse(card)
+        scheduler.update(card, True)
+    print(f"most_due(3), 3 reviews and a lapse: {(time.perf_counter() - start) * 1e6 / rounds:.2f} µs per round")
+
+
+if __name__ == '__main__':
+    do_main()
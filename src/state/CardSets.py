@@ -0,0 +1,319 @@
+import random
+import time
+from collections import deque
+from itertools import repeat
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from state.CardScheduler import DAY_SECONDS
+from state.WordCard import WordCard
+
+STATUS_NEW = "new"
+STATUS_LEARNING = "learning"
+STATUS_MASTERED = "mastered"
+STATUSES = (STATUS_NEW, STATUS_LEARNING, STATUS_MASTERED)
+
+# Cards whose stability reached this many days count as mastered
+MASTERED_STABILITY_DAYS = 21.0
+
+FOCUSED = ("focused", "")
+
+
+def status(card: WordCard) -> str:
+    if not card.exposures:
+        return STATUS_NEW
+    return STATUS_MASTERED if card.stability >= MASTERED_STABILITY_DAYS else STATUS_LEARNING
+
+
+def _bit_count(bits: int) -> int:
+    return bin(bits).count("1")
+
+
+class Bitmap:
+    """
+    Mutable set of card ordinals as a bytearray, so that adding or removing a card is O(1).
+    Set algebra goes through Python ints, which do it a machine word at a time.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def add(self, ordinal: int):
+        byte = ordinal >> 3
+        if byte >= len(self.data):
+            self.data.extend(bytes(max(byte + 1 - len(self.data), len(self.data))))
+        self.data[byte] |= 1 << (ordinal & 7)
+
+    def add_all(self, ordinals: List[int]):
+        """
+        Adds the ordinals at once. When they are dense, the bits are set as the digits of a binary number,
+        so that the loop over them runs in C.
+        """
+        if not ordinals:
+            return
+        last = max(ordinals)
+        if len(ordinals) * 8 < last:
+            size = (last >> 3) + 1
+            if size > len(self.data):
+                self.data.extend(bytes(size - len(self.data)))
+            data = self.data
+            for ordinal in ordinals:
+                data[ordinal >> 3] |= 1 << (ordinal & 7)
+            return
+        digits = bytearray(b"0") * (last + 1)
+        deque(map(digits.__setitem__, ordinals, repeat(ord("1"))), maxlen=0)
+        bits = int(digits[::-1], 2) | self.to_int()
+        self.data = bytearray(bits.to_bytes((bits.bit_length() + 7) // 8, "little"))
+
+    def discard(self, ordinal: int):
+        byte = ordinal >> 3
+        if byte < len(self.data):
+            self.data[byte] &= ~(1 << (ordinal & 7)) & 0xFF
+
+    def to_int(self) -> int:
+        return int.from_bytes(self.data, "little")
+
+
+class CardSet:
+    """
+    Immutable set of cards from a CardSets index, combined with &, | and -, and ~ for the complement.
+    """
+
+    def __init__(self, index: "CardSets", bits: int):
+        self.index = index
+        self.bits = bits
+        self._bytes: Optional[bytes] = None
+
+    def __and__(self, other: "CardSet") -> "CardSet":
+        return CardSet(self.index, self.bits & other.bits)
+
+    def __or__(self, other: "CardSet") -> "CardSet":
+        return CardSet(self.index, self.bits | other.bits)
+
+    def __sub__(self, other: "CardSet") -> "CardSet":
+        return CardSet(self.index, self.bits & ~other.bits)
+
+    def __invert__(self) -> "CardSet":
+        return CardSet(self.index, ((1 << len(self.index.cards)) - 1) & ~self.bits)
+
+    def __len__(self) -> int:
+        return _bit_count(self.bits)
+
+    def __bool__(self) -> bool:
+        return bool(self.bits)
+
+    def _as_bytes(self) -> bytes:
+        if self._bytes is None:
+            self._bytes = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, "little")
+        return self._bytes
+
+    def __contains__(self, identifier: str) -> bool:
+        ordinal = self.index.ordinals.get(identifier)
+        if ordinal is None:
+            return False
+        data = self._as_bytes()
+        byte = ordinal >> 3
+        return byte < len(data) and bool(data[byte] >> (ordinal & 7) & 1)
+
+    def __iter__(self) -> Iterator[WordCard]:
+        """
+        The cards in the order they were added to the index.
+        """
+        cards = self.index.cards
+        for byte, value in enumerate(self._as_bytes()):
+            while value:
+                low = value & -value
+                yield cards[(byte << 3) + low.bit_length() - 1]
+                value ^= low
+
+
+class CardSets:
+    """
+    Bitmap index of the word cards by focus, deck, tag, status and the day they were last seen.
+
+    Every card gets an ordinal when it's added, and every attribute value a Bitmap of the ordinals of the
+    cards having it. The bitmaps are updated in place as the cards change, and a query such as
+    "focused and tagged travel and not seen in the last 7 days" is a few ANDs over them:
+    index.focused() & index.tag("travel") - index.seen_since(now - 7 * DAY_SECONDS).
+    """
+
+    def __init__(self):
+        self.cards: List[WordCard] = []
+        self.ordinals: Dict[str, int] = {}
+        self._bitmaps: Dict[Tuple[str, str], Bitmap] = {}
+        # The keys each card is in, to remove it from them when it changes
+        self._keys: List[Tuple[Tuple[str, str], ...]] = []
+
+    def __len__(self):
+        return len(self.cards)
+
+    def _keys_of(self, card: WordCard, focused: bool) -> Tuple[Tuple[str, str], ...]:
+        keys = [("status", status(card))]
+        if focused:
+            keys.append(FOCUSED)
+        if card.deck:
+            keys.append(("deck", card.deck))
+        keys.extend(("tag", tag) for tag in card.tags)
+        if card.last_seen:
+            keys.append(("seenDay", str(card.last_seen // DAY_SECONDS)))
+        return tuple(keys)
+
+    def add(self, card: WordCard, focused: bool):
+        if card.identifier in self.ordinals:
+            self.update(card, focused)
+            return
+        ordinal = len(self.cards)
+        self.cards.append(card)
+        self.ordinals[card.identifier] = ordinal
+        keys = self._keys_of(card, focused)
+        self._keys.append(keys)
+        for key in keys:
+            self._bitmap(key).add(ordinal)
+
+    def add_all(self, cards: Iterable[WordCard], focused: bool):
+        """
+        Adds the cards like add does one by one, but in bulk, for building the index of all the cards:
+        the keys are found once per distinct combination of labels and day, of which there are few,
+        and every bitmap is filled in one pass. Cards with the same keys share one tuple of them.
+        """
+        new_cards = []
+        for card in cards:
+            if card.identifier in self.ordinals:
+                self.update(card, focused)
+            else:
+                new_cards.append(card)
+        identifiers = [card.identifier for card in new_cards]
+        start = len(self.cards)
+        self.ordinals.update(zip(identifiers, range(start, start + len(new_cards))))
+        if len(self.ordinals) != start + len(new_cards):
+            # A card given twice, added and then updated like add would
+            for identifier in identifiers:
+                self.ordinals.pop(identifier, None)
+            for card in new_cards:
+                self.add(card, focused)
+            return
+        self.cards.extend(new_cards)
+        labels = [(status(card), card.deck, card.tags, card.last_seen // DAY_SECONDS) for card in new_cards]
+        keys_by_labels = {card_labels: self._keys_of(card, focused)
+                          for card_labels, card in dict(zip(labels, new_cards)).items()}
+        self._keys.extend(map(keys_by_labels.__getitem__, labels))
+
+        ordinals_by_labels: Dict[tuple, List[int]] = {card_labels: [] for card_labels in keys_by_labels}
+        for ordinal, card_labels in enumerate(labels, start):
+            ordinals_by_labels[card_labels].append(ordinal)
+        ordinals_by_key: Dict[Tuple[str, str], List[int]] = {}
+        for card_labels, label_ordinals in ordinals_by_labels.items():
+            for key in keys_by_labels[card_labels]:
+                ordinals_by_key.setdefault(key, []).extend(label_ordinals)
+        for key, key_ordinals in ordinals_by_key.items():
+            self._bitmap(key).add_all(key_ordinals)
+
+    def update(self, card: WordCard, focused: bool):
+        """
+        Must be called after the card's focus, schedule or labels changed.
+        """
+        ordinal = self.ordinals.get(card.identifier)
+        if ordinal is None:
+            self.add(card, focused)
+            return
+        old_keys = self._keys[ordinal]
+        new_keys = self._keys_of(card, focused)
+        if old_keys == new_keys:
+            return
+        for key in set(old_keys) - set(new_keys):
+            self._bitmaps[key].discard(ordinal)
+        for key in set(new_keys) - set(old_keys):
+            self._bitmap(key).add(ordinal)
+        self._keys[ordinal] = new_keys
+
+    def _bitmap(self, key: Tuple[str, str]) -> Bitmap:
+        bitmap = self._bitmaps.get(key)
+        if bitmap is None:
+            bitmap = self._bitmaps[key] = Bitmap()
+        return bitmap
+
+    def _set(self, key: Tuple[str, str]) -> CardSet:
+        bitmap = self._bitmaps.get(key)
+        return CardSet(self, bitmap.to_int() if bitmap else 0)
+
+    def values(self, attribute: str) -> List[str]:
+        """
+        The values of the attribute that some card has, e.g. the decks or the tags.
+        """
+        return sorted(value for (name, value), bitmap in self._bitmaps.items()
+                      if name == attribute and any(bitmap.data))
+
+    def all(self) -> CardSet:
+        return CardSet(self, (1 << len(self.cards)) - 1)
+
+    def focused(self) -> CardSet:
+        return self._set(FOCUSED)
+
+    def deck(self, deck: str) -> CardSet:
+        return self._set(("deck", deck))
+
+    def tag(self, tag: str) -> CardSet:
+        return self._set(("tag", tag))
+
+    def status(self, status_name: str) -> CardSet:
+        return self._set(("status", status_name))
+
+    def seen_since(self, since: int) -> CardSet:
+        """
+        The cards last seen at or after the unix time, to the day.
+        """
+        first_day = since // DAY_SECONDS
+        bits = 0
+        for (name, value), bitmap in self._bitmaps.items():
+            if name == "seenDay" and int(value) >= first_day:
+                bits |= bitmap.to_int()
+        return CardSet(self, bits)
+
+
+def build_card_sets(focused_cards: Iterable[WordCard], main_cards: Iterable[WordCard]) -> CardSets:
+    card_sets = CardSets()
+    card_sets.add_all(focused_cards, True)
+    card_sets.add_all(main_cards, False)
+    return card_sets
+
+
+def do_main():
+    n = 1_000_000
+    now = int(time.time())
+    random.seed(1)
+    decks = ["A1", "A2", "B1"]
+    tags = ["travel", "food", "work", "family"]
+    cards = []
+    for i in range(n):
+        exposures = random.choice((0, 0, 1, 3, 6))
+        cards.append(WordCard(f"id{i}", f"word{i}", "", f"translation{i}", "",
+                              stability=2.5 ** exposures if exposures else 0.0, exposures=exposures,
+                              last_seen=now - random.randrange(60) * DAY_SECONDS if exposures else 0,
+                              deck=random.choice(decks), tags=random.sample(tags, random.randint(0, 2))))
+
+    start = time.perf_counter()
+    card_sets = build_card_sets(cards[:n // 10], cards[n // 10:])
+    print(f"Indexing {n} cards: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    start = time.perf_counter()
+    result = card_sets.focused() & card_sets.tag("travel") - card_sets.seen_since(now - 7 * DAY_SECONDS)
+    count = len(result)
+    print(f"focused AND tag=travel AND NOT seen in the last 7 days: {count} cards in "
+          f"{(time.perf_counter() - start) * 1000:.2f} ms")
+
+    start = time.perf_counter()
+    naive = [card for card in cards[:n // 10]
+             if "travel" in card.tags and card.last_seen < (now - 7 * DAY_SECONDS) // DAY_SECONDS * DAY_SECONDS]
+    print(f"The same by scanning the cards: {len(naive)} cards in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    start = time.perf_counter()
+    for card in random.sample(cards, 10_000):
+        card.exposures += 1
+        card.last_seen = now
+        card_sets.update(card, False)
+    print(f"Update: {(time.perf_counter() - start) * 1e6 / 10_000:.2f} µs per card")
+
+
+if __name__ == '__main__':
+    do_main()
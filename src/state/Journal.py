@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+from typing import Callable
+
+from state.Snapshot import LearningSnapshot, write_snapshot
+from state.Storage import Storage
+
+JOURNAL_SUFFIX = ".journal"
+
+# Once the journal grows past this size, it is folded into a fresh snapshot
+COMPACT_THRESHOLD_BYTES = 1024 * 1024
+
+
+class Journal(Storage):
+    """
+    Append-only log of changes made to a Learning since its snapshot file was written.
+
+    Every change is a small JSON object with an "op" name and a monotonically increasing "seq".
+    The snapshot stores the "journalSeq" it includes, so changes with a lower or equal seq are
+    skipped on replay even if the journal could not be truncated after a compaction.
+
+    record and take_pending are called on the thread that owns the Learning;
+    append and compact do the I/O and may run on a worker thread.
+    """
+
+    def __init__(self, snapshot_path: str, seq: int = 0, compact_threshold: int = COMPACT_THRESHOLD_BYTES):
+        super().__init__(snapshot_path)
+        self.journal_path = snapshot_path + JOURNAL_SUFFIX
+        self.seq = seq
+        self.compact_threshold = compact_threshold
+        self.pending = []
+        # Guards the journal file against concurrent appends and compaction rewrites
+        self.lock = threading.Lock()
+        self.compaction_scheduled = False
+        self.compaction_requested = False
+
+    def record(self, change: dict):
+        self.seq += 1
+        change["seq"] = self.seq
+        self.pending.append(change)
+
+    def journal_seq(self) -> int:
+        return self.seq
+
+    def take_pending(self):
+        pending = self.pending
+        self.pending = []
+        return pending
+
+    def prepare_save(self, learning) -> Callable[[], int]:
+        changes = self.take_pending()
+        snapshot = None
+        if self.needs_compaction():
+            self.compaction_scheduled = True
+            self.compaction_requested = False
+            snapshot = learning.snapshot()
+
+        def append_to_journal():
+            compacted = False
+            try:
+                written = self.append(changes)
+                if snapshot:
+                    written += self.compact(snapshot)
+                    compacted = True
+                return written
+            finally:
+                if snapshot:
+                    # The SaveService may drop a failed job, so the flag can't wait for a successful compaction
+                    self.compaction_scheduled = False
+                    if not compacted:
+                        self.compaction_requested = True
+
+        return append_to_journal
+
+    def append(self, changes) -> int:
+        """
+        Appends the changes to the journal file and returns the number of bytes written.
+        """
+        if not changes:
+            return 0
+        data = "".join(json.dumps(change, ensure_ascii=False) + "\n" for change in changes).encode('utf-8')
+        with self.lock:
+            with open(self.journal_path, 'ab') as journal_file:
+                journal_file.write(data)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+        return len(data)
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def request_compaction(self):
+        self.compaction_requested = True
+
+    def needs_compaction(self) -> bool:
+        return not self.compaction_scheduled and (self.compaction_requested or self.size() > self.compact_threshold)
+
+    def compact(self, snapshot: LearningSnapshot) -> int:
+        """
+        Writes the snapshot over the snapshot file and drops the journal entries it covers.
+        Returns the number of bytes written.
+        """
+        print(f"Compacting journal at seq {snapshot.journal_seq}")
+        written = write_snapshot(snapshot, self.path)
+        with self.lock:
+            remaining = [change for change in self.read_changes() if change["seq"] > snapshot.journal_seq]
+            temp_path = self.journal_path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as journal_file:
+                for change in remaining:
+                    journal_file.write(json.dumps(change, ensure_ascii=False) + "\n")
+            os.replace(temp_path, self.journal_path)
+        return written
+
+    def read_changes(self):
+        """
+        Reads all changes from the journal file. A torn last line (e.g. after a crash) is ignored.
+        """
+        changes = []
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        changes.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        print(f"Skipping damaged journal line: {line!r}")
+        except FileNotFoundError:
+            pass
+        return changes
+
+    def read_pending_changes(self):
+        """
+        Returns the changes that are not yet part of the snapshot, and advances seq past them.
+        A retried append may have written some changes twice, so seqs that were already seen are skipped.
+        """
+        changes = []
+        for change in self.read_changes():
+            if change["seq"] > self.seq:
+                changes.append(change)
+                self.seq = change["seq"]
+        return changes
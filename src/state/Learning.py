@@ -1,93 +1,487 @@
 import json
-from typing import List
+import time
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
 
 
+from state.Archive import Archive
+from state.CardScheduler import CardScheduler, review, lapse
+from state.CardSets import CardSets, CardSet, build_card_sets
 from state.Dialog import Dialog, CreateDialogSettings
+from state.Journal import Journal
 from state.Node import Node
+from state.NodeStub import NodeStub, ArchivedNodeStub
 from state.RootNode import RootNode
-from state.WordCard import WordCard, pop_card
+from state.Snapshot import LearningSnapshot, SnapshotSource, WordCardsSnapshot, write_snapshot
+from state.Storage import Storage
+from state.WordCard import WordCard
+from state.WordCardList import WordCardList, CombinedWordCards
+from utils.search_utils import TrigramIndex
 
 
 class Learning:
-    def __init__(self, language: str, second_language: str, root_node: Node, word_cards_focused: List[WordCard],
+    def __init__(self, language: str, second_language: str, root_node: RootNode, word_cards_focused: List[WordCard],
                  word_cards_main: List[WordCard], create_dialog_settings: CreateDialogSettings):
         self.language = language
         self.second_language = second_language
         self.root_node = root_node
-        self.word_cards_focused = word_cards_focused
-        self.word_cards_main = word_cards_main
+        self.word_cards_focused = WordCardList(word_cards_focused)
+        self.word_cards_main = WordCardList(word_cards_main)
+        self.card_scheduler = CardScheduler()
+        for word_card in self.word_cards_focused:
+            self.card_scheduler.add(word_card, True)
+        for word_card in self.word_cards_main:
+            self.card_scheduler.add(word_card, False)
         self.create_dialog_settings = create_dialog_settings
+        self.storage: Optional[Storage] = None
+        # The seq of the last journal change included in this state, see Journal
+        self.journal_seq = 0
+        # Cached snapshots of the card lists, reset whenever a list changes
+        self._word_cards_snapshot = None
+        # WordCard.to_list rows of the cards by identifier, shared by the snapshots until the card changes
+        self._word_card_rows: Dict[str, list] = {}
+        # Built on first use, see word_card_index and card_sets
+        self._word_card_index: Optional[TrigramIndex] = None
+        self._card_sets: Optional[CardSets] = None
+        # Set when the root children are loaded lazily from an indexed snapshot file
+        self.source: Optional[SnapshotSource] = None
+        # Where idle dialogs are moved, see archive_idle_dialogs
+        self.archive: Optional[Archive] = None
 
     @classmethod
-    def from_data(cls, data):
-        return cls(
+    def from_data(cls, data, archive: Optional[Archive] = None):
+        learning = cls(
             data["language"],
             data.get("secondLanguage", "en"),
-            parse_node(data.get("root", {})),
+            parse_node(data.get("root", {}), archive),
             [WordCard.from_list(x) for x in data.get("wordCardsFocused", [])],
             [WordCard.from_list(x) for x in data.get("wordCardsMain", [])],
             CreateDialogSettings.from_data(data.get("createDialogSettings", {}))
         )
+        learning.journal_seq = data.get("journalSeq", 0)
+        learning.archive = archive
+        return learning
+
+    @classmethod
+    def from_json_file(cls, json_file_path, journaled=False, lazy=False):
+        """
+        Loads the snapshot and replays the changes from its journal, if there is one.
+        When journaled is True, subsequent changes are recorded to the journal and save_to only appends them.
+        When lazy is True and the file has an up-to-date index, only the dialogs on the current path are parsed.
+        Archived dialogs are read from the file's Archive when they are accessed.
+        """
+        archive = Archive(json_file_path)
+        learning = cls.from_indexed_json_file(json_file_path, archive) if lazy else None
+        if learning is None:
+            with open(json_file_path, 'r', encoding='utf-8') as file:
+                learning = cls.from_data(json.load(file), archive)
+
+        journal = Journal(json_file_path, learning.journal_seq)
+        for change in journal.read_pending_changes():
+            learning.replay_change(change)
+        learning.journal_seq = journal.seq
+        if journaled:
+            learning.storage = journal
+            if learning.root_node.assigned_node_ids or (lazy and learning.source is None):
+                # Write the new ids and the index right away rather than on the next regular compaction
+                journal.request_compaction()
+        return learning
 
     @classmethod
-    def from_json_file(cls, json_file_path):
-        with open(json_file_path, 'r', encoding='utf-8') as file:
-            json_data = json.load(file)
-            return cls.from_data(json_data)
+    def from_indexed_json_file(cls, json_file_path, archive: Optional[Archive] = None) -> Optional["Learning"]:
+        """
+        Parses everything except the root children, which become NodeStubs, and then loads the current one.
+        Returns None if the file has no valid index.
+        """
+        source = SnapshotSource.open(json_file_path)
+        if source is None:
+            return None
+        data = source.read_header()
+        learning = cls.from_data(data, archive)
+        learning.source = source
+
+        root_node = learning.root_node
+        parse = partial(parse_node, archive=archive)
+        for key in range(source.child_count()):
+            root_node.add_child(NodeStub(source, key, parse))
+        if root_node.nodes:
+            root_node.child_index = data["root"]["childIndex"]
+            root_node.current_child()
+        return learning
+
+    def record_change(self, change: dict):
+        if self.storage:
+            self.storage.record(change)
+
+    def replay_change(self, change: dict):
+        """
+        Applies a change recorded by one of the methods below. The changes are:
+        navigate (path, position, time), treeNavigate (path, childIndex, time), addNode (node), toggleFocus (id),
+        moveToEnd (id), addCard (card), addCards (cards), schedule (id, due, stability, exposures, lastSeen)
+        labels (id, deck, tags) and editCard (card), where path is the Node.path()
+        of the changed node and time is when the visited dialog was visited.
+        """
+        op = change["op"]
+        if op == "navigate":
+            node = self.root_node.node_at(change["path"])
+            node.current_position = change["position"]
+            node.mark_dirty()
+            if "time" in change:
+                self.visit(node, change["time"])
+        elif op == "treeNavigate":
+            node = self.root_node.node_at(change["path"])
+            node.child_index = change["childIndex"]
+            node.mark_dirty()
+            if "time" in change:
+                self.visit(node.current_child(), change["time"])
+        elif op == "addNode":
+            self.add_root_node(parse_node(change["node"], self.archive))
+        elif op == "toggleFocus":
+            self._toggle_focus(change["id"])
+        elif op == "moveToEnd":
+            self.move_word_card_to_end(change["id"])
+        elif op == "addCard":
+            self.add_word_card(WordCard.from_list(change["card"]))
+        elif op == "addCards":
+            self.add_word_cards([WordCard.from_list(card) for card in change["cards"]])
+        elif op == "schedule":
+            word_card = self.get_word(change["id"])
+            if word_card:
+                word_card.due, word_card.stability, word_card.exposures = \
+                    change["due"], change["stability"], change["exposures"]
+                word_card.last_seen = change.get("lastSeen", word_card.last_seen)
+                self._schedule_changed(word_card)
+        elif op == "labels":
+            self.set_word_card_labels(change["id"], change["deck"], change["tags"])
+        elif op == "editCard":
+            self.edit_word_card(WordCard.from_list(change["card"]))
+        else:
+            raise Exception(f"Unknown journal op: {op}")
 
     def add_root_node(self, node: Node):
+        if not node.last_visited:
+            node.last_visited = int(time.time())
         self.root_node.add_child(node)
         self.root_node.child_index = len(self.root_node.nodes) - 1
+        self.record_change({"op": "addNode", "node": node.prepare_json_object()})
+
+    def navigate_dialog(self, dialog: Dialog, delta) -> bool:
+        if not dialog.navigate(delta):
+            return False
+        visited = self.visit(dialog)
+        self.record_change({"op": "navigate", "path": dialog.path(), "position": dialog.current_position,
+                            "time": visited})
+        return True
+
+    def tree_navigate(self, node: Node, delta):
+        node.tree_navigate(delta)
+        visited = self.visit(node.current_child())
+        self.record_change({"op": "treeNavigate", "path": node.path(), "childIndex": node.child_index,
+                            "time": visited})
+
+    def jump_to(self, node_id: int) -> Node:
+        """
+        Makes the node with the id current by pointing the child_index of each of its ancestors at it,
+        instead of a tree_navigate for every sibling in between. Raises KeyError for unknown ids.
+        """
+        path = self.root_node.node_by_id(node_id).path()
+        visited = int(time.time())
+        node = self.root_node
+        for index in path:
+            if node.child_index != index:
+                node.child_index = index
+                node.mark_dirty()
+                self.record_change({"op": "treeNavigate", "path": node.path(), "childIndex": index,
+                                    "time": visited})
+            node = node.child(index)
+        self.visit(node, visited)
+        return node
+
+    def visit(self, node: Node, visited: Optional[int] = None) -> int:
+        """
+        Stamps the root child containing the node with the visit time, now by default, and returns it.
+        """
+        if visited is None:
+            visited = int(time.time())
+        while node.parent is not None and node.parent is not self.root_node:
+            node = node.parent
+        if node.parent is not None and node.last_visited != visited:
+            node.last_visited = visited
+            node.mark_dirty()
+        return visited
+
+    def stamp_unvisited(self, now: Optional[int] = None) -> int:
+        """
+        Gives the root children without a visit time, saved before visits were tracked, the load time,
+        now by default, so that archive_idle_dialogs counts their idle time from the first launch that
+        tracks it instead of archiving them right away. Unloaded children are loaded to be stamped,
+        which only happens once. Returns the number of stamped children.
+        """
+        if now is None:
+            now = int(time.time())
+        root_node = self.root_node
+        stamped = 0
+        for index, node in enumerate(root_node.nodes):
+            if not node.last_visited and not node.is_archived():
+                node = root_node.child(index)
+                node.last_visited = now
+                node.mark_dirty()
+                stamped += 1
+        if stamped and self.storage:
+            self.storage.request_compaction()
+        return stamped
+
+    def archive_idle_dialogs(self, max_idle_seconds) -> int:
+        """
+        Moves the root children that have not been visited for max_idle_seconds, except the current one,
+        to the Archive, and replaces them with ArchivedNodeStubs. Children without a visit time should be
+        stamped with stamp_unvisited first, they count as idle otherwise. Returns the number of archived children.
+
+        The archived chunks are on disk before this returns, and the storage is asked to rewrite the
+        snapshot on the next save, which then holds just the stubs.
+        """
+        if self.archive is None:
+            return 0
+        root_node = self.root_node
+        cutoff = time.time() - max_idle_seconds
+        idle = [index for index, node in enumerate(root_node.nodes)
+                if index != root_node.child_index and not node.is_archived() and node.last_visited < cutoff]
+        if not idle:
+            return 0
+
+        # Unloaded children are archived from the bytes they were read from, the rest from their cached encoding
+        stubs = {index: root_node.nodes[index] for index in idle if not root_node.nodes[index].is_loaded()}
+        raw_bytes = {}
+        for stub in stubs.values():
+            raw_bytes.setdefault(stub.source, []).append(stub.key)
+        raw_bytes = {source: source.read_many(keys) for source, keys in raw_bytes.items()}
+        chunks = []
+        for index in idle:
+            stub = stubs.get(index)
+            if stub:
+                chunks.append(raw_bytes[stub.source][stub.key])
+            else:
+                chunks.append(root_node.nodes[index].snapshot().encode())
+
+        parse = partial(parse_node, archive=self.archive)
+        for index, address in zip(idle, self.archive.append(chunks)):
+            summary = dict(root_node.nodes[index].summary(), archived=True)
+            archived = ArchivedNodeStub(self.archive, address, summary, parse)
+            root_node.nodes[index] = archived
+            archived.parent = root_node
+            archived.index_in_parent = index
+            archived.mark_dirty()
+            root_node.register(archived)
+        if self.storage:
+            self.storage.request_compaction()
+        print(f"Archived {len(idle)} dialogs")
+        return len(idle)
 
     def save_to(self, filename):
-        json_object = self.prepare_json_object()
+        self.prepare_save(filename)()
 
-        with open(filename, 'w', encoding='utf-8') as outfile:
-            json.dump(json_object, outfile, indent=2, ensure_ascii=False)
+    def prepare_save(self, filename) -> Callable[[], int]:
+        """
+        Does the cheap part of saving on the calling thread: takes a snapshot or the pending journal changes.
+        Returns a function that does the serialization and I/O and returns the number of bytes written;
+        it does not touch the Learning and can be run on a worker thread.
+        Saving to the storage's own path is delegated to the storage, anything else writes a JSON snapshot.
+        """
+        if self.storage and self.storage.path == filename:
+            return self.storage.prepare_save(self)
+
+        snapshot = self.snapshot()
+        return lambda: write_snapshot(snapshot, filename)
+
+    def snapshot(self) -> LearningSnapshot:
+        if self._word_cards_snapshot is None:
+            self._word_cards_snapshot = (WordCardsSnapshot(self._rows(self.word_cards_focused)),
+                                         WordCardsSnapshot(self._rows(self.word_cards_main)))
+        word_cards_focused, word_cards_main = self._word_cards_snapshot
+        return LearningSnapshot(
+            self.language,
+            self.second_language,
+            self.root_node.snapshot(),
+            word_cards_focused,
+            word_cards_main,
+            self.create_dialog_settings.to_data(),
+            self.storage.journal_seq() if self.storage else self.journal_seq,
+            self.source
+        )
+
+    def _rows(self, word_cards: WordCardList) -> Tuple[list, ...]:
+        # Only the cards that changed since the last snapshot are converted again, see _card_changed
+        rows = self._word_card_rows
+        result = []
+        for word_card in word_cards:
+            row = rows.get(word_card.identifier)
+            if row is None:
+                row = rows[word_card.identifier] = word_card.to_list()
+            result.append(row)
+        return tuple(result)
 
     def prepare_json_object(self):
-        return {
-            "language": self.language,
-            "secondLanguage": self.second_language,
-            "root": self.root_node.prepare_json_object(),
-            "wordCardsFocused": [x.to_list() for x in self.word_cards_focused],
-            "wordCardsMain": [x.to_list() for x in self.word_cards_main],
-            "createDialogSettings": self.create_dialog_settings.to_data()
-        }
+        return self.snapshot().to_json_object()
+
+    def word_cards_combined(self) -> CombinedWordCards:
+        return CombinedWordCards(self.word_cards_focused, self.word_cards_main)
+
+    def word_card_index(self) -> TrigramIndex:
+        """
+        Search index over the texts of all cards by identifier. Building it takes a while for large decks,
+        so that happens on the first search; after that, add_word_card keeps it up to date.
+        """
+        if self._word_card_index is None:
+            self._word_card_index = TrigramIndex()
+            for word_card in self.word_cards_combined():
+                self._word_card_index.add(word_card.identifier, word_card.texts())
+        return self._word_card_index
+
+    def card_sets(self) -> CardSets:
+        """
+        Bitmap index of the cards by focus, deck, tag, status and when they were last seen, for filtering.
+        Built on first use like word_card_index, and kept up to date by the methods changing the cards.
+        """
+        if self._card_sets is None:
+            self._card_sets = build_card_sets(self.word_cards_focused, self.word_cards_main)
+        return self._card_sets
+
+    def _card_changed(self, word_card: WordCard):
+        self._word_card_rows.pop(word_card.identifier, None)
+        if self._card_sets is not None:
+            self._card_sets.update(word_card, self.word_cards_focused.contains_id(word_card.identifier))
 
     def is_focused(self, word_id):
-        return word_id in (w.identifier for w in self.word_cards_focused)
+        return self.word_cards_focused.contains_id(word_id)
 
     def get_word(self, identifier):
-        for word_card in self.word_cards_focused:
-            if word_card.identifier == identifier:
-                return word_card
-        for word_card in self.word_cards_main:
-            if word_card.identifier == identifier:
-                return word_card
-        return None
+        return self.word_cards_focused.get(identifier) or self.word_cards_main.get(identifier)
 
     def toggle_word_card_focus(self, word_id):
-        word = pop_card(self.word_cards_focused, word_id)
+        """
+        Focusing a card again counts as a lapse, which makes it due before every other card.
+        """
+        self._toggle_focus(word_id)
+        self.record_change({"op": "toggleFocus", "id": word_id})
+        word_card = self.word_cards_focused.get(word_id)
+        if word_card:
+            lapse(word_card)
+            self._schedule_changed(word_card)
+
+    def _toggle_focus(self, word_id):
+        word = self.word_cards_focused.pop_id(word_id)
         if word:
             self.word_cards_main.append(word)
+            self.card_scheduler.update(word, False)
         else:
-            word = pop_card(self.word_cards_main, word_id)
+            word = self.word_cards_main.pop_id(word_id)
             if word:
-                self.word_cards_focused.insert(0, word)
+                self.word_cards_focused.insert_first(word)
+                self.card_scheduler.update(word, True)
+        if word:
+            self._card_changed(word)
+        self._word_cards_snapshot = None
+
+    def review_word_card(self, identifier):
+        """
+        Reschedules the card after it was featured in an accepted dialog.
+        """
+        word_card = self.get_word(identifier)
+        if word_card:
+            review(word_card, int(time.time()))
+            self._schedule_changed(word_card)
+
+    def _schedule_changed(self, word_card: WordCard):
+        self.card_scheduler.update(word_card, self.word_cards_focused.contains_id(word_card.identifier))
+        self._card_changed(word_card)
+        self._word_cards_snapshot = None
+        self.record_change({"op": "schedule", "id": word_card.identifier, "due": word_card.due,
+                            "stability": word_card.stability, "exposures": word_card.exposures,
+                            "lastSeen": word_card.last_seen})
+
+    def set_word_card_labels(self, identifier, deck: str, tags: List[str]):
+        word_card = self.get_word(identifier)
+        if word_card:
+            word_card.deck = deck
+            word_card.tags = tuple(tags)
+            self._card_changed(word_card)
+            self._word_cards_snapshot = None
+            self.record_change({"op": "labels", "id": identifier, "deck": deck, "tags": list(tags)})
+
+    def edit_word_card(self, edited: WordCard):
+        """
+        Replaces the texts and labels of the card with the edited one's identifier; the schedule stays as it is.
+        """
+        word_card = self.get_word(edited.identifier)
+        if not word_card:
+            return
+        word_card.word, word_card.word_comment, word_card.translation, word_card.translation_comment = edited.texts()
+        word_card.deck, word_card.tags = edited.deck, edited.tags
+        if self._word_card_index is not None:
+            self._word_card_index.add(word_card.identifier, word_card.texts())
+        self._card_changed(word_card)
+        self._word_cards_snapshot = None
+        self.record_change({"op": "editCard", "card": word_card.to_list()})
+
+    def most_due_word_cards(self, k, pool: Optional[CardSet] = None) -> List[WordCard]:
+        """
+        The k most due cards, only among the ones in the pool if there is one, see card_sets.
+        """
+        return self.card_scheduler.most_due(k, pool)
+
+    def move_word_card_to_end(self, identifier):
+        self.word_cards_focused.move_to_end(identifier)
+        self.word_cards_main.move_to_end(identifier)
+        self._word_cards_snapshot = None
+        self.record_change({"op": "moveToEnd", "id": identifier})
+
+    def add_word_card(self, word_card: WordCard):
+        self.word_cards_main.insert_first(word_card)
+        self.card_scheduler.add(word_card, False)
+        if self._word_card_index is not None:
+            self._word_card_index.add(word_card.identifier, word_card.texts())
+        self._card_changed(word_card)
+        self._word_cards_snapshot = None
+        self.record_change({"op": "addCard", "card": word_card.to_list()})
+
+    def add_word_cards(self, word_cards: List[WordCard]):
+        """
+        Appends the cards to the end of the main cards as one change, e.g. after a bulk import.
+        The search index is dropped rather than updated card by card; it's rebuilt on the next search.
+        """
+        if not word_cards:
+            return
+        self.word_cards_main.extend(word_cards)
+        for word_card in word_cards:
+            self.card_scheduler.add(word_card, False)
+            self._card_changed(word_card)
+        self._word_card_index = None
+        self._word_cards_snapshot = None
+        self.record_change({"op": "addCards", "cards": [word_card.to_list() for word_card in word_cards]})
+        if self.storage:
+            # The journal would otherwise carry the whole batch until the next compaction
+            self.storage.request_compaction()
+
 
-def parse_node(data) -> Node:
+def parse_node(data, archive: Optional[Archive] = None) -> Node:
     node_type = data.get("type")
     if node_type == "dialog":
-        result = Dialog.from_data(data)
+        result = Dialog.from_data(data, packed=True)
+    elif node_type == "archived":
+        if archive is None:
+            raise Exception("Archived node without an archive")
+        summary = {"id": data.get("id", 0), "lastVisited": data.get("lastVisited", 0), "archived": True,
+                   "title": data.get("title", "")}
+        return ArchivedNodeStub(archive, data["address"], summary, partial(parse_node, archive=archive))
     elif node_type is None:
-        result = RootNode()
+        result = RootNode(data.get("nextNodeId", 1))
     else:
         raise Exception(f"Unknown node type: {node_type}")
+    result.node_id = data.get("id", 0)
     child_nodes = data.get("nodes")
     if child_nodes:
         for child in child_nodes:
-            result.add_child(parse_node(child))
+            result.add_child(parse_node(child, archive))
         result.child_index = data["childIndex"]
     return result
 
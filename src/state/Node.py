@@ -3,12 +3,23 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 from typing import Any, Dict, List, Optional
 
+from state.Snapshot import NodeSnapshot
+
 
 class Node(ABC):
     def __init__(self):
+        # Stable identity of the node, saved as "id". 0 until the node is registered with a RootNode
+        self.node_id = 0
         self.nodes: List[Node] = []
         self.child_index = -1
         self.parent: Optional[Node] = None
+        self.index_in_parent = -1
+        # Unix time of the last visit, tracked for root children only, see Learning.visit. 0 if unknown
+        self.last_visited = 0
+        self._snapshot: Optional[NodeSnapshot] = None
+        self._child_snapshots: List[NodeSnapshot] = []
+        # Indexes of children whose snapshots in _child_snapshots are out of date
+        self._dirty_children = set()
 
     @abstractmethod
     def prepare_specific_json_object(self) -> Dict[str, Any]:
@@ -18,12 +29,18 @@ class Node(ABC):
         """
         pass
 
+    def specific_json_object(self) -> Dict[str, Any]:
+        json_object = self.prepare_specific_json_object()
+        if self.node_id:
+            json_object["id"] = self.node_id
+        return json_object
+
     def prepare_json_object(self) -> Dict[str, Any]:
         """
         Prepare the JSON object for the current node, including the JSON objects for its child nodes.
         """
         # Call the implementation-specific method to get the JSON object for the current node
-        json_object = self.prepare_specific_json_object()
+        json_object = self.specific_json_object()
 
         if self.nodes:
             # Prepare the JSON objects for the child nodes and add them to the 'nodes' property
@@ -32,10 +49,115 @@ class Node(ABC):
 
         return json_object
 
+    def snapshot(self) -> NodeSnapshot:
+        """
+        Returns an immutable snapshot of this subtree. Clean subtrees return their cached snapshot,
+        so after a change only the path from the changed node to the root is rebuilt.
+        """
+        if self._snapshot is None:
+            child_snapshots = self._child_snapshots
+            for index in self._dirty_children:
+                if index < len(child_snapshots):
+                    child_snapshots[index] = self.nodes[index].snapshot()
+            self._dirty_children.clear()
+            for child in self.nodes[len(child_snapshots):]:
+                child_snapshots.append(child.snapshot())
+            self._snapshot = NodeSnapshot(self.specific_json_object(), tuple(child_snapshots), self.child_index)
+        return self._snapshot
+
+    def is_dirty(self) -> bool:
+        return self._snapshot is None
+
+    def mark_dirty(self):
+        """
+        Must be called after any change to the node's state, so the next snapshot and save pick it up.
+        Only the dirty nodes are snapshotted and encoded again, see NodeSnapshot.
+        """
+        node = self
+        while node is not None:
+            node._snapshot = None
+            if node.parent is not None:
+                node.parent._dirty_children.add(node.index_in_parent)
+            node = node.parent
+
     def add_child(self, child: Node):
         self.nodes.append(child)
         child.child_index = len(self.nodes) - 1
+        child.index_in_parent = len(self.nodes) - 1
         child.parent = self
+        child.mark_dirty()
+        self.root().register(child)
+
+    def root(self) -> Node:
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        return node
+
+    def register(self, node: Node):
+        """
+        Called on the root of the tree whenever a subtree is attached to it, see RootNode.
+        """
+        pass
+
+    def title(self) -> str:
+        return ""
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        What lists of nodes show, in the format of Snapshot.summarize.
+        """
+        return {"id": self.node_id, "lastVisited": self.last_visited, "archived": self.is_archived(),
+                "title": self.title()}
+
+    def path(self) -> List[int]:
+        """
+        The positions of this node and its ancestors in their parents, starting from the root.
+        Nodes are only ever appended, so a path stays valid for the lifetime of the tree.
+        """
+        result = []
+        node = self
+        while node.parent is not None:
+            result.append(node.index_in_parent)
+            node = node.parent
+        result.reverse()
+        return result
+
+    def node_at(self, path: List[int]) -> Node:
+        node = self
+        for index in path:
+            node = node.child(index)
+        return node
+
+    def is_loaded(self) -> bool:
+        """
+        False for placeholders of subtrees that have not been parsed yet, see NodeStub and ArchivedNodeStub.
+        """
+        return True
+
+    def is_archived(self) -> bool:
+        return False
+
+    def load(self) -> Node:
+        return self
+
+    def child(self, index) -> Node:
+        """
+        Returns the child at index, loading it first if it is still a placeholder.
+        """
+        node = self.nodes[index]
+        if not node.is_loaded():
+            # A lazily loaded child may turn out to be archived, which takes a second step
+            while not node.is_loaded():
+                node = node.load()
+            self.nodes[index] = node
+            node.index_in_parent = index
+            node.parent = self
+            self.root().register(node)
+        return node
+
+    def current_child(self) -> Node:
+        return self.child(self.child_index)
 
     def is_first_parents_child(self):
         return self.parent.is_first_child(self)
@@ -56,3 +178,5 @@ class Node(ABC):
         elif new_child_index >= len(self.nodes):
             raise ValueError(f"new_child_index {new_child_index} >= len(self.nodes) which is {len(self.nodes)}")
         self.child_index = new_child_index
+        self.mark_dirty()
+        self.child(new_child_index)
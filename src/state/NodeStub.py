@@ -0,0 +1,85 @@
+import json
+from typing import Any, Callable, Dict, List
+
+from state.Archive import Archive
+from state.Node import Node
+from state.Snapshot import SnapshotSource, RawNodeSnapshot, ArchivedNodeSnapshot
+
+
+class NodeStub(Node):
+    """
+    Placeholder for a root child of a lazily loaded snapshot file, see SnapshotSource.
+    Its parent replaces it with the parsed subtree the first time the child is accessed through Node.child().
+    """
+
+    def __init__(self, source: SnapshotSource, key: int, parse_node: Callable[[Dict[str, Any]], Node]):
+        super().__init__()
+        self.source = source
+        self.key = key
+        self.parse_node = parse_node
+        summary = source.summary(key)
+        self.node_id = summary["id"]
+        self.last_visited = summary["lastVisited"]
+
+    def is_loaded(self) -> bool:
+        return False
+
+    def is_archived(self) -> bool:
+        return self.source.summary(self.key)["archived"]
+
+    def summary(self) -> Dict[str, Any]:
+        return self.source.summary(self.key)
+
+    def load(self) -> Node:
+        return self.parse_node(json.loads(self.source.read(self.key)))
+
+    def prepare_specific_json_object(self) -> Dict[str, Any]:
+        json_object = self.prepare_json_object()
+        json_object.pop('nodes', None)
+        json_object.pop('childIndex', None)
+        return json_object
+
+    def prepare_json_object(self) -> Dict[str, Any]:
+        return json.loads(self.source.read(self.key))
+
+    def snapshot(self) -> RawNodeSnapshot:
+        return RawNodeSnapshot(self.source, self.key)
+
+
+class ArchivedNodeStub(Node):
+    """
+    Placeholder for a root child that was moved to the Archive. It is decompressed and parsed the first time
+    the child is accessed through Node.child(), and goes back into the snapshot file once it changes,
+    e.g. when it is visited.
+    """
+
+    def __init__(self, archive: Archive, address: List[int], summary: Dict[str, Any],
+                 parse_node: Callable[[Dict[str, Any]], Node]):
+        super().__init__()
+        self.archive = archive
+        self.address = address
+        self.node_id = summary["id"]
+        self.last_visited = summary["lastVisited"]
+        self.parse_node = parse_node
+        self._archived_snapshot = ArchivedNodeSnapshot(archive, address, summary)
+
+    def is_loaded(self) -> bool:
+        return False
+
+    def is_archived(self) -> bool:
+        return True
+
+    def load(self) -> Node:
+        return self.parse_node(json.loads(self.archive.read(self.address)))
+
+    def prepare_specific_json_object(self) -> Dict[str, Any]:
+        return self._archived_snapshot.stub_json_object()
+
+    def summary(self) -> Dict[str, Any]:
+        return self._archived_snapshot.summary
+
+    def prepare_json_object(self) -> Dict[str, Any]:
+        return self._archived_snapshot.to_json_object()
+
+    def snapshot(self) -> ArchivedNodeSnapshot:
+        return self._archived_snapshot
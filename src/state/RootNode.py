@@ -5,7 +5,37 @@ from state.Node import Node
 
 class RootNode(Node):
     def prepare_specific_json_object(self) -> Dict[str, Any]:
-        return {}
+        return {"nextNodeId": self.next_node_id}
 
-    def __init__(self):
+    def __init__(self, next_node_id=1):
         super().__init__()
+        self.next_node_id = next_node_id
+        # Every registered node by its node_id, including NodeStubs for subtrees that are not loaded yet
+        self.nodes_by_id: Dict[int, Node] = {}
+        # How many nodes got their id from register, e.g. because they come from a file written before there were ids
+        self.assigned_node_ids = 0
+
+    def register(self, node: Node):
+        """
+        Adds the subtree to nodes_by_id, giving ids to the nodes that don't have one yet.
+        Loaded stubs are registered again, replacing the stub by the parsed node.
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if not node.node_id:
+                node.node_id = self.next_node_id
+                self.next_node_id += 1
+                self.assigned_node_ids += 1
+                node.mark_dirty()
+            elif node.node_id >= self.next_node_id:
+                self.next_node_id = node.node_id + 1
+                self.mark_dirty()
+            self.nodes_by_id[node.node_id] = node
+            stack.extend(node.nodes)
+
+    def node_by_id(self, node_id: int) -> Node:
+        """
+        Raises KeyError if there is no such node, or it is inside a subtree that has not been loaded yet.
+        """
+        return self.nodes_by_id[node_id]
@@ -0,0 +1,375 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.file_utils import write_bytes_atomically, write_json_atomically
+
+INDEX_SUFFIX = ".index"
+# Titles of dialogs in node lists and in the index are cut to this length
+TITLE_LENGTH = 80
+
+
+def make_title(context: Optional[str]) -> str:
+    return (context or "").strip().split("\n", 1)[0][:TITLE_LENGTH]
+
+
+def summarize(specific: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    What the index stores about a root child, so that it can be listed, found by id and archived without parsing it.
+    Same format as Node.summary.
+    """
+    return {
+        "id": specific.get("id", 0),
+        "lastVisited": specific.get("lastVisited", 0),
+        "archived": False,
+        "title": make_title(specific.get("context"))
+    }
+
+
+class SnapshotSource:
+    """
+    Gives access to the root children of a snapshot file by the byte ranges stored in its index sidecar,
+    so that they can be parsed only when needed.
+
+    Children are keyed by their position under the root, which never changes.
+    When the snapshot file is rewritten, the writer rebinds the source to the new offsets under the lock.
+    """
+
+    def __init__(self, file_path: str, index: Dict[str, Any]):
+        self.file_path = file_path
+        self.index = index
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, file_path: str) -> Optional["SnapshotSource"]:
+        """
+        Returns None if there's no index or it doesn't match the file, e.g. because the file was edited by hand
+        or written before the index had summaries.
+        """
+        try:
+            with open(file_path + INDEX_SUFFIX, 'r', encoding='utf-8') as index_file:
+                index = json.load(index_file)
+            stat = os.stat(file_path)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if index.get("size") != stat.st_size or index.get("mtimeNs") != stat.st_mtime_ns or "summaries" not in index:
+            print(f"Index of {file_path} is out of date")
+            return None
+        return cls(file_path, index)
+
+    def child_count(self) -> int:
+        return len(self.index["children"])
+
+    def read_header(self) -> Dict[str, Any]:
+        """
+        Parses everything in the file except the root children.
+        """
+        with self.lock:
+            with open(self.file_path, 'rb') as file:
+                prefix = file.read(self.index["childrenStart"])
+                file.seek(self.index["childrenEnd"])
+                suffix = file.read()
+        return json.loads(prefix + suffix)
+
+    def read(self, key: int) -> bytes:
+        return self.read_many([key])[key]
+
+    def summary(self, key: int) -> Dict[str, Any]:
+        """
+        The summary of the child, see summarize, without reading it.
+        """
+        return self.index["summaries"][key]
+
+    def read_many(self, keys: List[int]) -> Dict[int, bytes]:
+        result = {}
+        with self.lock:
+            children = self.index["children"]
+            with open(self.file_path, 'rb') as file:
+                for key in keys:
+                    offset, length = children[key]
+                    file.seek(offset)
+                    result[key] = file.read(length)
+        return result
+
+    def rebind(self, index: Dict[str, Any]):
+        """
+        Must be called under the lock, together with replacing the file.
+        """
+        self.index = index
+
+
+class NodeSnapshot:
+    """
+    Immutable view of a Node at the time it was taken.
+
+    Nodes cache their snapshot until they are marked dirty, so a snapshot of an unchanged subtree
+    is shared between consecutive snapshots and taking a new one only rebuilds the dirty path.
+    The encoded JSON is cached on the snapshot as well, so writing the file only encodes the dirty nodes
+    and splices in the bytes of everything else.
+    """
+    __slots__ = ("specific", "children", "child_index", "_encoded")
+
+    def __init__(self, specific: Dict[str, Any], children: Tuple["NodeSnapshot", ...], child_index: int):
+        self.specific = specific
+        self.children = children
+        self.child_index = child_index
+        self._encoded: Optional[bytes] = None
+
+    def to_json_object(self) -> Dict[str, Any]:
+        json_object = dict(self.specific)
+        if self.children:
+            json_object['nodes'] = [child.to_json_object() for child in self.children]
+            json_object['childIndex'] = self.child_index
+        return json_object
+
+    def encode(self) -> bytes:
+        if self._encoded is None:
+            members = _encode_members(self.specific)
+            if self.children:
+                members.append(b'"nodes": [' + b", ".join(child.encode() for child in self.children) + b"]")
+                members.append(b'"childIndex": ' + _encode(self.child_index))
+            self._encoded = b"{" + b", ".join(members) + b"}"
+        return self._encoded
+
+
+class RawNodeSnapshot:
+    """
+    Snapshot of a subtree that was never loaded, see NodeStub. It is written back as the bytes it was read from.
+    """
+    __slots__ = ("source", "key")
+
+    def __init__(self, source: SnapshotSource, key: int):
+        self.source = source
+        self.key = key
+
+    def to_json_object(self) -> Dict[str, Any]:
+        return json.loads(self.encode())
+
+    def encode(self) -> bytes:
+        return self.source.read(self.key)
+
+
+class ArchivedNodeSnapshot:
+    """
+    Snapshot of a subtree that was moved to the Archive. Only the stub pointing to it is written to the snapshot file,
+    but to_json_object returns the archived subtree, so that e.g. migrations get the full tree.
+    """
+    __slots__ = ("archive", "address", "summary", "_encoded")
+
+    def __init__(self, archive, address: List[int], summary: Dict[str, Any]):
+        self.archive = archive
+        self.address = address
+        self.summary = summary
+        self._encoded: Optional[bytes] = None
+
+    def stub_json_object(self) -> Dict[str, Any]:
+        return {"type": "archived", "address": self.address, "id": self.summary["id"],
+                "lastVisited": self.summary["lastVisited"], "title": self.summary["title"]}
+
+    def to_json_object(self) -> Dict[str, Any]:
+        return json.loads(self.archive.read(self.address))
+
+    def encode(self) -> bytes:
+        if self._encoded is None:
+            self._encoded = _encode(self.stub_json_object())
+        return self._encoded
+
+
+class WordCardsSnapshot:
+    """
+    Immutable copy of a list of word cards as WordCard.to_list rows, taken on the GUI thread, which keeps
+    changing the cards while a worker encodes the snapshot. The rows are never modified, so Learning shares
+    the ones of unchanged cards between snapshots. Learning reuses the snapshot until the list changes,
+    so its encoded JSON is cached the same way as for NodeSnapshot.
+    """
+    __slots__ = ("rows", "_encoded")
+
+    def __init__(self, rows: Tuple[list, ...]):
+        self.rows = rows
+        self._encoded: Optional[bytes] = None
+
+    def to_json_object(self) -> List[list]:
+        return [list(row) for row in self.rows]
+
+    def encode(self) -> bytes:
+        if self._encoded is None:
+            # One card per line keeps long card lists readable and diffable
+            self._encoded = b"[\n" + b",\n".join(_encode(row) for row in self.rows) + b"\n]" \
+                if self.rows else b"[]"
+        return self._encoded
+
+
+class LearningSnapshot:
+    __slots__ = ("language", "second_language", "root", "word_cards_focused", "word_cards_main",
+                 "create_dialog_settings", "journal_seq", "source")
+
+    def __init__(self, language: str, second_language: str, root: NodeSnapshot,
+                 word_cards_focused: WordCardsSnapshot, word_cards_main: WordCardsSnapshot,
+                 create_dialog_settings: Dict[str, Any], journal_seq: int, source: Optional[SnapshotSource]):
+        self.language = language
+        self.second_language = second_language
+        self.root = root
+        self.word_cards_focused = word_cards_focused
+        self.word_cards_main = word_cards_main
+        self.create_dialog_settings = create_dialog_settings
+        self.journal_seq = journal_seq
+        self.source = source
+
+    def to_json_object(self) -> Dict[str, Any]:
+        json_object = {
+            "language": self.language,
+            "secondLanguage": self.second_language,
+            "root": self.root.to_json_object(),
+            "wordCardsFocused": self.word_cards_focused.to_json_object(),
+            "wordCardsMain": self.word_cards_main.to_json_object(),
+            "createDialogSettings": self.create_dialog_settings
+        }
+        if self.journal_seq:
+            json_object["journalSeq"] = self.journal_seq
+        return json_object
+
+    def encode_header(self) -> bytes:
+        """
+        Everything except the root node, as JSON object members.
+        """
+        members = _encode_members({"language": self.language, "secondLanguage": self.second_language})
+        members.append(b'"wordCardsFocused": ' + self.word_cards_focused.encode())
+        members.append(b'"wordCardsMain": ' + self.word_cards_main.encode())
+        members.append(b'"createDialogSettings": ' + _encode(self.create_dialog_settings))
+        if self.journal_seq:
+            members.append(b'"journalSeq": ' + _encode(self.journal_seq))
+        return b",\n".join(members)
+
+
+def _encode(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def _encode_members(json_object: Dict[str, Any]) -> List[bytes]:
+    return [_encode(key) + b": " + _encode(value) for key, value in json_object.items()]
+
+
+def _summary(child) -> Dict[str, Any]:
+    if isinstance(child, RawNodeSnapshot):
+        return child.source.summary(child.key)
+    elif isinstance(child, ArchivedNodeSnapshot):
+        return child.summary
+    return summarize(child.specific)
+
+
+def encode_snapshot(snapshot: LearningSnapshot) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Returns the file contents and the index entries of the root children, see write_snapshot.
+    """
+    root = snapshot.root
+    root_members = _encode_members(root.specific)
+    root_members.append(b'"childIndex": ' + _encode(root.child_index))
+    root_prefix = b"{" + b", ".join(root_members) + b', "nodes": [\n'
+
+    # Read the children that were never loaded in one go, instead of reopening the file for each of them
+    raw_children = {}
+    for child in root.children:
+        if isinstance(child, RawNodeSnapshot):
+            raw_children.setdefault(child.source, []).append(child.key)
+    raw_bytes = {source: source.read_many(keys) for source, keys in raw_children.items()}
+
+    parts = [b"{\n", snapshot.encode_header(), b',\n"root": ', root_prefix]
+    position = sum(len(part) for part in parts)
+    children_start = position
+    children = []
+    summaries = []
+    for i, child in enumerate(root.children):
+        if i > 0:
+            parts.append(b",\n")
+            position += 2
+        if isinstance(child, RawNodeSnapshot):
+            encoded = raw_bytes[child.source][child.key]
+        else:
+            encoded = child.encode()
+        parts.append(encoded)
+        children.append([position, len(encoded)])
+        summaries.append(_summary(child))
+        position += len(encoded)
+    children_end = position
+    parts.append(b"\n]}\n}\n")
+    index = {
+        "childrenStart": children_start,
+        "childrenEnd": children_end,
+        "children": children,
+        "summaries": summaries
+    }
+    return b"".join(parts), index
+
+
+def write_snapshot(snapshot: LearningSnapshot, file_path: str) -> int:
+    """
+    Serializes the snapshot and atomically replaces file_path with it. Safe to call from any thread.
+
+    The root children are written last, one per line, and their byte ranges are stored in the index sidecar
+    (file_path + INDEX_SUFFIX), so the file can be loaded lazily, see SnapshotSource.
+    Returns the number of bytes written.
+    """
+    data, index = encode_snapshot(snapshot)
+
+    source = snapshot.source if snapshot.source and snapshot.source.file_path == file_path else None
+    if source:
+        # Stubs must not read the new file with the old offsets
+        source.lock.acquire()
+    try:
+        written = write_bytes_atomically(file_path, data)
+        stat = os.stat(file_path)
+        index = {"size": stat.st_size, "mtimeNs": stat.st_mtime_ns, **index}
+        if source:
+            source.rebind(index)
+    finally:
+        if source:
+            source.lock.release()
+    written += write_json_atomically(file_path + INDEX_SUFFIX, index)
+    return written
+
+
+def do_main():
+    from state.Dialog import Dialog, DialogType, ApiType, Interlocutor, Sentence
+    from state.Learning import Learning
+    from state.RootNode import RootNode
+    from state.Dialog import CreateDialogSettings
+
+    learning = Learning("tr", "en", RootNode(), [], [], CreateDialogSettings())
+    for i in range(10_000):
+        learning.add_root_node(Dialog(
+            DialogType.LISTEN, ApiType.GEMINI,
+            [Interlocutor("friend", "Ali", "m", "tr-TR-AhmetNeural"),
+             Interlocutor("friend", "Ayşe", "f", "tr-TR-EmelNeural")],
+            0,
+            [Sentence("Ali" if j % 2 == 0 else "Ayşe", f"Cümle {i}.{j}", f"Sentence {i}.{j}") for j in range(12)],
+            f"Context {i}",
+            []
+        ))
+
+    start = time.perf_counter()
+    learning.snapshot()
+    print(f"First snapshot: {(time.perf_counter() - start) * 1000:.3f} ms")
+
+    pauses = []
+    for i in range(100):
+        learning.navigate_dialog(learning.root_node.nodes[i * 37], 1)
+        start = time.perf_counter()
+        learning.snapshot()
+        pauses.append(time.perf_counter() - start)
+    pauses.sort()
+    print(f"Snapshot after a navigation: median {pauses[50] * 1000:.3f} ms, max {pauses[-1] * 1000:.3f} ms")
+
+    encode_snapshot(learning.snapshot())
+    for dirty_count in (0, 1, 10, 100, 1000, 10_000):
+        for i in range(dirty_count):
+            dialog = learning.root_node.nodes[i]
+            learning.navigate_dialog(dialog, 1 if dialog.current_position == 0 else -1)
+        start = time.process_time()
+        encode_snapshot(learning.snapshot())
+        print(f"Snapshot and encoding with {dirty_count} dirty dialogs: {(time.process_time() - start) * 1000:.3f} ms CPU")
+
+
+if __name__ == '__main__':
+    do_main()
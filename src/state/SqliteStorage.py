@@ -0,0 +1,367 @@
+import json
+import sqlite3
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from state.Dialog import CreateDialogSettings
+from state.Learning import Learning, parse_node
+from state.NodeStub import NodeStub
+from state.RootNode import RootNode
+from state.Snapshot import summarize
+from state.Storage import Storage
+from state.WordCard import WordCard
+
+SQLITE_SUFFIXES = (".sqlite", ".db")
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS nodes (
+        id INTEGER PRIMARY KEY,
+        parent_id INTEGER,
+        position INTEGER NOT NULL,
+        child_index INTEGER NOT NULL,
+        current_position INTEGER,
+        -- The rest of the node's JSON object, without the columns and the child tables
+        data TEXT NOT NULL
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS nodes_by_parent ON nodes (parent_id, position);
+    CREATE TABLE IF NOT EXISTS interlocutors (
+        node_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        type TEXT,
+        name TEXT,
+        gender TEXT,
+        voice TEXT,
+        PRIMARY KEY (node_id, position)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS sentences (
+        node_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        who TEXT,
+        sentence TEXT,
+        translation TEXT,
+        PRIMARY KEY (node_id, position)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS word_cards (
+        identifier TEXT PRIMARY KEY,
+        focused INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        word TEXT,
+        word_comment TEXT,
+        translation TEXT,
+        translation_comment TEXT,
+        due INTEGER NOT NULL DEFAULT 0,
+        stability REAL NOT NULL DEFAULT 0,
+        exposures INTEGER NOT NULL DEFAULT 0,
+        last_seen INTEGER NOT NULL DEFAULT 0,
+        deck TEXT NOT NULL DEFAULT '',
+        tags TEXT NOT NULL DEFAULT '[]'
+    );
+    CREATE INDEX IF NOT EXISTS word_cards_by_order ON word_cards (focused, position);
+'''
+
+
+def is_sqlite_file(file_path: str) -> bool:
+    return file_path.endswith(SQLITE_SUFFIXES)
+
+
+class SqliteStorage(Storage):
+    """
+    Keeps a Learning in SQLite tables instead of a single JSON document.
+
+    Every recorded change is applied in its own transaction, so there is nothing left to do when the
+    SaveService fires except for the dialog creation settings, which are edited in place.
+    Root children are loaded lazily through NodeStubs keyed by node id, see read().
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        # Stubs and writers look for these, see SnapshotSource
+        self.file_path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+        self.add_missing_columns()
+        # Node paths resolved so far; positions never change, so the ids stay valid
+        self.node_ids: Dict[tuple, int] = {}
+        # Summaries of the root children by row id, read once on load
+        self.summaries: Dict[int, Dict[str, Any]] = {}
+
+    def add_missing_columns(self):
+        """
+        Brings databases created by older versions up to the schema.
+        """
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(word_cards)")}
+        with self.connection:
+            for column, definition in (("due", "INTEGER NOT NULL DEFAULT 0"),
+                                       ("stability", "REAL NOT NULL DEFAULT 0"),
+                                       ("exposures", "INTEGER NOT NULL DEFAULT 0"),
+                                       ("last_seen", "INTEGER NOT NULL DEFAULT 0"),
+                                       ("deck", "TEXT NOT NULL DEFAULT ''"),
+                                       ("tags", "TEXT NOT NULL DEFAULT '[]'")):
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE word_cards ADD COLUMN {column} {definition}")
+
+    def close(self):
+        self.connection.close()
+
+    # Loading
+
+    def load(self) -> Learning:
+        with self.lock:
+            meta = dict(self.connection.execute("SELECT key, value FROM meta"))
+            root_id = self.node_id(())
+            root_node = RootNode(self.next_node_id())
+            children = self.connection.execute(
+                "SELECT id, data FROM nodes WHERE parent_id = ? ORDER BY position", (root_id,)).fetchall()
+            for child_id, data in children:
+                self.summaries[child_id] = summarize(self.with_node_id(json.loads(data), child_id))
+            for child_id, _ in children:
+                root_node.add_child(NodeStub(self, child_id, parse_node))
+            if root_node.nodes:
+                root_node.child_index = self.connection.execute(
+                    "SELECT child_index FROM nodes WHERE id = ?", (root_id,)).fetchone()[0]
+
+            learning = Learning(
+                meta["language"],
+                meta.get("secondLanguage", "en"),
+                root_node,
+                self.load_word_cards(True),
+                self.load_word_cards(False),
+                CreateDialogSettings.from_data(json.loads(meta.get("createDialogSettings", "{}")))
+            )
+        learning.source = self
+        learning.storage = self
+        if root_node.nodes:
+            root_node.current_child()
+        return learning
+
+    def load_word_cards(self, focused: bool) -> List[WordCard]:
+        return [WordCard(*row[:-1], json.loads(row[-1])) for row in self.connection.execute(
+            "SELECT identifier, word, word_comment, translation, translation_comment, due, stability, exposures, "
+            "last_seen, deck, tags FROM word_cards WHERE focused = ? ORDER BY position", (int(focused),))]
+
+    def read(self, key: int) -> bytes:
+        """
+        The JSON of the subtree with the node id, in the format Learning.parse_node expects.
+        """
+        with self.lock:
+            return json.dumps(self.read_json_object(key), ensure_ascii=False).encode('utf-8')
+
+    def read_many(self, keys: List[int]) -> Dict[int, bytes]:
+        return {key: self.read(key) for key in keys}
+
+    def summary(self, key: int) -> Dict[str, Any]:
+        return self.summaries[key]
+
+    def next_node_id(self) -> int:
+        """
+        Node ids are stored in the data column; nodes imported before there were node ids use their row id instead.
+        """
+        row_id, data_id = self.connection.execute(
+            "SELECT MAX(id), MAX(json_extract(data, '$.id')) FROM nodes").fetchone()
+        return max(row_id or 0, data_id or 0) + 1
+
+    @staticmethod
+    def with_node_id(json_object: Dict[str, Any], row_id: int) -> Dict[str, Any]:
+        json_object.setdefault("id", row_id)
+        return json_object
+
+    def read_json_object(self, node_id: int) -> Dict[str, Any]:
+        child_index, current_position, data = self.connection.execute(
+            "SELECT child_index, current_position, data FROM nodes WHERE id = ?", (node_id,)).fetchone()
+        json_object = self.with_node_id(json.loads(data), node_id)
+        if current_position is not None:
+            json_object["currentPosition"] = current_position
+            json_object["interlocutors"] = [list(row) for row in self.connection.execute(
+                "SELECT type, name, gender, voice FROM interlocutors WHERE node_id = ? ORDER BY position",
+                (node_id,))]
+            json_object["content"] = [list(row) for row in self.connection.execute(
+                "SELECT who, sentence, translation FROM sentences WHERE node_id = ? ORDER BY position",
+                (node_id,))]
+        children = self.connection.execute(
+            "SELECT id FROM nodes WHERE parent_id = ? ORDER BY position", (node_id,)).fetchall()
+        if children:
+            json_object["nodes"] = [self.read_json_object(child_id) for (child_id,) in children]
+            json_object["childIndex"] = child_index
+        return json_object
+
+    def node_id(self, path) -> int:
+        """
+        Resolves a Node.path() through the (parent_id, position) index. The root has the empty path.
+        """
+        path = tuple(path)
+        node_id = self.node_ids.get(path)
+        if node_id is None:
+            if path:
+                row = self.connection.execute(
+                    "SELECT id FROM nodes WHERE parent_id = ? AND position = ?",
+                    (self.node_id(path[:-1]), path[-1])).fetchone()
+            else:
+                row = self.connection.execute("SELECT id FROM nodes WHERE parent_id IS NULL").fetchone()
+            node_id = row[0]
+            self.node_ids[path] = node_id
+        return node_id
+
+    # Writing
+
+    def record(self, change: dict):
+        op = change["op"]
+        with self.lock, self.connection:
+            if op == "navigate":
+                self.connection.execute("UPDATE nodes SET current_position = ? WHERE id = ?",
+                                        (change["position"], self.node_id(change["path"])))
+            elif op == "treeNavigate":
+                self.connection.execute("UPDATE nodes SET child_index = ? WHERE id = ?",
+                                        (change["childIndex"], self.node_id(change["path"])))
+            elif op == "addNode":
+                root_id = self.node_id(())
+                position = self.connection.execute(
+                    "SELECT COUNT(*) FROM nodes WHERE parent_id = ?", (root_id,)).fetchone()[0]
+                self.insert_node(change["node"], root_id, position)
+                self.connection.execute("UPDATE nodes SET child_index = ? WHERE id = ?", (position, root_id))
+            elif op == "toggleFocus":
+                row = self.connection.execute(
+                    "SELECT focused FROM word_cards WHERE identifier = ?", (change["id"],)).fetchone()
+                if row:
+                    if row[0]:
+                        self.move_card(change["id"], False, to_end=True)
+                    else:
+                        self.move_card(change["id"], True, to_end=False)
+            elif op == "moveToEnd":
+                row = self.connection.execute(
+                    "SELECT focused FROM word_cards WHERE identifier = ?", (change["id"],)).fetchone()
+                if row:
+                    self.move_card(change["id"], bool(row[0]), to_end=True)
+            elif op == "addCard":
+                self.insert_word_card(WordCard.from_list(change["card"]), False, self.edge_position(False, False))
+            elif op == "addCards":
+                self.insert_word_cards([WordCard.from_list(card) for card in change["cards"]], False,
+                                       self.edge_position(False, True))
+            elif op == "schedule":
+                self.connection.execute(
+                    "UPDATE word_cards SET due = ?, stability = ?, exposures = ?, last_seen = ? WHERE identifier = ?",
+                    (change["due"], change["stability"], change["exposures"], change.get("lastSeen", 0), change["id"]))
+            elif op == "editCard":
+                word_card = WordCard.from_list(change["card"])
+                self.connection.execute(
+                    "UPDATE word_cards SET word = ?, word_comment = ?, translation = ?, translation_comment = ?, "
+                    "deck = ?, tags = ? WHERE identifier = ?",
+                    (*word_card.texts(), word_card.deck, json.dumps(list(word_card.tags), ensure_ascii=False),
+                     word_card.identifier))
+            elif op == "labels":
+                self.connection.execute(
+                    "UPDATE word_cards SET deck = ?, tags = ? WHERE identifier = ?",
+                    (change["deck"], json.dumps(change["tags"], ensure_ascii=False), change["id"]))
+            else:
+                raise Exception(f"Unknown journal op: {op}")
+
+    def edge_position(self, focused: bool, to_end: bool) -> int:
+        """
+        A position before the first or after the last card of the list, found through the order index.
+        """
+        aggregate = "MAX(position) + 1" if to_end else "MIN(position) - 1"
+        position = self.connection.execute(
+            f"SELECT {aggregate} FROM word_cards WHERE focused = ?", (int(focused),)).fetchone()[0]
+        return 0 if position is None else position
+
+    def move_card(self, identifier: str, focused: bool, to_end: bool):
+        position = self.edge_position(focused, to_end)
+        self.connection.execute("UPDATE word_cards SET focused = ?, position = ? WHERE identifier = ?",
+                                (int(focused), position, identifier))
+
+    def insert_word_card(self, word_card: WordCard, focused: bool, position: int):
+        self.insert_word_cards([word_card], focused, position)
+
+    def insert_word_cards(self, word_cards: List[WordCard], focused: bool, first_position: int):
+        self.connection.executemany(
+            "INSERT INTO word_cards (identifier, focused, position, word, word_comment, translation, translation_comment, "
+            "due, stability, exposures, last_seen, deck, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(word_card.identifier, int(focused), first_position + i, word_card.word, word_card.word_comment,
+              word_card.translation, word_card.translation_comment,
+              word_card.due, word_card.stability, word_card.exposures, word_card.last_seen, word_card.deck,
+              json.dumps(list(word_card.tags), ensure_ascii=False))
+             for i, word_card in enumerate(word_cards)])
+
+    def insert_node(self, json_object: Dict[str, Any], parent_id: Optional[int], position: int) -> int:
+        json_object = dict(json_object)
+        child_nodes = json_object.pop("nodes", [])
+        child_index = json_object.pop("childIndex", -1)
+        current_position = json_object.pop("currentPosition", None)
+        interlocutors = json_object.pop("interlocutors", [])
+        content = json_object.pop("content", [])
+        cursor = self.connection.execute(
+            "INSERT INTO nodes (parent_id, position, child_index, current_position, data) VALUES (?, ?, ?, ?, ?)",
+            (parent_id, position, child_index, current_position, json.dumps(json_object, ensure_ascii=False)))
+        node_id = cursor.lastrowid
+        self.connection.executemany(
+            "INSERT INTO interlocutors (node_id, position, type, name, gender, voice) VALUES (?, ?, ?, ?, ?, ?)",
+            [(node_id, i, *interlocutor) for i, interlocutor in enumerate(interlocutors)])
+        self.connection.executemany(
+            "INSERT INTO sentences (node_id, position, who, sentence, translation) VALUES (?, ?, ?, ?, ?)",
+            [(node_id, i, *sentence) for i, sentence in enumerate(content)])
+        for i, child in enumerate(child_nodes):
+            self.insert_node(child, node_id, i)
+        return node_id
+
+    def set_meta(self, key: str, value: str):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def prepare_save(self, learning) -> Callable[[], int]:
+        settings = json.dumps(learning.create_dialog_settings.to_data())
+
+        def save_settings():
+            with self.lock, self.connection:
+                self.set_meta("createDialogSettings", settings)
+            return len(settings)
+
+        return save_settings
+
+    # Migration
+
+    def import_learning(self, learning: Learning):
+        """
+        Replaces the contents of the database with the learning, in one transaction.
+        """
+        json_object = learning.prepare_json_object()
+        with self.lock, self.connection:
+            for table in ("meta", "nodes", "interlocutors", "sentences", "word_cards"):
+                self.connection.execute(f"DELETE FROM {table}")
+            self.node_ids.clear()
+            self.set_meta("language", json_object["language"])
+            self.set_meta("secondLanguage", json_object["secondLanguage"])
+            self.set_meta("createDialogSettings", json.dumps(json_object["createDialogSettings"]))
+            self.insert_node(json_object["root"], None, 0)
+            for focused, key in ((True, "wordCardsFocused"), (False, "wordCardsMain")):
+                for position, card in enumerate(json_object[key]):
+                    self.insert_word_card(WordCard.from_list(card), focused, position)
+
+
+def load_learning(db_path: str) -> Learning:
+    return SqliteStorage(db_path).load()
+
+
+def migrate_json_to_sqlite(json_file_path: str, db_path: str):
+    """
+    Creates a database from a JSON learning file, including the changes in its journal.
+    """
+    storage = SqliteStorage(db_path)
+    storage.import_learning(Learning.from_json_file(json_file_path))
+    storage.close()
+
+
+def do_main():
+    if len(sys.argv) < 3:
+        print("Usage: python SqliteStorage.py <learning json> <database>")
+        sys.exit(1)
+    migrate_json_to_sqlite(sys.argv[1], sys.argv[2])
+
+
+if __name__ == '__main__':
+    do_main()
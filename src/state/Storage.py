@@ -0,0 +1,39 @@
+from abc import ABC, abstractmethod
+from typing import Callable
+
+
+class Storage(ABC):
+    """
+    Persistence backend of a Learning. The Learning reports every change through record()
+    and asks the storage to prepare a save when the SaveService fires.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @abstractmethod
+    def record(self, change: dict):
+        """
+        Called on the thread that owns the Learning right after the change was applied to it.
+        The change format is described in Learning.replay_change.
+        """
+        pass
+
+    @abstractmethod
+    def prepare_save(self, learning) -> Callable[[], int]:
+        """
+        Same contract as Learning.prepare_save.
+        """
+        pass
+
+    def request_compaction(self):
+        """
+        Asks for the whole snapshot to be rewritten on the next save, e.g. after Learning.archive_idle_dialogs.
+        """
+        pass
+
+    def journal_seq(self) -> int:
+        """
+        The seq to store in snapshots of the Learning, see Journal.
+        """
+        return 0
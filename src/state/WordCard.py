@@ -1,47 +1,52 @@
-from typing import List, Callable
-
-
 class WordCard:
-    def __init__(self, identifier: str, word: str, word_comment: str, translation: str, translation_comment: str):
+    __slots__ = ("identifier", "word", "word_comment", "translation", "translation_comment",
+                 "due", "stability", "exposures", "last_seen", "deck", "tags")
+
+    def __init__(self, identifier: str, word: str, word_comment: str, translation: str, translation_comment: str,
+                 due: int = 0, stability: float = 0.0, exposures: int = 0, last_seen: int = 0, deck: str = "",
+                 tags=()):
         self.identifier = identifier
         self.word = word
         self.word_comment = word_comment
         self.translation = translation
         self.translation_comment = translation_comment
+        # Spaced repetition state, see CardScheduler: unix time when the card is due (0 for new cards),
+        # stability in days and the number of dialogs the card was featured in
+        self.due = due
+        self.stability = stability
+        self.exposures = exposures
+        # Unix time of the last dialog the card was featured in, 0 if none
+        self.last_seen = last_seen
+        # Labels for filtering, see CardSets
+        self.deck = deck
+        self.tags = tuple(tags)
 
     @classmethod
     def from_list(cls, data: list):
-        if len(data) != 5:
-            raise ValueError("List must contain exactly 5 elements")
-        return cls(data[0], data[1], data[2], data[3], data[4])
+        """
+        Accepts the 5 text fields, optionally followed by due, stability and exposures,
+        and then optionally by last_seen, deck and tags.
+        """
+        if len(data) not in (5, 8, 11):
+            raise ValueError("List must contain exactly 5, 8 or 11 elements")
+        return cls(*data)
 
     def to_list(self):
-        return [self.identifier, self.word, self.word_comment, self.translation, self.translation_comment]
+        result = [self.identifier, self.word, self.word_comment, self.translation, self.translation_comment]
+        if self.last_seen or self.deck or self.tags:
+            result += [self.due, self.stability, self.exposures, self.last_seen, self.deck, list(self.tags)]
+        elif self.due or self.stability or self.exposures:
+            result += [self.due, self.stability, self.exposures]
+        return result
+
+    def texts(self):
+        """
+        The fields searched by the word card index, see Learning.word_card_index.
+        """
+        return self.word, self.word_comment, self.translation, self.translation_comment
 
     def __repr__(self):
         return (f"WordCard(identifier={self.identifier!r}, word={self.word!r}, "
                 f"word_comment={self.word_comment!r}, translation={self.translation!r}, "
                 f"translation_comment={self.translation_comment!r})")
 
-
-def move_card(cards: List[WordCard], identifier: str, position_func: Callable[[List[WordCard], WordCard], None]):
-    index = next((i for i, card in enumerate(cards) if card.identifier == identifier), None)
-    if index is not None:
-        card = cards.pop(index)
-        position_func(cards, card)
-
-
-def move_id_to_end(cards: List[WordCard], identifier: str):
-    move_card(cards, identifier, lambda cs, c: cs.append(c))
-
-
-def move_id_to_start(cards: List[WordCard], identifier: str):
-    move_card(cards, identifier, lambda cs, c: cs.insert(0, c))
-
-
-def pop_card(cards: List[WordCard], identifier: str):
-    index = next((i for i, card in enumerate(cards) if card.identifier == identifier), None)
-    if index is not None:
-        card = cards.pop(index)
-        return card
-    return None
@@ -0,0 +1,192 @@
+import csv
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+from dataclasses import dataclass
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from state.WordCard import WordCard
+from utils.search_utils import normalize
+from utils.time_utils import unique_ids_by_time
+
+# Rows read and turned into cards at a time
+BATCH_SIZE = 10_000
+
+JSON_LINES_SUFFIXES = (".jsonl", ".ndjson")
+TAB_SEPARATED_SUFFIXES = (".tsv", ".tab", ".txt")
+
+# Keys of JSON lines objects, in the camelCase of the snapshot files or in snake_case
+JSON_FIELDS = (("word",), ("wordComment", "word_comment"), ("translation",),
+               ("translationComment", "translation_comment"))
+
+# The word, word comment, translation and translation comment of a card to import
+CardFields = Tuple[str, str, str, str]
+
+
+@dataclass
+class ImportResult:
+    imported: int = 0
+    # Rows whose word and translation match an existing card or an earlier row
+    duplicates: int = 0
+    # Rows without a word or a translation, or with an unexpected number of columns
+    invalid: int = 0
+
+
+def card_key(word: str, translation: str) -> int:
+    """
+    Duplicate detection key: a 64-bit hash of the word and translation, ignoring case, diacritics and spacing.
+    Keeping hashes instead of the texts makes the set of seen keys small enough for millions of cards.
+    """
+    text = " ".join(normalize(word).split()) + "\t" + " ".join(normalize(translation).split())
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _fields_from_columns(columns: list) -> Optional[CardFields]:
+    """
+    Two columns are the word and the translation, four are the fields in the order of the word cards table.
+    """
+    columns = [column.strip() if isinstance(column, str) else "" for column in columns]
+    if len(columns) == 2:
+        return columns[0], "", columns[1], ""
+    if len(columns) == 4:
+        return columns[0], columns[1], columns[2], columns[3]
+    return None
+
+
+def _fields_from_json(data) -> Optional[CardFields]:
+    if isinstance(data, list):
+        return _fields_from_columns(data)
+    if not isinstance(data, dict):
+        return None
+    fields = []
+    for names in JSON_FIELDS:
+        value = next((data[name] for name in names if name in data), "")
+        fields.append(value.strip() if isinstance(value, str) else "")
+    return fields[0], fields[1], fields[2], fields[3]
+
+
+def _is_header(fields: CardFields) -> bool:
+    return fields[0].casefold() == "word"
+
+
+def read_card_fields(path: str) -> Iterator[Optional[CardFields]]:
+    """
+    Streams the cards of a CSV, TSV or JSON lines file, one row at a time, without reading the whole file.
+    Yields None for rows that can't be read as a card. A first row starting with "Word" is taken for a header.
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    with open(path, encoding="utf-8-sig", newline="") as file:
+        if suffix in JSON_LINES_SUFFIXES:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    yield _fields_from_json(json.loads(line))
+                except json.JSONDecodeError:
+                    yield None
+            return
+
+        delimiter = "\t" if suffix in TAB_SEPARATED_SUFFIXES else ","
+        first = True
+        for columns in csv.reader(file, delimiter=delimiter):
+            if not columns:
+                continue
+            fields = _fields_from_columns(columns)
+            if first:
+                first = False
+                if fields and _is_header(fields):
+                    continue
+            yield fields
+
+
+class WordCardImporter:
+    """
+    Turns streamed rows into word cards, skipping the ones that duplicate an existing card or an earlier row.
+
+    The keys of the existing cards are hashed once up front; after that, each row costs one hash and one
+    set lookup. Ids are made for a whole batch at once, see unique_ids_by_time. The cards are collected
+    and committed with a single Learning.add_word_cards, so the import is one change and one save.
+    """
+
+    def __init__(self, existing_cards: Iterable[WordCard] = (), batch_size: int = BATCH_SIZE):
+        self.batch_size = batch_size
+        self.seen_keys: Set[int] = {card_key(card.word, card.translation) for card in existing_cards}
+        self.result = ImportResult()
+
+    def convert(self, rows: Iterable[Optional[CardFields]]) -> Iterator[WordCard]:
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                return
+            new_fields = []
+            for fields in batch:
+                if not fields or not fields[0] or not fields[2]:
+                    self.result.invalid += 1
+                    continue
+                key = card_key(fields[0], fields[2])
+                if key in self.seen_keys:
+                    self.result.duplicates += 1
+                    continue
+                self.seen_keys.add(key)
+                new_fields.append(fields)
+            for identifier, fields in zip(unique_ids_by_time(len(new_fields)), new_fields):
+                yield WordCard(identifier, *fields)
+            self.result.imported += len(new_fields)
+
+
+def read_word_cards(existing_cards: Iterable[WordCard], path: str,
+                    batch_size: int = BATCH_SIZE) -> Tuple[List[WordCard], ImportResult]:
+    """
+    The new cards of the file, skipping the ones that duplicate the existing cards or earlier rows.
+    Doesn't touch the learning, so it can run off the GUI thread given a copy of the list of the cards.
+    Raises OSError, ValueError (including UnicodeDecodeError) or csv.Error if the file can't be read.
+    """
+    importer = WordCardImporter(existing_cards, batch_size)
+    return list(importer.convert(read_card_fields(path))), importer.result
+
+
+def import_word_cards(learning, path: str, batch_size: int = BATCH_SIZE) -> ImportResult:
+    """
+    Imports the cards of the file at the end of the learning's main cards. The caller triggers the save.
+    """
+    word_cards, result = read_word_cards(learning.word_cards_combined(), path, batch_size)
+    learning.add_word_cards(word_cards)
+    return result
+
+
+def do_main():
+    n = 1_000_000
+    letters = "abcçdefgğhıijklmnoöprsştuüvyz"
+    random.seed(1)
+
+    def random_word():
+        return "".join(random.choice(letters) for _ in range(random.randint(3, 10)))
+
+    existing = [WordCard(str(i), random_word(), "", random_word(), "") for i in range(10_000)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cards.tsv")
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file, delimiter="\t")
+            writer.writerow(["Word", "Translation"])
+            for i in range(n):
+                if i % 10 == 0:
+                    card = random.choice(existing)
+                    writer.writerow([card.word.upper(), " " + card.translation])
+                else:
+                    writer.writerow([random_word(), random_word()])
+
+        start = time.perf_counter()
+        importer = WordCardImporter(existing)
+        cards = list(importer.convert(read_card_fields(path)))
+        elapsed = time.perf_counter() - start
+        print(f"Importing {n} rows: {elapsed:.2f} s, {importer.result}, "
+              f"{len({card.identifier for card in cards})} distinct ids")
+
+
+if __name__ == '__main__':
+    do_main()
@@ -0,0 +1,266 @@
+import random
+import time
+from collections.abc import Sequence
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from state.WordCard import WordCard
+from utils.time_utils import unique_id_by_time
+
+
+class WordCardList:
+    """
+    Ordered collection of word cards with an index by identifier.
+
+    Cards sit in a sparse array of slots: moving a card to the start or the end puts it into a free slot
+    before the first or after the last card and leaves a hole behind. A Fenwick tree over the slots counts
+    the occupied ones, so the position of a card and the card at a position are found in O(log n).
+    When there's no free slot at the needed end, the cards are spread out again, which is amortized O(1).
+
+    Lookups by identifier are O(1), moves to the start or end and positional access O(log n),
+    iteration is in order and O(n).
+
+    Identifiers must be unique. A card loaded with the identifier of an earlier one gets a new identifier,
+    and adding a card whose identifier is already in the list raises ValueError.
+    """
+
+    def __init__(self, cards: Iterable[WordCard] = ()):
+        self._slot_by_id: Dict[str, int] = {}
+        cards = list(cards)
+        seen = set()
+        for card in cards:
+            if card.identifier in seen:
+                new_identifier = unique_id_by_time()
+                print(f"Duplicate word card identifier {card.identifier} of {card.word}, changed to {new_identifier}")
+                card.identifier = new_identifier
+            seen.add(card.identifier)
+        self._respace(cards)
+
+    def _respace(self, cards: List[WordCard]):
+        # Leave as much room as there are cards on both sides
+        capacity = max(16, 3 * len(cards))
+        self._slots: List[Optional[WordCard]] = [None] * capacity
+        self._head = (capacity - len(cards)) // 2
+        self._tail = self._head + len(cards)
+        self._slots[self._head:self._tail] = cards
+        self._slot_by_id.clear()
+        for slot in range(self._head, self._tail):
+            self._slot_by_id[self._slots[slot].identifier] = slot
+        if len(self._slot_by_id) != len(cards):
+            raise ValueError("Duplicate word card identifiers")
+
+        # Fenwick tree built in O(capacity)
+        tree = [0] * (capacity + 1)
+        for i in range(1, capacity + 1):
+            if self._slots[i - 1] is not None:
+                tree[i] += 1
+            parent = i + (i & -i)
+            if parent <= capacity:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _update(self, slot: int, delta: int):
+        i = slot + 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _count_before(self, slot: int) -> int:
+        """
+        The number of cards in the slots before slot.
+        """
+        i = slot
+        tree = self._tree
+        result = 0
+        while i > 0:
+            result += tree[i]
+            i -= i & -i
+        return result
+
+    def _slot_at(self, index: int) -> int:
+        """
+        The slot of the card at the 0-based position index, found by descending the Fenwick tree.
+        """
+        tree = self._tree
+        slot = 0
+        remaining = index + 1
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            next_slot = slot + step
+            if next_slot < len(tree) and tree[next_slot] < remaining:
+                slot = next_slot
+                remaining -= tree[next_slot]
+            step >>= 1
+        return slot
+
+    def _check_new(self, cards: List[WordCard]):
+        identifiers = {card.identifier for card in cards}
+        if len(identifiers) != len(cards) or any(identifier in self._slot_by_id for identifier in identifiers):
+            raise ValueError(f"Duplicate word card identifiers among {[card.identifier for card in cards]}")
+
+    def _place(self, card: WordCard, slot: int):
+        self._slots[slot] = card
+        self._slot_by_id[card.identifier] = slot
+        self._update(slot, 1)
+
+    def _remove(self, identifier: str) -> Optional[WordCard]:
+        slot = self._slot_by_id.pop(identifier, None)
+        if slot is None:
+            return None
+        card = self._slots[slot]
+        self._slots[slot] = None
+        self._update(slot, -1)
+        return card
+
+    def __len__(self) -> int:
+        return len(self._slot_by_id)
+
+    def __iter__(self) -> Iterator[WordCard]:
+        for slot in range(self._head, self._tail):
+            card = self._slots[slot]
+            if card is not None:
+                yield card
+
+    def __getitem__(self, index: int) -> WordCard:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("WordCardList index out of range")
+        return self._slots[self._slot_at(index)]
+
+    def __add__(self, other) -> List[WordCard]:
+        return list(self) + list(other)
+
+    def __repr__(self):
+        return f"WordCardList({list(self)!r})"
+
+    def contains_id(self, identifier: str) -> bool:
+        return identifier in self._slot_by_id
+
+    def get(self, identifier: str) -> Optional[WordCard]:
+        slot = self._slot_by_id.get(identifier)
+        return None if slot is None else self._slots[slot]
+
+    def index_of(self, identifier: str) -> int:
+        """
+        The position of the card with the identifier, or -1 if there's none.
+        """
+        slot = self._slot_by_id.get(identifier)
+        return -1 if slot is None else self._count_before(slot)
+
+    def append(self, card: WordCard):
+        self._check_new([card])
+        if self._tail == len(self._slots):
+            self._respace(list(self))
+        self._place(card, self._tail)
+        self._tail += 1
+
+    def extend(self, cards: List[WordCard]):
+        """
+        Appends the cards in order, spreading the slots out at most once.
+        """
+        self._check_new(cards)
+        if self._tail + len(cards) > len(self._slots):
+            self._respace(list(self) + cards)
+            return
+        for card in cards:
+            self._place(card, self._tail)
+            self._tail += 1
+
+    def insert_first(self, card: WordCard):
+        self._check_new([card])
+        if self._head == 0:
+            self._respace(list(self))
+        self._head -= 1
+        self._place(card, self._head)
+
+    def pop_id(self, identifier: str) -> Optional[WordCard]:
+        """
+        Removes the card with the identifier and returns it, or returns None if there's none.
+        """
+        return self._remove(identifier)
+
+    def move_to_end(self, identifier: str):
+        card = self._remove(identifier)
+        if card:
+            self.append(card)
+
+    def move_to_start(self, identifier: str):
+        card = self._remove(identifier)
+        if card:
+            self.insert_first(card)
+
+
+class CombinedWordCards(Sequence):
+    """
+    Read-only view of the focused cards followed by the main ones, without copying them into one list.
+    """
+
+    def __init__(self, first: WordCardList, second: WordCardList):
+        self.first = first
+        self.second = second
+
+    def __len__(self) -> int:
+        return len(self.first) + len(self.second)
+
+    def __getitem__(self, index: int) -> WordCard:
+        if index < 0:
+            index += len(self)
+        if index < len(self.first):
+            return self.first[index]
+        return self.second[index - len(self.first)]
+
+    def __iter__(self) -> Iterator[WordCard]:
+        yield from self.first
+        yield from self.second
+
+
+def do_main():
+    n = 100_000
+    cards = [WordCard(f"id{i}", f"word{i}", "", f"translation{i}", "") for i in range(n)]
+    ids = [card.identifier for card in cards]
+    lookups = [random.choice(ids) for _ in range(1000)]
+
+    def measure(name, action):
+        start = time.perf_counter()
+        for identifier in lookups:
+            action(identifier)
+        print(f"{name}: {(time.perf_counter() - start) * 1e6 / len(lookups):.2f} µs per call")
+
+    cards_list = list(cards)
+
+    def list_move_to_end(identifier):
+        index = next(i for i, card in enumerate(cards_list) if card.identifier == identifier)
+        cards_list.append(cards_list.pop(index))
+
+    def list_move_to_start(identifier):
+        index = next(i for i, card in enumerate(cards_list) if card.identifier == identifier)
+        cards_list.insert(0, cards_list.pop(index))
+
+    print(f"{n} cards")
+    measure("list lookup", lambda identifier: next(card for card in cards_list if card.identifier == identifier))
+    measure("list move to end", list_move_to_end)
+    measure("list move to start", list_move_to_start)
+
+    start = time.perf_counter()
+    card_list = WordCardList(cards)
+    print(f"WordCardList build: {(time.perf_counter() - start) * 1000:.1f} ms")
+    measure("WordCardList lookup", card_list.get)
+    measure("WordCardList move to end", card_list.move_to_end)
+    measure("WordCardList move to start", card_list.move_to_start)
+    measure("WordCardList index_of", card_list.index_of)
+    positions = [random.randrange(n) for _ in range(1000)]
+    start = time.perf_counter()
+    for position in positions:
+        _ = card_list[position]
+    print(f"WordCardList access by position: {(time.perf_counter() - start) * 1e6 / len(positions):.2f} µs per call")
+
+    start = time.perf_counter()
+    for i in range(n):
+        card_list.move_to_end(ids[i % 100])
+    print(f"WordCardList {n} moves of the same cards, including respacing: "
+          f"{(time.perf_counter() - start) * 1e6 / n:.2f} µs per move")
+
+
+if __name__ == '__main__':
+    do_main()
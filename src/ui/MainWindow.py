@@ -1,25 +1,36 @@
+import csv
 import logging
 import os
+import sqlite3
 import sys
+import time
 import traceback
+from typing import Callable
 
+from PyQt5.QtCore import QThread, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QDialog, QMainWindow, \
-    QAction
+    QAction, QFileDialog, QMessageBox
 from dotenv import load_dotenv
 from google import genai
 from openai import OpenAI
 
+from anki.again_today import Watermark, failed_since_watermark, focus_failed_words
+from anki.apkg_export import export_apkg
+from anki.collection_import import apply_import, read_collection
+from languages.serbian import latin_to_cyrillic
 from ontology.Locale import Locale
 from ontology.dialogs import Dialogs
 from service.AudioPlayer import AudioPlayer
 from service.SaveService import SaveServiceThread
 from state.Dialog import Dialog
 from state.Learning import Learning
-from state.WordCard import move_id_to_end
+from state.SqliteStorage import is_sqlite_file, load_learning
+from state.WordCardImporter import read_word_cards
 from ui.widgets.LanguageDialogBlock import LanguageDialogWidget
 from ui.widgets.NodeWidget import UiContext
 from ui.widgets.modal.WordCardsDialog import WordCardsDialog
 from ui.widgets.modal.GenerateDialogModal import GenerateDialogModal
+from ui.widgets.modal.JumpToDialogModal import JumpToDialogModal
 from ui.widgets.widget_utils import clear_layout
 
 logging.basicConfig(level=logging.ERROR,
@@ -33,15 +44,108 @@ def log_uncaught_exceptions(ex_cls, ex, tb):
 
 sys.excepthook = log_uncaught_exceptions
 
+# How long closing the window waits for the pending saves
+FLUSH_TIMEOUT_SECONDS = 10
+# How long closing the window waits for each running background thread
+THREAD_WAIT_SECONDS = 5
+# Dialogs not visited for this many days are moved to the archive when the learning is opened, 0 turns it off
+ARCHIVE_AFTER_DAYS_VARIABLE = "ARCHIVE_AFTER_DAYS"
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+
+
+class WordCardImportThread(QThread):
+    """
+    Reads and converts the file of word cards off the GUI thread; adding the cards to the learning
+    is left to the receiver of finished_signal, on the GUI thread.
+    """
+
+    # The new cards and the ImportResult
+    finished_signal = pyqtSignal(object, object)
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, existing_cards, path: str, parent=None):
+        super().__init__(parent)
+        self.existing_cards = existing_cards
+        self.path = path
+
+    def run(self):
+        try:
+            word_cards, result = read_word_cards(self.existing_cards, self.path)
+        except (OSError, ValueError, csv.Error) as e:
+            logging.exception("Error importing word cards")
+            self.error_signal.emit(f"Could not import {self.path}: {e}")
+            return
+        self.finished_signal.emit(word_cards, result)
+
+
+class AnkiImportThread(QThread):
+    """
+    Reads the changed notes of an Anki collection off the GUI thread, see read_collection;
+    applying them to the learning is left to the receiver of finished_signal, on the GUI thread.
+    """
+
+    # The AnkiImport
+    finished_signal = pyqtSignal(object)
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, existing_cards, path: str, parent=None):
+        super().__init__(parent)
+        self.existing_cards = existing_cards
+        self.path = path
+
+    def run(self):
+        try:
+            anki_import = read_collection(self.existing_cards, self.path)
+        except (OSError, sqlite3.Error) as e:
+            logging.exception("Error importing the Anki collection")
+            self.error_signal.emit(f"Could not import {self.path}: {e}")
+            return
+        self.finished_signal.emit(anki_import)
+
+
+class AnkiExportThread(QThread):
+    """
+    Writes the Anki package off the GUI thread from a snapshot of the learning, see export_apkg.
+    """
+
+    # The ExportResult
+    finished_signal = pyqtSignal(object)
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, snapshot, archive, path: str, audio_lookup, parent=None):
+        super().__init__(parent)
+        self.snapshot = snapshot
+        self.archive = archive
+        self.path = path
+        self.audio_lookup = audio_lookup
+
+    def run(self):
+        try:
+            result = export_apkg(self.snapshot, self.path, self.audio_lookup, self.archive)
+        except (OSError, sqlite3.Error) as e:
+            logging.exception("Error exporting the Anki package")
+            self.error_signal.emit(f"Could not export {self.path}: {e}")
+            return
+        self.finished_signal.emit(result)
+
 
 class MainWindow(QMainWindow):
     def __init__(self, file_path):
         super().__init__()
         self.file_path = file_path
-        self.learning = Learning.from_json_file(file_path)
+        if is_sqlite_file(file_path):
+            self.learning = load_learning(file_path)
+        else:
+            self.learning = Learning.from_json_file(file_path, journaled=True, lazy=True)
+        stamped = self.learning.stamp_unvisited()
+        archived = self.archive_idle_dialogs()
+        # Build the snapshot cache up front, so that saves only rebuild what changed since
+        self.learning.snapshot()
         self.save_service = SaveServiceThread()
         self.save_service.start()
         self.save_service.connect(self.save_learning)
+        if stamped or archived:
+            self.trigger_save()
 
         self.dialogs = Dialogs.parse_from_json_file("../../data/dialogs.json")
 
@@ -70,6 +174,27 @@ class MainWindow(QMainWindow):
         word_cards_action.triggered.connect(self.open_word_cards)
         file_menu.addAction(word_cards_action)
 
+        self.import_word_cards_action = QAction('Import Word Cards...', self)
+        self.import_word_cards_action.triggered.connect(self.import_word_cards)
+        file_menu.addAction(self.import_word_cards_action)
+
+        self.anki_import_action = QAction('Import Anki Collection...', self)
+        self.anki_import_action.triggered.connect(self.import_anki_collection)
+        file_menu.addAction(self.anki_import_action)
+
+        anki_failures_action = QAction('Focus Words Failed in Anki Today...', self)
+        anki_failures_action.triggered.connect(self.focus_anki_failures)
+        file_menu.addAction(anki_failures_action)
+
+        self.anki_export_action = QAction('Export to Anki Package...', self)
+        self.anki_export_action.triggered.connect(self.export_anki_package)
+        file_menu.addAction(self.anki_export_action)
+
+        jump_action = QAction('Jump to Dialog...', self)
+        jump_action.setShortcut('Ctrl+J')
+        jump_action.triggered.connect(self.open_jump_to_dialog)
+        file_menu.addAction(jump_action)
+
         main_layout = QVBoxLayout()
 
         create_dialog_button = QPushButton("Create Dialog")
@@ -91,7 +216,7 @@ class MainWindow(QMainWindow):
     def open_generate_dialog_modal(self):
         dialog = GenerateDialogModal(
             self.openai_client, self.gemini_client, self.dialogs, self.locale, self.second_locale, self.learning.create_dialog_settings,
-            self.learning.word_cards_focused + self.learning.word_cards_main,
+            self.learning,
             parent=self)
         result = dialog.exec_()
         if result == QDialog.Accepted:
@@ -99,22 +224,156 @@ class MainWindow(QMainWindow):
             self.learning.add_root_node(dialog)
 
             for identifier in dialog.selected_word_card_ids:
-                move_id_to_end(self.learning.word_cards_focused, identifier)
-                move_id_to_end(self.learning.word_cards_main, identifier)
+                self.learning.move_word_card_to_end(identifier)
+                self.learning.review_word_card(identifier)
 
             self.save_and_rebuild()
 
     def open_word_cards(self):
-        dialog = WordCardsDialog(self, self.learning.word_cards_focused, self.learning.word_cards_main)
+        dialog = WordCardsDialog(self, self.learning)
         if dialog.exec_() == QDialog.Accepted:
-            word_cards_focused, word_cards_main = dialog.export_word_cards()
-            self.learning.word_cards_focused = word_cards_focused
-            self.learning.word_cards_main = word_cards_main
+            for word_card in dialog.export_word_cards():
+                self.learning.add_word_card(word_card)
+            self.trigger_save()
+
+    def import_word_cards(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Import Word Cards", "",
+                                              "Word cards (*.csv *.tsv *.txt *.jsonl *.ndjson);;All files (*)")
+        if not path:
+            return
+        # The file is read in a thread, against a copy of the list of the cards at this point
+        self.import_word_cards_action.setEnabled(False)
+        thread = WordCardImportThread(list(self.learning.word_cards_combined()), path, self)
+        thread.finished_signal.connect(self.add_imported_word_cards)
+        thread.error_signal.connect(self.handle_import_error)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+
+    def add_imported_word_cards(self, word_cards, result):
+        self.import_word_cards_action.setEnabled(True)
+        if word_cards:
+            self.learning.add_word_cards(word_cards)
+            self.trigger_save()
+        QMessageBox.information(self, "Import Word Cards",
+                                f"Imported {result.imported} cards, skipped {result.duplicates} duplicates "
+                                f"and {result.invalid} invalid rows.")
+
+    def handle_import_error(self, error_message):
+        self.import_word_cards_action.setEnabled(True)
+        QMessageBox.warning(self, "Import Word Cards", error_message)
+
+    def import_anki_collection(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Anki Collection", "", "Anki collection (*.anki2);;All files (*)")
+        if not path:
+            return
+        # The collection is read in a thread, against a copy of the list of the cards at this point
+        self.anki_import_action.setEnabled(False)
+        thread = AnkiImportThread(list(self.learning.word_cards_combined()), path, self)
+        thread.finished_signal.connect(self.apply_anki_import)
+        thread.error_signal.connect(self.handle_anki_import_error)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+
+    def apply_anki_import(self, anki_import):
+        self.anki_import_action.setEnabled(True)
+        try:
+            result = apply_import(self.learning, anki_import)
+        except OSError as e:
+            # The cards are in, but the next import reads the same notes again and updates them once more
+            logging.exception("Error storing the Anki import state")
+            QMessageBox.warning(self, "Anki", f"Could not store the import state: {e}")
+            result = anki_import.result
+        if result.added or result.updated:
             self.trigger_save()
+        QMessageBox.information(self, "Anki", f"Added {result.added} cards, updated {result.updated}, "
+                                              f"linked {result.linked} existing ones, skipped {result.skipped} notes.")
+
+    def handle_anki_import_error(self, error_message):
+        self.anki_import_action.setEnabled(True)
+        QMessageBox.warning(self, "Anki", error_message)
+
+    def focus_anki_failures(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Anki Collection", "", "Anki collection (*.anki2);;All files (*)")
+        if not path:
+            return
+        watermark = Watermark(path)
+        try:
+            reviews, last_revlog_id = failed_since_watermark(path, watermark)
+        except (OSError, sqlite3.Error) as e:
+            logging.exception("Error reading the Anki collection")
+            QMessageBox.warning(self, "Anki", f"Could not read {path}: {e}")
+            return
+        focused = focus_failed_words(self.learning, reviews)
+
+        def store_watermark():
+            try:
+                watermark.store(last_revlog_id)
+            except OSError:
+                # The same failures are handed out next time, and focusing them again changes nothing
+                logging.exception("Error storing the Anki watermark")
+
+        if focused:
+            # The watermark only moves past the failures once the cards they focused are saved
+            self.save_now(store_watermark)
+        elif last_revlog_id is not None:
+            store_watermark()
+        QMessageBox.information(self, "Anki", f"{len(reviews)} new failed reviews, {focused} cards focused.")
+
+    def export_anki_package(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export to Anki", "", "Anki package (*.apkg)")
+        if not path:
+            return
+        language = self.learning.language
+        audio_player = self.audio_player
+
+        def cached_audio(voice, utterance):
+            if language == 'sr':
+                utterance = latin_to_cyrillic(utterance)
+            return audio_player.cached_audio(voice, utterance)
+
+        # The package is written in a thread from a snapshot, so the learning can change in the meantime
+        self.anki_export_action.setEnabled(False)
+        thread = AnkiExportThread(self.learning.snapshot(), self.learning.archive, path, cached_audio, self)
+        thread.finished_signal.connect(self.handle_anki_export_finished)
+        thread.error_signal.connect(self.handle_anki_export_error)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+
+    def handle_anki_export_finished(self, result):
+        self.anki_export_action.setEnabled(True)
+        QMessageBox.information(self, "Anki", f"Exported {result.sentences} sentences with {result.audio_files} audio "
+                                              f"files and {result.word_cards} word cards.")
+
+    def handle_anki_export_error(self, error_message):
+        self.anki_export_action.setEnabled(True)
+        QMessageBox.warning(self, "Anki", error_message)
+
+    def open_jump_to_dialog(self):
+        dialog = JumpToDialogModal(self.learning.root_node, parent=self)
+        if dialog.exec_() == QDialog.Accepted:
+            self.learning.jump_to(dialog.selected_node_id)
+            self.save_and_rebuild()
 
     def save_learning(self):
         print("Saving learning...")
-        self.learning.save_to(self.file_path)
+        start = time.perf_counter()
+        save_job = self.learning.prepare_save(self.file_path)
+        print(f"Save paused the UI for {(time.perf_counter() - start) * 1000:.3f} ms")
+        self.save_service.submit(save_job)
+
+    def save_now(self, after_save: Callable[[], None]):
+        """
+        Saves without waiting for the debounce, and calls after_save in the save thread
+        once the changes are written. It isn't called if the save is dropped.
+        """
+        save_job = self.learning.prepare_save(self.file_path)
+
+        def save_and_continue():
+            written = save_job()
+            after_save()
+            return written
+
+        self.save_service.submit(save_and_continue)
 
     def save_and_rebuild(self):
         self.trigger_save()
@@ -129,7 +388,7 @@ class MainWindow(QMainWindow):
         learning = self.learning
         current_node = learning.root_node
         while current_node.nodes:
-            current_node = current_node.nodes[current_node.child_index]
+            current_node = current_node.current_child()
             widget = self.create_widget(current_node, node_creation_context)
             self.dynamic_layout.addWidget(widget)
 
@@ -137,12 +396,31 @@ class MainWindow(QMainWindow):
         if isinstance(current_node, Dialog):
             return LanguageDialogWidget(current_node, node_creation_context)
 
+    def archive_idle_dialogs(self) -> int:
+        """
+        Archives the dialogs idle for longer than the ARCHIVE_AFTER_DAYS environment variable, 90 days by default.
+        """
+        try:
+            days = float(os.environ.get(ARCHIVE_AFTER_DAYS_VARIABLE, DEFAULT_ARCHIVE_AFTER_DAYS))
+        except ValueError:
+            logging.exception(f"Invalid {ARCHIVE_AFTER_DAYS_VARIABLE}, using {DEFAULT_ARCHIVE_AFTER_DAYS} days")
+            days = DEFAULT_ARCHIVE_AFTER_DAYS
+        if days <= 0:
+            return 0
+        return self.learning.archive_idle_dialogs(int(days * 24 * 60 * 60))
+
     def trigger_save(self):
         self.save_service.trigger_save()
 
     def closeEvent(self, event):
-        if self.save_service.pending_save():
-            self.save_learning()
+        # A running import or export is dropped, but its thread should end before it's destroyed with the window
+        threads = self.findChildren(WordCardImportThread) + self.findChildren(AnkiImportThread) + \
+            self.findChildren(AnkiExportThread)
+        for thread in threads:
+            if not thread.wait(THREAD_WAIT_SECONDS * 1000):
+                logging.error(f"Closing while {type(thread).__name__} is still running")
+        # Changes recorded since the last save may not have triggered one yet, so always prepare a final job
+        self.save_service.flush(self.learning.prepare_save(self.file_path), FLUSH_TIMEOUT_SECONDS)
 
 
 def do_main(file_path):
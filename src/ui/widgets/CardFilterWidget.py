@@ -0,0 +1,83 @@
+import time
+from typing import Optional
+
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtWidgets import QWidget, QHBoxLayout, QComboBox, QCheckBox
+
+from state.CardScheduler import DAY_SECONDS
+from state.CardSets import CardSet, STATUSES
+from state.Learning import Learning
+
+# "Not seen recently" means not featured in a dialog for this many days
+RECENT_DAYS = 7
+
+
+class CardFilterWidget(QWidget):
+    """
+    Deck, tag and status pickers and focus and recency checkboxes, turned into a CardSet of the learning's cards.
+    """
+
+    changed = pyqtSignal()
+
+    def __init__(self, learning: Learning, parent=None):
+        super().__init__(parent)
+        self.learning = learning
+        card_sets = learning.card_sets()
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        self.deck_combo = QComboBox()
+        self.deck_combo.addItem("Any deck", None)
+        for deck in card_sets.values("deck"):
+            self.deck_combo.addItem(deck, deck)
+        layout.addWidget(self.deck_combo)
+
+        self.tag_combo = QComboBox()
+        self.tag_combo.addItem("Any tag", None)
+        for tag in card_sets.values("tag"):
+            self.tag_combo.addItem(tag, tag)
+        layout.addWidget(self.tag_combo)
+
+        self.status_combo = QComboBox()
+        self.status_combo.addItem("Any status", None)
+        for status in STATUSES:
+            self.status_combo.addItem(status.capitalize(), status)
+        layout.addWidget(self.status_combo)
+
+        self.focused_checkbox = QCheckBox("Focused only")
+        layout.addWidget(self.focused_checkbox)
+        self.not_recent_checkbox = QCheckBox(f"Not seen in {RECENT_DAYS} days")
+        layout.addWidget(self.not_recent_checkbox)
+
+        for combo in (self.deck_combo, self.tag_combo, self.status_combo):
+            combo.currentIndexChanged.connect(self.changed)
+        for checkbox in (self.focused_checkbox, self.not_recent_checkbox):
+            checkbox.stateChanged.connect(self.changed)
+
+    def card_set(self) -> Optional[CardSet]:
+        """
+        The cards passing the filter, or None if nothing is filtered.
+        """
+        card_sets = self.learning.card_sets()
+        result = None
+
+        def intersect(card_set):
+            nonlocal result
+            result = card_set if result is None else result & card_set
+
+        deck = self.deck_combo.currentData()
+        if deck is not None:
+            intersect(card_sets.deck(deck))
+        tag = self.tag_combo.currentData()
+        if tag is not None:
+            intersect(card_sets.tag(tag))
+        status = self.status_combo.currentData()
+        if status is not None:
+            intersect(card_sets.status(status))
+        if self.focused_checkbox.isChecked():
+            intersect(card_sets.focused())
+        if self.not_recent_checkbox.isChecked():
+            recent = card_sets.seen_since(int(time.time()) - RECENT_DAYS * DAY_SECONDS)
+            result = (result if result is not None else card_sets.all()) - recent
+        return result
@@ -0,0 +1,65 @@
+from typing import List
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QPlainTextEdit
+
+from ui.widgets.widget_utils import large_qedit_font
+
+# The preview is redrawn at most this often, however fast the utterances come
+FRAME_MS = 100
+
+
+class DialogPreviewWidget(QPlainTextEdit):
+    """
+    Read-only view of the dialog being generated. Utterances and translations are collected as they are
+    parsed and drawn on the next frame, so a burst of them costs one redraw.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setReadOnly(True)
+        self.setFont(large_qedit_font)
+        self.context = ""
+        self.rows: List[List[str]] = []
+        self._dirty = False
+        self._timer = QTimer(self)
+        self._timer.setInterval(FRAME_MS)
+        self._timer.timeout.connect(self._draw)
+
+    def set_context(self, context: str):
+        self.context = context
+        self._schedule()
+
+    def set_utterance(self, index: int, who: str, sentence: str, translation: str):
+        """
+        Sets utterance index, appended if it's the next one. An empty translation keeps the one shown.
+        """
+        if index > len(self.rows):
+            return
+        if index == len(self.rows):
+            self.rows.append([who, sentence, translation])
+        else:
+            row = self.rows[index]
+            row[0] = who or row[0]
+            row[1] = sentence or row[1]
+            row[2] = translation or row[2]
+        self._schedule()
+
+    def _schedule(self):
+        self._dirty = True
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _draw(self):
+        if not self._dirty:
+            self._timer.stop()
+            return
+        self._dirty = False
+        lines = [self.context, ""] if self.context else []
+        for who, sentence, translation in self.rows:
+            lines.append(f"{who}: {sentence}" if who else sentence)
+            if translation:
+                lines.append(f"    {translation}")
+        self.setPlainText("\n".join(lines))
+        scroll_bar = self.verticalScrollBar()
+        scroll_bar.setValue(scroll_bar.maximum())
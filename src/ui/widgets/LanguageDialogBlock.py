@@ -163,11 +163,11 @@ class LanguageDialogWidget(NodeWidget):
         return sentence
 
     def navigate_previous(self):
-        if self.dialog.navigate(-1):
+        if self.ui_context.learning.navigate_dialog(self.dialog, -1):
             self.navigate(True)
 
     def navigate_next(self):
-        if self.dialog.navigate(1):
+        if self.ui_context.learning.navigate_dialog(self.dialog, 1):
             self.navigate(True)
 
     def play_dialog(self):
@@ -66,7 +66,7 @@ class NodeWidget(QWidget):
         self.tree_navigate(1)
 
     def tree_navigate(self, delta):
-        self.node.parent.tree_navigate(delta)
+        self.ui_context.learning.tree_navigate(self.node.parent, delta)
         self.tree_navigation_signal.emit()
 
     @abstractmethod
@@ -1,30 +1,49 @@
 import json
+import logging
+import time
 from typing import Optional, List
 
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from PyQt5.QtWidgets import QDialog, QStackedWidget, QVBoxLayout, QPushButton, QHBoxLayout, QLabel, QWidget, QCheckBox, \
-    QTextEdit, QRadioButton, QButtonGroup
+    QTextEdit, QRadioButton, QButtonGroup, QMessageBox
 from google import genai
 from openai import OpenAI
 
 from ontology.Locale import Locale
+from ontology.dialog_pipeline import PipelinedTranslation
 from ontology.dialogs import Dialogs, DialogPreliminary, extract_context_and_dialog
+from ontology.morphology import CoverageMatcher
+from ontology.stream_parsers import DialogStreamParser, JsonElementStreamParser, Utterance, parse_utterance
+from ontology.structured_dialog import dialog_schema, parse_structured_dialog
 from state.Dialog import Dialog, CreateDialogSettings, DialogCreationAlgorithm, DialogType, ApiType
+from state.Learning import Learning
 from state.WordCard import WordCard
+from ui.widgets.CardFilterWidget import CardFilterWidget
+from ui.widgets.DialogPreviewWidget import DialogPreviewWidget
 from utils.ai_utils import stream_chat_completion
 from utils.format_utils import remove_fenced_lines
-from utils.my_random import select_and_remove
 
+# How many of the most due word cards a dialog generated with the WORD_CARDS algorithm features
+WORD_CARDS_PER_DIALOG = 3
+# The chunk count shown for a stage is updated at most this often
+COUNT_INTERVAL_SECONDS = 0.1
+
+
+def parse_json_completion(text: str):
+    """
+    The JSON of a completion, which may be in a code fence.
+    """
+    return json.loads(remove_fenced_lines(text))
 
 
 class GenerateDialogModal(QDialog):
     def __init__(self, openai_client: OpenAI, gemini_client: genai.Client, dialogs: Dialogs, locale: Locale, second_locale: Locale,
-                 settings: CreateDialogSettings, word_cards_combined: List[WordCard], parent=None):
+                 settings: CreateDialogSettings, learning: Learning, parent=None):
         super(GenerateDialogModal, self).__init__(parent)
         self.locale = locale
         self.second_locale = second_locale
         self.settings = settings
-        self.word_cards_combined = word_cards_combined
+        self.learning = learning
         self.dialogs = dialogs
         self.openai_client = openai_client
         self.gemini_client = gemini_client
@@ -42,7 +61,10 @@ class GenerateDialogModal(QDialog):
 
         self.second_panel = QDialog()
         self.second_panel_layout = QVBoxLayout(self.second_panel)
-        self.second_panel_layout.addWidget(QLabel("Second Panel", self))
+        self.stages_layout = QVBoxLayout()
+        self.second_panel_layout.addLayout(self.stages_layout)
+        self.preview = DialogPreviewWidget(self.second_panel)
+        self.second_panel_layout.addWidget(self.preview)
         self.stacked_widget.addWidget(self.second_panel)
 
         layout = QVBoxLayout(self)
@@ -90,6 +112,10 @@ class GenerateDialogModal(QDialog):
         word_cards_panel_layout = QVBoxLayout(self.word_cards_panel)
         word_cards_label = QLabel("Word Cards", self.word_cards_panel)
         word_cards_panel_layout.addWidget(word_cards_label)
+        # The most due cards among the ones passing the filter are featured
+        self.card_filter = CardFilterWidget(self.learning, self.word_cards_panel)
+        word_cards_panel_layout.addWidget(self.card_filter)
+        word_cards_panel_layout.addStretch()
 
         self.first_panel_stacked_widget.addWidget(self.word_cards_panel)
 
@@ -133,6 +159,17 @@ class GenerateDialogModal(QDialog):
         dialog_controls_first_row.addLayout(api_type_layout)
         dialog_controls_first_row.addWidget(self.use_heavy_model_checkbox)
 
+        self.pipelined_translation_checkbox = QCheckBox("Translate while generating")
+        self.pipelined_translation_checkbox.setChecked(settings.pipelined_translation)
+        self.pipelined_translation_checkbox.stateChanged.connect(self.update_pipelined_translation)
+        dialog_controls_first_row.addWidget(self.pipelined_translation_checkbox)
+
+        self.structured_output_checkbox = QCheckBox("Single request")
+        self.structured_output_checkbox.setChecked(settings.structured_output)
+        self.structured_output_checkbox.stateChanged.connect(self.update_structured_output)
+        dialog_controls_first_row.addWidget(self.structured_output_checkbox)
+        self.pipelined_translation_checkbox.setEnabled(not settings.structured_output)
+
         dialog_controls_rows.addLayout(dialog_controls_first_row)
 
         plot_row = QHBoxLayout()
@@ -202,6 +239,14 @@ class GenerateDialogModal(QDialog):
     def update_use_heavy_model(self, state):
         self.settings.use_heavy_model = (state == Qt.Checked)
 
+    def update_pipelined_translation(self, state):
+        self.settings.pipelined_translation = (state == Qt.Checked)
+
+    def update_structured_output(self, state):
+        self.settings.structured_output = (state == Qt.Checked)
+        # Nothing is left to translate separately
+        self.pipelined_translation_checkbox.setEnabled(not self.settings.structured_output)
+
     def regen_plot(self):
         self.initial_prompt = self.generate_initial_prompt()
         self.refresh_plot_label()
@@ -218,7 +263,7 @@ class GenerateDialogModal(QDialog):
         stage_layout.addWidget(QLabel(stage_name, self))
         self.current_counter_widget = QLabel("...", self)
         stage_layout.addWidget(self.current_counter_widget)
-        self.second_panel_layout.addWidget(stage_panel)
+        self.stages_layout.addWidget(stage_panel)
 
     def add_stage_current_count(self, current_count: int):
         self.current_counter_widget.setText(str(current_count))
@@ -228,6 +273,15 @@ class GenerateDialogModal(QDialog):
         self.accept()
 
     def generate(self):
+        word_cards = []
+        if self.settings.algorithm == DialogCreationAlgorithm.WORD_CARDS:
+            card_set = self.card_filter.card_set()
+            if card_set is not None and not card_set:
+                QMessageBox.warning(self, "No word cards", "No word cards pass the filter. Change the filter to "
+                                                           "generate a dialog featuring some of them.")
+                return
+            word_cards = self.learning.most_due_word_cards(WORD_CARDS_PER_DIALOG, card_set)
+
         self.stacked_widget.setCurrentIndex(1)
 
         thread = GenerateDialogThread(
@@ -239,17 +293,18 @@ class GenerateDialogModal(QDialog):
             self.settings,
             self.initial_prompt,
             self.plot_details_edit.toPlainText(),
-            self.word_cards_combined,
+            word_cards,
             self
         )
         thread.new_stage_signal.connect(self.add_stage_name)
         thread.update_count_signal.connect(self.add_stage_current_count)
+        thread.context_signal.connect(self.preview.set_context)
+        thread.utterance_signal.connect(self.preview.set_utterance)
         thread.finished_signal.connect(self.finished)
         thread.error_signal.connect(self.handle_error)  # Connect error signal
         thread.start()
 
     def handle_error(self, error_message):
-        from PyQt5.QtWidgets import QMessageBox
         QMessageBox.critical(self, "Error", f"An error occurred during dialog generation:\n\n{error_message}")
         self.stacked_widget.setCurrentIndex(0)  # Return to the first panel
 
@@ -257,6 +312,9 @@ class GenerateDialogModal(QDialog):
 class GenerateDialogThread(QThread):
     new_stage_signal = pyqtSignal(str)
     update_count_signal = pyqtSignal(int)
+    # The context and the utterances (index, who, utterance, translation) as soon as they are parsed
+    context_signal = pyqtSignal(str)
+    utterance_signal = pyqtSignal(int, str, str, str)
     finished_signal = pyqtSignal(Dialog)
     error_signal = pyqtSignal(str)
 
@@ -269,7 +327,7 @@ class GenerateDialogThread(QThread):
                  settings: CreateDialogSettings,
                  initial_prompt: DialogPreliminary,
                  prompt_details: str,
-                 word_cards_combined: List[WordCard],
+                 word_cards: List[WordCard],
                  parent=None):
         super(GenerateDialogThread, self).__init__(parent)
         self.openai_client = openai_client
@@ -280,65 +338,67 @@ class GenerateDialogThread(QThread):
         self.settings = settings
         self.initial_prompt = initial_prompt
         self.prompt_details = prompt_details
-        self.word_cards_combined = word_cards_combined
+        self.word_cards = word_cards
+        self._count_time = 0.0
+        # The last count not passed on yet, if any
+        self._pending_count: Optional[int] = None
+
+    def new_stage(self, stage_name: str):
+        self.flush_count()
+        self._count_time = 0.0
+        self.new_stage_signal.emit(stage_name)
+
+    def report_count(self, count: int):
+        """
+        Passes the chunk count on to the UI, no more often than every COUNT_INTERVAL_SECONDS.
+        The last count held back is passed on by flush_count when the stage ends.
+        """
+        now = time.monotonic()
+        if now - self._count_time >= COUNT_INTERVAL_SECONDS:
+            self._count_time = now
+            self._pending_count = None
+            self.update_count_signal.emit(count)
+        else:
+            self._pending_count = count
+
+    def flush_count(self):
+        if self._pending_count is not None:
+            self.update_count_signal.emit(self._pending_count)
+            self._pending_count = None
+
+    def preview_content(self, content: list):
+        for index, utterance in enumerate(content):
+            if isinstance(utterance, list) and len(utterance) == 3:
+                self.utterance_signal.emit(index, *(str(value) for value in utterance))
 
     def run(self):
         try:
             language_name = self.locale.locale_name
-            second_language_name = self.second_locale.locale_name
-            self.new_stage_signal.emit(f"Generating dialog in {language_name}")
+            self.new_stage(f"Generating dialog in {language_name}")
 
             prompt = self.initial_prompt.prompt
 
-            selected_word_card_ids = []
+            selected_words: List[WordCard] = []
             if self.settings.algorithm == DialogCreationAlgorithm.PARTICIPANTS_AND_SPEC:
                 if self.prompt_details:
                     prompt += " " + self.prompt_details
 
             elif self.settings.algorithm == DialogCreationAlgorithm.WORD_CARDS:
-                selected_words: List[WordCard] = select_and_remove(self.word_cards_combined, 3)
+                selected_words = self.word_cards
                 if selected_words:
                     prompt += (" The dialog should feature the following words: " +
                                ", ".join(f'"{w.word}"' for w in selected_words) + ".")
-                selected_word_card_ids = [w.identifier for w in selected_words]
 
-            prompt += " " + self.initial_prompt.prompt_end
-            print(prompt)
+            if self.settings.structured_output:
+                context_text, content = self.generate_structured(prompt)
+            else:
+                context_text, content = self.generate_and_translate(prompt)
 
-            dialog_orig = stream_chat_completion(
-                self.openai_client,
-                self.gemini_client,
-                self.settings.api_type,
-                self.locale.heavy_generation or self.settings.use_heavy_model,
-                prompt,
-                1,
-                lambda x: self.update_count_signal.emit(x)
-            )
-            print(dialog_orig)
-
-            # Attempt to extract the context and dialog
-            context_text, dialog_text = extract_context_and_dialog(dialog_orig)
-
-            if not context_text or not dialog_text:
-                raise ValueError("Failed to parse the OpenAI response.")
-
-            self.new_stage_signal.emit("Translating and packing to JSON")
-            aligned = stream_chat_completion(
-                self.openai_client,
-                self.gemini_client,
-                self.settings.api_type,
-                False,
-                f"{context_text}\n"
-                               f"Given their dialog in {language_name}:"
-                               f'\n```\n{dialog_text}\n```\n'
-                               f'output a JSON list of each utterance from this dialog with its {second_language_name} translation in the following format: '
-                               f'`[[<who>, <{language_name} utterance>, <{second_language_name} translation>], ...]`.',
-                0,
-                lambda x: self.update_count_signal.emit(x)
-            )
-            print(aligned)
-            aligned = remove_fenced_lines(aligned)
-            content = json.loads(aligned)
+            selected_word_card_ids = []
+            if selected_words:
+                content, covered_words = self.ensure_coverage(content, selected_words)
+                selected_word_card_ids = [w.identifier for w in covered_words]
+                self.preview_content(content)
 
             result = Dialog.from_data({
                 "dialogType": self.settings.dialog_type,
@@ -349,8 +409,217 @@ class GenerateDialogThread(QThread):
                 "selectedWordCardIds": selected_word_card_ids
             })
 
+            self.flush_count()
             self.finished_signal.emit(result)
 
         except Exception as e:
             error_message = str(e)
             self.error_signal.emit(error_message)
+
+    def generate_structured(self, prompt: str):
+        """
+        Generates the context and the translated utterances in one request, with the output constrained
+        to dialog_schema, so it's parsed as is.
+        """
+        prompt += " " + self.initial_prompt.structured_prompt_end
+        print(prompt)
+        names = [interlocutor[1] for interlocutor in self.initial_prompt.interlocutors]
+        parser = JsonElementStreamParser(2)
+        preview_count = 0
+
+        def preview(text):
+            nonlocal preview_count
+            for element in parser.feed(text):
+                if isinstance(element, dict):
+                    self.utterance_signal.emit(preview_count, str(element.get("who", "")),
+                                               str(element.get("utterance", "")), str(element.get("translation", "")))
+                    preview_count += 1
+
+        generated = stream_chat_completion(
+            self.openai_client,
+            self.gemini_client,
+            self.settings.api_type,
+            self.locale.heavy_generation or self.settings.use_heavy_model,
+            prompt,
+            1,
+            self.report_count,
+            text_callback=preview,
+            response_schema=dialog_schema(names)
+        )
+        print(generated)
+        context_text, content = parse_structured_dialog(generated, names)
+        self.context_signal.emit(context_text)
+        return context_text, content
+
+    def generate_and_translate(self, prompt: str):
+        prompt += " " + self.initial_prompt.prompt_end
+        print(prompt)
+
+        names = [interlocutor[1] for interlocutor in self.initial_prompt.interlocutors]
+        pipeline = None
+        if self.settings.pipelined_translation:
+            pipeline = PipelinedTranslation(self.translate_batch, names)
+
+        parser = DialogStreamParser()
+        preview_count = 0
+
+        def preview(lines):
+            nonlocal preview_count
+            if preview_count == 0 and lines:
+                self.context_signal.emit(parser.context)
+            for line in lines:
+                who, sentence = parse_utterance(line, names) or ("", line)
+                self.utterance_signal.emit(preview_count, who, sentence, "")
+                preview_count += 1
+
+        def on_text(text):
+            preview(parser.feed(text))
+            if pipeline:
+                pipeline.on_text(text)
+
+        dialog_orig = stream_chat_completion(
+            self.openai_client,
+            self.gemini_client,
+            self.settings.api_type,
+            self.locale.heavy_generation or self.settings.use_heavy_model,
+            prompt,
+            1,
+            self.report_count,
+            text_callback=on_text
+        )
+        print(dialog_orig)
+        preview(parser.finish())
+
+        content = None
+        if pipeline:
+            self.new_stage("Finishing translation")
+            content = pipeline.finish(self.report_count)
+            if content is not None:
+                self.preview_content(content)
+
+        # Attempt to extract the context and dialog
+        context_text, dialog_text = extract_context_and_dialog(dialog_orig)
+
+        if not context_text or not dialog_text:
+            raise ValueError("Failed to parse the OpenAI response.")
+
+        if content is None:
+            content = self.translate_dialog(context_text, dialog_text)
+        return context_text, content
+
+    def translate_dialog(self, context_text: str, dialog_text: str) -> list:
+        language_name = self.locale.locale_name
+        second_language_name = self.second_locale.locale_name
+        self.new_stage("Translating and packing to JSON")
+        parser = JsonElementStreamParser()
+        preview_count = 0
+
+        def preview(text):
+            nonlocal preview_count
+            for element in parser.feed(text):
+                if isinstance(element, list) and len(element) == 3:
+                    self.utterance_signal.emit(preview_count, *(str(value) for value in element))
+                    preview_count += 1
+
+        aligned = stream_chat_completion(
+            self.openai_client,
+            self.gemini_client,
+            self.settings.api_type,
+            False,
+            f"{context_text}\n"
+                           f"Given their dialog in {language_name}:"
+                           f'\n```\n{dialog_text}\n```\n'
+                           f'output a JSON list of each utterance from this dialog with its {second_language_name} translation in the following format: '
+                           f'`[[<who>, <{language_name} utterance>, <{second_language_name} translation>], ...]`.',
+            0,
+            self.report_count,
+            text_callback=preview,
+            validate=parse_json_completion
+        )
+        print(aligned)
+        return parse_json_completion(aligned)
+
+    def translate_batch(self, context_text: str, previous: List[Utterance], batch: List[Utterance]) -> list:
+        """
+        Translates the next utterances of the dialog being generated, with the earlier ones for reference.
+        Runs on a worker thread of the PipelinedTranslation, so it reports no progress.
+        """
+        language_name = self.locale.locale_name
+        second_language_name = self.second_locale.locale_name
+        earlier = "".join(f"{who}: {utterance}\n" for who, utterance in previous)
+        lines = "".join(f"{who}: {utterance}\n" for who, utterance in batch)
+
+        def validate(text):
+            translations = parse_json_completion(text)
+            if not isinstance(translations, list) or len(translations) != len(batch):
+                raise ValueError(f"Expected {len(batch)} translations, got: {translations}")
+
+        translated = stream_chat_completion(
+            self.openai_client,
+            self.gemini_client,
+            self.settings.api_type,
+            False,
+            f"{context_text}\n" +
+            (f"Their dialog in {language_name} so far:\n```\n{earlier}```\n" if previous else "") +
+            f"Translate the next {len(batch)} utterances of the dialog to {second_language_name}:\n```\n{lines}```\n"
+            f'Output a JSON list with one translation per utterance, in order: `[<{second_language_name} translation>, ...]`.',
+            0,
+            lambda x: None,
+            validate=validate
+        )
+        return parse_json_completion(translated)
+
+    def ensure_coverage(self, content: list, selected_words: List[WordCard]):
+        """
+        Checks that the utterances use the selected words in some form. If some are missing, asks for the
+        utterances to be revised to include them, which is a small request compared to generating again.
+        Returns the content and the words it really covers.
+        """
+        def split(utterances):
+            text = "\n".join(str(utterance[1]) for utterance in utterances if len(utterance) > 1)
+            return CoverageMatcher(self.locale.code, text).split(selected_words)
+
+        covered, missing = split(content)
+        if not missing:
+            return content, covered
+
+        language_name = self.locale.locale_name
+        second_language_name = self.second_locale.locale_name
+        self.new_stage("Adding missing words")
+
+        def parse_revised(text):
+            revised_content = parse_json_completion(text)
+            if not isinstance(revised_content, list) or not revised_content:
+                raise ValueError(f"The revised dialog is not a list of utterances: {revised_content}")
+            for utterance in revised_content:
+                if not isinstance(utterance, list) or len(utterance) != 3:
+                    raise ValueError(f"Not an utterance with its translation: {utterance}")
+            return revised_content
+
+        try:
+            revised = stream_chat_completion(
+                self.openai_client,
+                self.gemini_client,
+                self.settings.api_type,
+                False,
+                f"Here is a dialog in {language_name} as a JSON list of utterances, each with its "
+                f"{second_language_name} translation:\n```\n{json.dumps(content, ensure_ascii=False)}\n```\n"
+                f"Revise as few utterances as possible so that the dialog naturally uses the following words: " +
+                ", ".join(f'"{w.word}"' for w in missing) + ". Keep the speakers and update the translations of "
+                "the revised utterances. Output only the JSON list in the same format.",
+                0,
+                self.report_count,
+                validate=parse_revised
+            )
+        except ValueError:
+            logging.exception("Could not parse the revised dialog, keeping the original one")
+            return content, covered
+        print(revised)
+        revised_content = parse_revised(revised)
+
+        revised_covered, revised_missing = split(revised_content)
+        if len(revised_covered) < len(covered):
+            return content, covered
+        if revised_missing:
+            print("Missing words after the revision: " + ", ".join(w.word for w in revised_missing))
+        return revised_content, revised_covered
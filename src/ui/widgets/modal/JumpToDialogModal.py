@@ -0,0 +1,71 @@
+from typing import Optional
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLineEdit, QListWidget, QListWidgetItem, \
+    QPushButton, QAbstractItemView
+
+from state.RootNode import RootNode
+
+
+class JumpToDialogModal(QDialog):
+    """
+    Lists the dialogs under the root by their summaries, so that none of them has to be loaded to be listed.
+    The node id of the chosen one is in selected_node_id after the modal is accepted, see Learning.jump_to.
+    """
+
+    def __init__(self, root_node: RootNode, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Jump to Dialog")
+        self.setModal(True)
+        self.setGeometry(0, 0, 600, 500)
+        self.selected_node_id: Optional[int] = None
+
+        layout = QVBoxLayout()
+
+        self.filter_line_edit = QLineEdit()
+        self.filter_line_edit.setPlaceholderText("Filter")
+        self.filter_line_edit.textChanged.connect(self.apply_filter)
+        layout.addWidget(self.filter_line_edit)
+
+        self.list_widget = QListWidget()
+        self.list_widget.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.list_widget.itemDoubleClicked.connect(self.accept)
+        layout.addWidget(self.list_widget)
+
+        button_layout = QHBoxLayout()
+        self.ok_button = QPushButton("Jump")
+        self.ok_button.clicked.connect(self.accept)
+        button_layout.addWidget(self.ok_button)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.reject)
+        button_layout.addWidget(self.cancel_button)
+        layout.addLayout(button_layout)
+
+        self.setLayout(layout)
+
+        for position, node in enumerate(root_node.nodes):
+            summary = node.summary()
+            text = f"{position + 1}. {summary['title'] or 'Dialog'}"
+            if summary["archived"]:
+                text += " (archived)"
+            item = QListWidgetItem(text)
+            item.setData(Qt.UserRole, summary["id"])
+            self.list_widget.addItem(item)
+
+        if root_node.nodes:
+            self.list_widget.setCurrentRow(root_node.child_index)
+            self.list_widget.scrollToItem(self.list_widget.currentItem(), QAbstractItemView.PositionAtCenter)
+        self.filter_line_edit.setFocus()
+
+    def apply_filter(self, text):
+        text = text.casefold()
+        for row in range(self.list_widget.count()):
+            item = self.list_widget.item(row)
+            item.setHidden(text not in item.text().casefold())
+
+    def accept(self):
+        item = self.list_widget.currentItem()
+        if item is None or item.isHidden():
+            return
+        self.selected_node_id = item.data(Qt.UserRole)
+        super().accept()
@@ -1,33 +1,95 @@
-from typing import List, Tuple
+from typing import List, Optional
 
-from PyQt5.QtWidgets import QDialog, QVBoxLayout, QTableWidget, QTableWidgetItem, QHBoxLayout, QLabel, \
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QTableView, QHBoxLayout, QLabel, QHeaderView, \
     QLineEdit, QPushButton, QMessageBox
 
+from state.Learning import Learning
 from state.WordCard import WordCard
-from utils import my_random, time_utils
+from utils import time_utils
+from ui.widgets.CardFilterWidget import CardFilterWidget
+from utils.search_utils import TrigramIndex
 
+COLUMN_HEADERS = ["Word", "Word Comment", "Translation", "Translation Comment"]
 
-class WordCardTableRow:
-    def __init__(self, word_card: WordCard, focused: bool):
-        self.word_card = word_card
-        self.focused = focused
 
+class WordCardTableModel(QAbstractTableModel):
+    """
+    Table of the cards added in the dialog, newest first, followed by the learning's focused and main cards.
 
-def convert_to_word_card_table_rows(word_cards_focused: List[WordCard], word_cards_main: List[WordCard]):
-    return ([WordCardTableRow(word_card, True) for word_card in word_cards_focused] +
-            [WordCardTableRow(word_card, False) for word_card in word_cards_main])
-
+    The rows are read from the learning's card lists when the view asks for them, which it only does
+    for the visible ones, so nothing is created per card up front. While a search is active,
+    the rows are the matching cards instead.
+    """
 
+    def __init__(self, learning: Learning, parent=None):
+        super().__init__(parent)
+        self.learning_cards = learning.word_cards_combined()
+        # Newest last, shown first
+        self.added_word_cards: List[WordCard] = []
+        self.matches: Optional[List[WordCard]] = None
+
+    def card_at(self, row: int) -> WordCard:
+        if self.matches is not None:
+            return self.matches[row]
+        added_count = len(self.added_word_cards)
+        if row < added_count:
+            return self.added_word_cards[added_count - 1 - row]
+        return self.learning_cards[row - added_count]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self.matches is not None:
+            return len(self.matches)
+        return len(self.added_word_cards) + len(self.learning_cards)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMN_HEADERS)
+
+    def data(self, index: QModelIndex, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        return self.card_at(index.row()).texts()[index.column()]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return COLUMN_HEADERS[section]
+        return section + 1
+
+    def add_word_card(self, word_card: WordCard, matches_filter: bool):
+        """
+        Inserts the card as the first row, without resetting the model.
+        """
+        if self.matches is not None:
+            if not matches_filter:
+                self.added_word_cards.append(word_card)
+                return
+            self.beginInsertRows(QModelIndex(), 0, 0)
+            self.matches.insert(0, word_card)
+            self.added_word_cards.append(word_card)
+        else:
+            self.beginInsertRows(QModelIndex(), 0, 0)
+            self.added_word_cards.append(word_card)
+        self.endInsertRows()
 
+    def set_matches(self, matches: Optional[List[WordCard]]):
+        self.beginResetModel()
+        self.matches = matches
+        self.endResetModel()
 
 
 class WordCardsDialog(QDialog):
-    def __init__(self, parent, word_cards_focused, word_cards_main):
+    def __init__(self, parent, learning: Learning):
         super().__init__(parent)
         self.setWindowTitle("Word Cards")
         self.setModal(True)
         self.setGeometry(0, 0, 800, 400)
 
+        self.learning = learning
+
         layout = QVBoxLayout()
 
         # Panel for adding new word card
@@ -49,11 +111,36 @@ class WordCardsDialog(QDialog):
         add_panel_layout.addWidget(self.add_button)
         layout.addLayout(add_panel_layout)
 
-        # Table widget
-        self.table_widget = QTableWidget()
-        self.table_widget.setColumnCount(4)
-        self.table_widget.setHorizontalHeaderLabels(["Word", "Word Comment", "Translation", "Translation Comment"])
-        layout.addWidget(self.table_widget)
+        labels_layout = QHBoxLayout()
+        labels_layout.addWidget(QLabel("Deck:"))
+        self.deck_line_edit = QLineEdit()
+        labels_layout.addWidget(self.deck_line_edit)
+        labels_layout.addWidget(QLabel("Tags (comma separated):"))
+        self.tags_line_edit = QLineEdit()
+        labels_layout.addWidget(self.tags_line_edit)
+        layout.addLayout(labels_layout)
+
+        # Search box and filters for the table
+        search_layout = QHBoxLayout()
+        search_layout.addWidget(QLabel("Search:"))
+        self.search_line_edit = QLineEdit()
+        self.search_line_edit.setClearButtonEnabled(True)
+        self.search_line_edit.textChanged.connect(lambda: self.filter_table())
+        search_layout.addWidget(self.search_line_edit)
+        self.card_filter = CardFilterWidget(learning)
+        self.card_filter.changed.connect(self.filter_table)
+        search_layout.addWidget(self.card_filter)
+        layout.addLayout(search_layout)
+
+        # Table view; with fixed row heights it never measures rows that aren't shown
+        self.table_model = WordCardTableModel(learning, self)
+        self.table_view = QTableView()
+        self.table_view.setModel(self.table_model)
+        self.table_view.setWordWrap(False)
+        self.table_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table_view.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 8)
+        self.table_view.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        layout.addWidget(self.table_view)
 
         # OK and Cancel buttons
         button_layout = QHBoxLayout()
@@ -67,28 +154,43 @@ class WordCardsDialog(QDialog):
 
         self.setLayout(layout)
 
-        self.table_rows = convert_to_word_card_table_rows(word_cards_focused, word_cards_main)
-        self.populate_table(self.table_rows)
-
         self.center_on_parent()
 
         self.words_added = False
-
-    def export_word_cards(self) -> Tuple[List[WordCard], List[WordCard]]:
-        focused_cards = []
-        main_cards = []
-        for row in self.table_rows:
-            (focused_cards if row.focused else main_cards).append(row.word_card)
-        return focused_cards, main_cards
-
-    def populate_table(self, word_card_table_rows):
-        self.table_widget.setRowCount(len(word_card_table_rows))
-        for row, table_row in enumerate(word_card_table_rows):
-            card = table_row.word_card
-            self.table_widget.setItem(row, 0, QTableWidgetItem(card.word))
-            self.table_widget.setItem(row, 1, QTableWidgetItem(card.word_comment))
-            self.table_widget.setItem(row, 2, QTableWidgetItem(card.translation))
-            self.table_widget.setItem(row, 3, QTableWidgetItem(card.translation_comment))
+        # The learning's index only has the cards saved before; the ones added here go to a small one of their own
+        self.added_word_card_index = TrigramIndex()
+
+    def export_word_cards(self) -> List[WordCard]:
+        """
+        Returns the cards added in this dialog, in the order they were added.
+        Each of them goes to the start of the main cards.
+        """
+        return self.table_model.added_word_cards
+
+    def filter_table(self):
+        """
+        Shows the cards matching both the search and the filters. The filters only apply to the saved cards;
+        the ones added in this dialog stay in view unless the search excludes them.
+        """
+        query = self.search_line_edit.text().strip()
+        card_set = self.card_filter.card_set()
+        if not query and card_set is None:
+            self.table_model.set_matches(None)
+            return
+        if query:
+            added_ids = self.added_word_card_index.search(query)
+            added_cards = {card.identifier: card for card in self.table_model.added_word_cards}
+            # Newest first, as without the search
+            matches = [added_cards[identifier] for identifier in reversed(added_ids)]
+            for identifier in self.learning.word_card_index().search(query):
+                if card_set is not None and identifier not in card_set:
+                    continue
+                word_card = self.learning.get_word(identifier)
+                if word_card:
+                    matches.append(word_card)
+        else:
+            matches = list(reversed(self.table_model.added_word_cards)) + list(card_set)
+        self.table_model.set_matches(matches)
 
     def center_on_parent(self):
         parent_geometry = self.parent().frameGeometry()
@@ -103,18 +205,13 @@ class WordCardsDialog(QDialog):
         translation = self.translation_line_edit.text()
         translation_comment = self.translation_comment_line_edit.text()
         if word and translation:
-            # Add in the table
-            row = 0
-            self.table_widget.insertRow(row)
-            self.table_widget.setItem(row, 0, QTableWidgetItem(word))
-            self.table_widget.setItem(row, 1, QTableWidgetItem(word_comment))
-            self.table_widget.setItem(row, 2, QTableWidgetItem(translation))
-            self.table_widget.setItem(row, 3, QTableWidgetItem(translation_comment))
-
-            # Add to the backing collection
-            self.table_rows.insert(0,
-                                   WordCardTableRow(
-                                       WordCard(time_utils.encode_by_time(), word, word_comment, translation, translation_comment), False))
+            tags = [tag.strip() for tag in self.tags_line_edit.text().split(",") if tag.strip()]
+            word_card = WordCard(time_utils.unique_id_by_time(), word, word_comment, translation, translation_comment,
+                                 deck=self.deck_line_edit.text().strip(), tags=tags)
+            self.added_word_card_index.add(word_card.identifier, word_card.texts())
+            query = self.search_line_edit.text().strip()
+            matches_filter = not query or word_card.identifier in self.added_word_card_index.search(query)
+            self.table_model.add_word_card(word_card, matches_filter)
 
             # Clear the edit fields
             self.word_line_edit.clear()
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Callable, Optional
 
 from google import genai
 from openai import OpenAI
@@ -6,6 +6,8 @@ from openai import OpenAI
 
 from state.Dialog import ApiType
 from utils import openai_utils, gemini_utils
+from utils.async_ai_utils import stream_chat_completion_sync
+from utils.completion_cache import completion_cache, completion_key
 
 
 def stream_chat_completion(
@@ -16,11 +18,65 @@ def stream_chat_completion(
         instruct: str,
         temperature: float,
         stream_callback,
-        system_message: Optional[str] = None
+        system_message: Optional[str] = None,
+        use_cache: Optional[bool] = None,
+        text_callback: Optional[Callable[[str], None]] = None,
+        response_schema: Optional[dict] = None,
+        validate: Optional[Callable[[str], object]] = None
 ) -> str:
-    if api_type == ApiType.OPEN_AI:
-        return openai_utils.stream_chat_completion(
-            openai_client, use_heavy_model, system_message, instruct, temperature, stream_callback)
-    elif api_type == ApiType.GEMINI:
-        return gemini_utils.stream_chat_completion(
-            gemini_client, use_heavy_model, system_message, instruct, temperature, stream_callback)
+    """
+    text_callback, if given, receives the text of every chunk as it arrives, or a cached completion at once.
+    With response_schema, a JSON schema, the completion is JSON following it.
+
+    The request goes through the shared event loop of async_ai_utils, which bounds the requests in flight
+    per provider and retries rate-limited ones, so any number of threads can call this.
+
+    Completions are cached on disk, and a cached one is replayed through stream_callback chunk by chunk.
+    By default only the ones at temperature 0 are: sampling at a higher temperature is meant to vary,
+    so a repeated request shouldn't get the same text back.
+
+    validate, if given, is called with the completion, before it's cached, and raises if the caller can't
+    use it, such as JSON that doesn't parse. Such a completion isn't cached and the error is raised from here.
+    A cached completion it rejects is dropped and requested again.
+    """
+    chunk_counts = [0]
+
+    def on_text(text):
+        chunk_counts[0] += 1
+        stream_callback(chunk_counts[0])
+        if text_callback:
+            text_callback(text)
+
+    cache = completion_cache() if (temperature == 0 if use_cache is None else use_cache) else None
+    if cache is None:
+        result = stream_chat_completion_sync(openai_client, gemini_client, api_type, use_heavy_model, instruct,
+                                             temperature, on_text, system_message, response_schema)
+        if validate:
+            validate(result)
+        return result
+
+    module = openai_utils if api_type == ApiType.OPEN_AI else gemini_utils
+    key = completion_key(api_type.value, module.model_name(use_heavy_model), system_message, instruct, temperature,
+                         response_schema)
+    cached = cache.get(key)
+    if cached and validate:
+        try:
+            validate(cached[0])
+        except Exception as e:
+            print(f"Dropping a cached completion that fails validation: {e}")
+            cache.delete(key)
+            cached = None
+    if cached:
+        text, chunks = cached
+        for chunk_count in range(1, chunks + 1):
+            stream_callback(chunk_count)
+        if text_callback:
+            text_callback(text)
+        return text
+
+    result = stream_chat_completion_sync(openai_client, gemini_client, api_type, use_heavy_model, instruct,
+                                         temperature, on_text, system_message, response_schema)
+    if validate:
+        validate(result)
+    cache.put(key, result, chunk_counts[0])
+    return result
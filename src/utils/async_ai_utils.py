@@ -0,0 +1,261 @@
+import asyncio
+import inspect
+import queue
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, Optional
+
+import httpx
+from google import genai
+from openai import APIConnectionError, AsyncOpenAI, OpenAI
+
+from state.Dialog import ApiType
+from utils import openai_utils, gemini_utils
+
+# Requests streaming from a provider at once; the others wait for a slot
+MAX_CONCURRENT_REQUESTS = {ApiType.OPEN_AI: 8, ApiType.GEMINI: 4}
+# Rate-limited requests and ones failed by the connection or a server error are retried this many times...
+MAX_RETRIES = 5
+# ...after the delay a rate limit asks for, or else after a backoff starting at this many seconds and doubling
+INITIAL_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+_DONE = object()
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    For a rate limit (HTTP 429) error, the delay the provider asks for in its retry-after headers,
+    or 0 if there are none. None for any other error.
+    """
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if status != 429:
+        return None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return max(float(value) * scale, 0.0)
+            except ValueError:
+                # An HTTP date rather than seconds
+                pass
+    return 0.0
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether the request failed for a reason worth retrying it for other than a rate limit:
+    a connection error or timeout, or a server error (HTTP 5xx).
+    """
+    if isinstance(error, (APIConnectionError, httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return isinstance(status, int) and 500 <= status < 600
+
+
+class AsyncProviders:
+    """
+    Streams completions from the async OpenAI and Gemini clients. At most MAX_CONCURRENT_REQUESTS requests
+    per provider are in flight, and a request turned down with 429 is retried after the delay the provider
+    asks for, without holding its slot meanwhile. Connection errors, timeouts and server errors are retried
+    with the same backoff. A request is only retried before any of its text has been handed out,
+    so a consumer never sees a completion restart.
+    """
+
+    def __init__(self, openai_client: Optional[AsyncOpenAI], gemini_client: Optional[genai.Client],
+                 limits: Dict[ApiType, int] = None):
+        self.openai_client = openai_client
+        self.gemini_client = gemini_client
+        self.limits = limits or MAX_CONCURRENT_REQUESTS
+        self._semaphores: Dict[ApiType, asyncio.Semaphore] = {}
+
+    def _semaphore(self, api_type: ApiType) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(api_type)
+        if semaphore is None:
+            semaphore = self._semaphores[api_type] = asyncio.Semaphore(self.limits[api_type])
+        return semaphore
+
+    async def stream(self, api_type: ApiType, use_heavy_model: bool, instruct: str, temperature: float,
+                     system_message: Optional[str] = None, response_schema: Optional[dict] = None) -> AsyncIterator[str]:
+        """
+        The text of the completion chunk by chunk.
+        """
+        attempt = 0
+        while True:
+            started = False
+            async with self._semaphore(api_type):
+                try:
+                    async for text in self._provider_stream(api_type, use_heavy_model, instruct, temperature,
+                                                            system_message, response_schema):
+                        started = True
+                        yield text
+                    return
+                except Exception as e:
+                    delay = retry_after_seconds(e)
+                    if (delay is None and not is_transient(e)) or started or attempt >= MAX_RETRIES:
+                        raise
+                    reason = (f"Rate limited by {api_type.value}" if delay is not None
+                              else f"Request to {api_type.value} failed: {e}")
+            if not delay:
+                delay = min(INITIAL_BACKOFF_SECONDS * 2 ** attempt, MAX_BACKOFF_SECONDS)
+            attempt += 1
+            print(f"{reason}, retrying in {delay:.1f} s")
+            await asyncio.sleep(delay)
+
+    async def complete(self, api_type: ApiType, use_heavy_model: bool, instruct: str, temperature: float,
+                       system_message: Optional[str] = None, response_schema: Optional[dict] = None) -> str:
+        return "".join([text async for text in self.stream(api_type, use_heavy_model, instruct, temperature,
+                                                            system_message, response_schema)])
+
+    def _provider_stream(self, api_type: ApiType, use_heavy_model: bool, instruct: str, temperature: float,
+                         system_message: Optional[str], response_schema: Optional[dict]) -> AsyncIterator[str]:
+        if api_type == ApiType.OPEN_AI:
+            return self._openai_stream(use_heavy_model, instruct, temperature, system_message, response_schema)
+        elif api_type == ApiType.GEMINI:
+            return self._gemini_stream(use_heavy_model, instruct, response_schema)
+        raise ValueError(f"Unknown API type {api_type}")
+
+    async def _openai_stream(self, use_heavy_model, instruct, temperature, system_message, response_schema):
+        stream = await self.openai_client.chat.completions.create(
+            **openai_utils.request_arguments(use_heavy_model, system_message, instruct, temperature, response_schema))
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def _gemini_stream(self, use_heavy_model, instruct, response_schema):
+        stream = self.gemini_client.aio.models.generate_content_stream(
+            model=gemini_utils.model_name(use_heavy_model),
+            contents=instruct,
+            config=gemini_utils.generation_config(response_schema)
+        )
+        # An async generator in older google-genai versions, a coroutine returning one in newer ones
+        if inspect.isawaitable(stream):
+            stream = await stream
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+
+class _LoopThread:
+    """
+    An event loop running in a daemon thread, where the sync shim runs the requests of all threads.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="ai-event-loop", daemon=True)
+        self.thread.start()
+
+
+_loop_thread: Optional[_LoopThread] = None
+_providers: Dict[tuple, AsyncProviders] = {}
+_lock = threading.Lock()
+
+
+def shared_providers(openai_client: Optional[OpenAI], gemini_client: Optional[genai.Client]):
+    """
+    The shared event loop and the AsyncProviders for the sync clients, whose settings the async OpenAI client
+    copies. Failed requests are retried by AsyncProviders, so the OpenAI client doesn't retry them itself.
+    """
+    global _loop_thread
+    with _lock:
+        if _loop_thread is None:
+            _loop_thread = _LoopThread()
+        key = (id(openai_client), id(gemini_client))
+        providers = _providers.get(key)
+        if providers is None:
+            async_openai_client = AsyncOpenAI(api_key=openai_client.api_key, base_url=openai_client.base_url,
+                                              max_retries=0) if openai_client else None
+            providers = _providers[key] = AsyncProviders(async_openai_client, gemini_client)
+        return _loop_thread.loop, providers
+
+
+def stream_chat_completion_sync(openai_client: Optional[OpenAI], gemini_client: Optional[genai.Client],
+                                api_type: ApiType, use_heavy_model: bool, instruct: str, temperature: float,
+                                text_callback: Callable[[str], None], system_message: Optional[str] = None,
+                                response_schema: Optional[dict] = None) -> str:
+    """
+    Sync shim over AsyncProviders.stream for code running in threads, such as GenerateDialogThread.
+    The request runs in the shared event loop, so the concurrency limits hold across all the threads,
+    and text_callback is called in the calling thread with each chunk's text.
+    """
+    loop, providers = shared_providers(openai_client, gemini_client)
+    chunks = queue.Queue()
+
+    async def pump():
+        try:
+            async for text in providers.stream(api_type, use_heavy_model, instruct, temperature,
+                                               system_message, response_schema):
+                chunks.put(text)
+        finally:
+            chunks.put(_DONE)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), loop)
+    parts = []
+    try:
+        while True:
+            text = chunks.get()
+            if text is _DONE:
+                break
+            parts.append(text)
+            text_callback(text)
+    except BaseException:
+        future.cancel()
+        raise
+    # Raises the error of the request, if any
+    future.result()
+    return "".join(parts)
+
+
+def do_main():
+    class RateLimitError(Exception):
+        status_code = 429
+
+        class response:
+            headers = {"retry-after-ms": "200"}
+
+    class ServerError(Exception):
+        status_code = 503
+
+    class FakeProviders(AsyncProviders):
+        """
+        Completions of 20 chunks taking 50 ms each, the first request turned down with 429
+        and the second failing with 503.
+        """
+
+        def __init__(self):
+            super().__init__(None, None, {ApiType.OPEN_AI: 8, ApiType.GEMINI: 4})
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.requests = 0
+
+        async def _provider_stream(self, api_type, use_heavy_model, instruct, temperature, system_message,
+                                   response_schema):
+            self.requests += 1
+            if self.requests == 1:
+                raise RateLimitError()
+            if self.requests == 2:
+                raise ServerError("Service unavailable")
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                for i in range(20):
+                    await asyncio.sleep(0.05)
+                    yield f"{instruct} {i} "
+            finally:
+                self.in_flight -= 1
+
+    async def generate_all(providers, n):
+        return await asyncio.gather(*(providers.complete(ApiType.OPEN_AI, False, f"dialog {i}", 1.0)
+                                      for i in range(n)))
+
+    providers = FakeProviders()
+    start = time.perf_counter()
+    results = asyncio.run(generate_all(providers, 40))
+    print(f"40 completions of 1 s from one event loop: {time.perf_counter() - start:.2f} s, "
+          f"at most {providers.max_in_flight} at once, {providers.requests} requests, {len(results[0])} characters")
+
+
+if __name__ == '__main__':
+    do_main()
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional, Tuple
+
+# Overridable in .env
+CACHE_PATH_VARIABLE = "COMPLETION_CACHE_PATH"
+CACHE_MAX_MB_VARIABLE = "COMPLETION_CACHE_MAX_MB"
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".ai-language-studio", "completions.sqlite")
+DEFAULT_MAX_MB = 64
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS completions (
+        key TEXT PRIMARY KEY,
+        text TEXT NOT NULL,
+        chunks INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        last_used INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used);
+'''
+
+
+def completion_key(provider: str, model: str, system_message: Optional[str], prompt: str, temperature: float,
+                   response_schema: Optional[dict] = None) -> str:
+    """
+    Content address of a completion request.
+    """
+    data = json.dumps([provider, model, system_message, prompt, float(temperature)] +
+                      ([response_schema] if response_schema else []), ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """
+    Completions by completion_key in a SQLite file, with the number of chunks they were streamed in so that
+    the progress can be replayed. Once the texts take more than max_bytes, the least recently used ones
+    are evicted. Every call opens its own connection, so the cache can be used from any thread.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.executescript(_SCHEMA)
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA journal_mode = WAL")
+        return connection
+
+    def get(self, key: str) -> Optional[Tuple[str, int]]:
+        """
+        The text and the chunk count of the completion, marking it as used.
+        A cache that can't be read is a miss rather than a failed request.
+        """
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    row = connection.execute("SELECT text, chunks FROM completions WHERE key = ?", (key,)).fetchone()
+                    if row:
+                        connection.execute("UPDATE completions SET last_used = ? WHERE key = ?",
+                                           (time.time_ns(), key))
+                return row
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            logging.exception("Error reading the completion cache")
+            return None
+
+    def put(self, key: str, text: str, chunks: int):
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                connection = self._connect()
+                try:
+                    with connection:
+                        connection.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                                           (key, text, chunks, size, time.time_ns()))
+                        self._evict(connection)
+                finally:
+                    connection.close()
+            except sqlite3.Error:
+                logging.exception("Error writing the completion cache")
+
+    def delete(self, key: str):
+        with self._lock:
+            try:
+                connection = self._connect()
+                try:
+                    with connection:
+                        connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                finally:
+                    connection.close()
+            except sqlite3.Error:
+                logging.exception("Error writing the completion cache")
+
+    def _evict(self, connection: sqlite3.Connection):
+        total = 0
+        for key, size in connection.execute("SELECT key, size FROM completions ORDER BY last_used DESC").fetchall():
+            total += size
+            if total > self.max_bytes:
+                connection.execute("DELETE FROM completions WHERE last_used <= "
+                                   "(SELECT last_used FROM completions WHERE key = ?)", (key,))
+                return
+
+
+_cache: Optional[CompletionCache] = None
+_cache_disabled = False
+_cache_lock = threading.Lock()
+
+
+def completion_cache() -> Optional[CompletionCache]:
+    """
+    The shared cache, at COMPLETION_CACHE_PATH or the default path and bounded by COMPLETION_CACHE_MAX_MB.
+    Setting COMPLETION_CACHE_MAX_MB to 0 turns it off, and so does failing to create it.
+    """
+    global _cache, _cache_disabled
+    with _cache_lock:
+        if _cache is None and not _cache_disabled:
+            max_mb = float(os.environ.get(CACHE_MAX_MB_VARIABLE, DEFAULT_MAX_MB))
+            if max_mb <= 0:
+                _cache_disabled = True
+                return None
+            try:
+                _cache = CompletionCache(os.environ.get(CACHE_PATH_VARIABLE, DEFAULT_CACHE_PATH),
+                                         int(max_mb * 1024 * 1024))
+            except (OSError, sqlite3.Error):
+                logging.exception("Error opening the completion cache, completions won't be cached")
+                _cache_disabled = True
+        return _cache
+
+
+def do_main():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = CompletionCache(os.path.join(directory, "completions.sqlite"), 1024 * 1024)
+        text = "x" * 10_000
+        start = time.perf_counter()
+        for i in range(200):
+            cache.put(completion_key("openai", "gpt-4o-mini", None, f"prompt {i}", 0), text, 100)
+        print(f"Put: {(time.perf_counter() - start) * 1000 / 200:.2f} ms per completion")
+        start = time.perf_counter()
+        hits = sum(1 for i in range(200) if cache.get(completion_key("openai", "gpt-4o-mini", None, f"prompt {i}", 0)))
+        print(f"Get: {(time.perf_counter() - start) * 1000 / 200:.2f} ms per completion, {hits} hits of 200 "
+              f"within {cache.max_bytes // len(text)} fitting")
+
+
+if __name__ == '__main__':
+    do_main()
@@ -0,0 +1,38 @@
+import json
+import os
+
+
+def fsync_directory(directory):
+    """
+    Makes a rename inside the directory durable. Not supported on Windows, where it is a no-op.
+    """
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_bytes_atomically(file_path, data: bytes) -> int:
+    """
+    Writes the data to a temporary file next to file_path, flushes it to disk and renames it over the target,
+    so readers never see a half-written file, even after a crash.
+    """
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb') as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_path, file_path)
+    fsync_directory(os.path.dirname(file_path))
+    return len(data)
+
+
+def write_json_atomically(file_path, json_object) -> int:
+    data = json.dumps(json_object, indent=2, ensure_ascii=False).encode('utf-8')
+    return write_bytes_atomically(file_path, data)
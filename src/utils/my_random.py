@@ -1,4 +1,3 @@
-import copy
 import random
 import string
 
@@ -20,17 +19,3 @@ def weighted_random_choice(elements):
         cumulative_weight += (n - i)  # Weight for the i-th element (n, n-1, ..., 1)
         if rand_value <= cumulative_weight:
             return elements[i]
-
-
-def select_and_remove(elements, n):
-    elements_copy = copy.copy(elements)
-    selected_elements = []
-
-    for _ in range(n):
-        if not elements_copy:
-            break
-        chosen_element = weighted_random_choice(elements_copy)
-        selected_elements.append(chosen_element)
-        elements_copy.remove(chosen_element)
-
-    return selected_elements
@@ -0,0 +1,174 @@
+import math
+import random
+import re
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+# Share of the query's trigrams a text must contain to match, so that a typo or two still matches
+MIN_SIMILARITY = 0.5
+
+# Queries with this many trigrams or fewer must match all of them, otherwise a single letter would do
+MIN_FUZZY_TRIGRAMS = 3
+
+# Letters that don't decompose into a base letter and a combining mark
+_BASE_LETTERS = {"ı": "i", "đ": "d", "ł": "l", "ø": "o", "æ": "ae", "œ": "oe"}
+_WORD_SEPARATORS = re.compile(r"\W+")
+
+
+class _StripDiacritics(dict):
+    """
+    Translation table for str.translate that works out the base letters of each character once.
+    """
+
+    def __missing__(self, code):
+        char = chr(code)
+        decomposed = unicodedata.normalize("NFKD", char)
+        result = "".join(c for c in decomposed if not unicodedata.combining(c))
+        result = _BASE_LETTERS.get(result, result)
+        self[code] = result
+        return result
+
+
+_STRIP_DIACRITICS = _StripDiacritics()
+
+
+def normalize(text: str) -> str:
+    """
+    Lower case without diacritics, so that e.g. "Çiçek" and "cicek" match.
+    """
+    text = text.casefold()
+    return text if text.isascii() else text.translate(_STRIP_DIACRITICS)
+
+
+def trigrams(text: str, complete=True) -> set:
+    """
+    The trigrams of the normalized words of the text. Words are padded with two spaces in front,
+    so that one- and two-letter prefixes have trigrams too, and with one behind when complete.
+    A query that is still being typed is not complete, so that its last word matches as a prefix.
+    """
+    words = [word for word in _WORD_SEPARATORS.split(normalize(text)) if word]
+    result = set()
+    for i, word in enumerate(words):
+        padded = "  " + word + (" " if complete or i < len(words) - 1 else "")
+        for j in range(len(padded) - 2):
+            result.add(padded[j:j + 3])
+    return result
+
+
+class TrigramIndex:
+    """
+    Incremental fuzzy search over short texts, e.g. the fields of word cards.
+
+    Every document gets a sequential number, and each trigram maps to the sorted array of the numbers
+    of the documents containing it. A document matches when it contains at least MIN_SIMILARITY of the
+    query's trigrams; by the pigeonhole principle it then contains one of the rarest trigrams, so only the
+    documents in those postings are considered, and checked against the other postings by binary search.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, array] = {}
+        # Key of each document number, None once the key was removed or re-added
+        self._keys: List[Optional[str]] = []
+        self._numbers: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def add(self, key: str, texts: Iterable[str]):
+        """
+        Indexes the texts under the key, replacing what was indexed under it before.
+        """
+        self.remove(key)
+        number = len(self._keys)
+        self._keys.append(key)
+        self._numbers[key] = number
+        postings = self._postings
+        # The words are split on non-word characters anyway, so the texts can be joined
+        for gram in trigrams(" ".join(text for text in texts if text)):
+            posting = postings.get(gram)
+            if posting is None:
+                posting = postings[gram] = array("I")
+            posting.append(number)
+
+    def remove(self, key: str):
+        # The postings keep the number; search skips it
+        number = self._numbers.pop(key, None)
+        if number is not None:
+            self._keys[number] = None
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[str]:
+        """
+        The keys of the matching documents, best matches first, and among equal ones in the order they were added.
+        """
+        grams = trigrams(query, complete=False)
+        if not grams:
+            return []
+        empty = array("I")
+        postings = sorted((self._postings.get(gram, empty) for gram in grams), key=len)
+        if len(postings) <= MIN_FUZZY_TRIGRAMS:
+            required = len(postings)
+        else:
+            required = math.ceil(len(postings) * MIN_SIMILARITY)
+        keys = self._keys
+
+        if required == len(postings):
+            # All trigrams must match: intersect, starting from the rarest one. The result stays in order
+            numbers = postings[0]
+            for posting in postings[1:]:
+                numbers = [number for number in numbers if _contains(posting, number)]
+            matches = [number for number in numbers if keys[number] is not None]
+        else:
+            candidate_count = len(postings) - required + 1
+            counts = Counter()
+            for posting in postings[:candidate_count]:
+                counts.update(posting)
+            for posting in postings[candidate_count:]:
+                for number in counts:
+                    if _contains(posting, number):
+                        counts[number] += 1
+            matches = [number for _, number in sorted((-count, number) for number, count in counts.items()
+                                                      if count >= required and keys[number] is not None)]
+
+        if limit is not None:
+            matches = matches[:limit]
+        return [keys[number] for number in matches]
+
+
+def _contains(posting: array, number: int) -> bool:
+    index = bisect_left(posting, number)
+    return index < len(posting) and posting[index] == number
+
+
+def do_main():
+    from state.WordCard import WordCard
+
+    letters = "abcçdefgğhıijklmnoöprsştuüvyz"
+    random.seed(1)
+
+    def random_word():
+        return "".join(random.choice(letters) for _ in range(random.randint(3, 10)))
+
+    cards = [WordCard(str(i), random_word(), random_word() if i % 3 == 0 else "",
+                      random_word() + " " + random_word(), "") for i in range(100_000)]
+    index = TrigramIndex()
+    start = time.perf_counter()
+    for card in cards:
+        index.add(card.identifier, (card.word, card.word_comment, card.translation, card.translation_comment))
+    print(f"Indexing {len(cards)} cards: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    word = cards[4242].word
+    # As typed, letter by letter, and then with a typo
+    queries = [word[:i] for i in range(1, len(word) + 1)] + [word[:2] + "x" + word[3:], normalize(word).upper()]
+    for query in queries:
+        start = time.perf_counter()
+        results = index.search(query)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{query!r}: {len(results)} results in {elapsed:.2f} ms, '4242' at {results.index('4242') if '4242' in results else None}")
+
+
+if __name__ == '__main__':
+    do_main()
@@ -1,22 +1,53 @@
 import base64
+import threading
 import time
+from typing import List
 
+# Ids handed out within one millisecond; the next ones borrow the following milliseconds
+IDS_PER_MILLISECOND = 1_000_000
 
-def encode_by_time(n=0):
-    # Ensure n is within the expected range
-    if not (0 <= n <= 1_000_000):
-        raise ValueError("n must be between 0 and 1,000,000 inclusive")
+# The last millisecond and n handed out by unique_ids_by_time, so that ids never repeat within a run
+_last_millis = 0
+_last_n = -1
+_ids_lock = threading.Lock()
 
-    # Get the current epoch time in milliseconds
-    current_time_millis = int(time.time() * 1000)
 
+def _encode(millis, n):
     # Multiply by 1,000,000 and add n
-    result = current_time_millis * 1_000_000 + n
+    result = millis * 1_000_000 + n
 
     # Convert the result to bytes
     result_bytes = result.to_bytes((result.bit_length() + 7) // 8, byteorder='big')
 
     # Encode the bytes to a base64 string
-    encoded_string = base64.urlsafe_b64encode(result_bytes).decode('utf-8').rstrip('=')
+    return base64.urlsafe_b64encode(result_bytes).decode('utf-8').rstrip('=')
 
-    return encoded_string
+
+def unique_ids_by_time(count=1) -> List[str]:
+    """
+    Encodes count ids from the current millisecond and a counter n, reserving the n values in one go,
+    so that ids made in the same millisecond, whether in one batch or in separate calls, are all different.
+    The ids sort in the order they were made when compared as numbers.
+    """
+    global _last_millis, _last_n
+    with _ids_lock:
+        millis = int(time.time() * 1000)
+        if millis > _last_millis:
+            n = 0
+        else:
+            millis = _last_millis
+            n = _last_n + 1
+        result = []
+        for _ in range(count):
+            if n == IDS_PER_MILLISECOND:
+                millis += 1
+                n = 0
+            result.append(_encode(millis, n))
+            n += 1
+        if count:
+            _last_millis, _last_n = millis, n - 1
+        return result
+
+
+def unique_id_by_time() -> str:
+    return unique_ids_by_time(1)[0]